@@ -0,0 +1,143 @@
+# -*- coding:utf-8 -*-
+# @FileName  :aoti_export.py
+# @Time      :2024/7/22 15:30
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import argparse
+import logging
+import os
+import time
+
+import torch
+from torch import nn
+
+from telespeechasr.torch.model.data2vec_ctc_inference import Data2VecCtcInference
+from telespeechasr.torch.utils.utils import load_checkpoint
+
+try:
+    from torch._inductor import aoti_compile_and_package, aoti_load_package
+    from torch.export import Dim
+except ImportError as e:
+    raise ImportError(
+        f"{os.path.basename(__file__)} needs torch>=2.6 for torch.export and "
+        f"AOTInductor packages, found torch {torch.__version__}, "
+        "install requirements-aoti.txt"
+    ) from e
+
+
+class data2vec_ctc_aoti_export(nn.Module):
+    """Export wrapper of ``Data2VecCtcInference`` with a required ``lengths`` input.
+
+    It returns B x T' x V logits and the number of valid output frames.
+    """
+
+    def __init__(self, model: Data2VecCtcInference):
+        super().__init__()
+        self.model = model
+
+    def forward(self, feats, lengths):
+        return self.model(feats, lengths)
+
+
+def export_aoti(
+    model: nn.Module,
+    package_path: str,
+    max_batch_size: int = 64,
+    max_frames: int = 30000,
+):
+    """torch.export the model with dynamic batch and time, then AOT compile it for CPU.
+
+    Args:
+        model: the export wrapper.
+        package_path: path of the ``.pt2`` package to write.
+        max_batch_size: largest batch size the package accepts.
+        max_frames: largest number of mfcc frames (10ms) the package accepts.
+    """
+    batch = Dim("batch", min=1, max=max_batch_size)
+    # the conv extractor needs at least 7 frames to output one
+    frames = Dim("frames", min=16, max=max_frames)
+    example_inputs = (torch.randn(2, 400, 40), torch.tensor([400, 300]))
+
+    start_time = time.time()
+    exported_program = torch.export.export(
+        model,
+        example_inputs,
+        dynamic_shapes={
+            "feats": {0: batch, 1: frames},
+            "lengths": {0: batch},
+        },
+    )
+    logging.info(f"torch.export done in {time.time() - start_time:.1f}s")
+
+    start_time = time.time()
+    package_path = aoti_compile_and_package(
+        exported_program, package_path=package_path
+    )
+    logging.info(f"AOT compilation done in {time.time() - start_time:.1f}s")
+    return package_path
+
+
+@torch.no_grad()
+def verify(model: nn.Module, package_path: str, lengths=(37, 155, 1000)):
+    """Compare the package with the eager model on padded batches."""
+    compiled = aoti_load_package(package_path)
+    for max_length in lengths:
+        feats = torch.randn(2, max_length, 40)
+        feat_lengths = torch.tensor([max_length, max(16, max_length * 2 // 3)])
+        logits, out_lengths = model(feats, feat_lengths)
+        compiled_logits, compiled_lengths = compiled(feats, feat_lengths)
+        assert torch.equal(out_lengths, compiled_lengths)
+        diff = (logits - compiled_logits).abs().max().item()
+        logging.info(f"T={max_length}: max abs diff {diff:.3g}")
+        assert diff < 1e-3, f"package output differs from eager at T={max_length}"
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        "--model_path",
+        type=str,
+        required=True,
+        help="Path to model checkpoint",
+    )
+
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        required=True,
+        help="Output dir of the compiled package",
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=64,
+        help="Largest batch size accepted by the package",
+    )
+    parser.add_argument(
+        "--max_frames",
+        type=int,
+        default=30000,
+        help="Largest number of mfcc frames (10ms) accepted by the package",
+    )
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    args = get_parser()
+    model = Data2VecCtcInference(vocab_size=7535)
+    model = load_checkpoint(args.model_path, model)
+    model_export = data2vec_ctc_aoti_export(model.eval())
+    package_path = export_aoti(
+        model_export,
+        os.path.join(args.output_dir, "model_export_aoti.pt2"),
+        max_batch_size=args.max_batch_size,
+        max_frames=args.max_frames,
+    )
+    verify(model_export, package_path)
@@ -0,0 +1,164 @@
+# -*- coding:utf-8 -*-
+# @FileName  :aoti_infer.py
+# @Time      :2024/7/22 16:10
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import argparse
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Tuple
+
+import kaldifeat
+import soundfile as sf
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from telespeechasr.decoding.timestamps import ctc_greedy_search, get_frame_shift
+from telespeechasr.torch.utils.utils import read_wave
+
+try:
+    from torch._inductor import aoti_load_package
+except ImportError as e:
+    raise ImportError(
+        f"{os.path.basename(__file__)} needs torch>=2.6 for torch.export and "
+        f"AOTInductor packages, found torch {torch.__version__}, "
+        "install requirements-aoti.txt"
+    ) from e
+
+
+class InferenceProcessor:
+    """Runtime of the package written by aoti_export.py, no model code is imported."""
+
+    def __init__(self, model_path, vocab_path=None, device: str = "cpu"):
+        self.model_path = model_path
+        self.vocab_path = vocab_path or os.path.join(
+            os.path.dirname(__file__), "data", "vocab.json"
+        )
+
+        with open(self.vocab_path, "r") as f:
+            self.vocab2id = json.load(f)
+            self.id2vocab = {}
+            for k, v in self.vocab2id.items():
+                self.id2vocab[v] = k
+
+        logging.info(f"Loading model from {self.model_path}")
+        start_time = time.time()
+        self.model = aoti_load_package(self.model_path)
+        logging.info(f"Model loaded in {(time.time() - start_time) * 1000:.1f}ms")
+
+        opts = kaldifeat.MfccOptions()
+        opts.device = torch.device("cpu")
+        opts.frame_opts.dither = 0
+        opts.num_ceps = 40
+        opts.mel_opts.num_bins = 40
+        opts.mel_opts.low_freq = 40
+        opts.mel_opts.high_freq = -200
+        opts.frame_opts.snip_edges = False
+        self.mfcc = kaldifeat.Mfcc(opts)
+        self.eps = 1e-5
+
+        self.blank_weight = 0.0
+        self.blank_mode = "add"
+        self.frame_shift = get_frame_shift()
+
+    def postprocess_batch(self, feats, lengths):
+        """Per-utterance CMVN of B x T x C padded features over the valid frames."""
+        mask = (
+            torch.arange(feats.size(1), device=feats.device)[None, :] < lengths[:, None]
+        ).unsqueeze(-1)
+        n = lengths.to(feats.dtype)[:, None, None]
+        feats = feats * mask
+        m = feats.sum(dim=1, keepdim=True) / n
+        # unbiased, as torch.std
+        var = ((feats - m) * mask).pow(2).sum(dim=1, keepdim=True) / (n - 1)
+        feats = (feats - m) / (var.sqrt() + self.eps)
+        return feats * mask
+
+    def get_features(
+        self, waves: List[torch.Tensor]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        feats = self.mfcc([wave.cpu() for wave in waves])
+        lengths = torch.tensor([f.size(0) for f in feats], dtype=torch.long)
+        feats = pad_sequence(feats, batch_first=True)
+        feats = self.postprocess_batch(feats, lengths)
+        return feats, lengths
+
+    def get_logits(self, logits):
+        if self.blank_weight != 0:
+            if self.blank_mode == "add":
+                logits[..., 0] += self.blank_weight
+            elif self.blank_mode == "set":
+                logits[..., 0] = self.blank_weight
+            else:
+                raise Exception(f"invalid blank mode {self.blank_mode}")
+
+        return logits
+
+    def viterbi_decode(
+        self,
+        emissions: torch.FloatTensor,
+    ) -> List[List[Dict]]:
+        return [
+            [ctc_greedy_search(x.cpu().numpy(), self.frame_shift)] for x in emissions
+        ]
+
+    def postprocess_sentence(self, tokens):
+        text = ""
+        for token in tokens:
+            if token in self.id2vocab:
+                token = self.id2vocab[token]
+                text += token
+        return text
+
+    @torch.no_grad()
+    def infer_batch(self, audio_paths: List[str]) -> List[str]:
+        """Recognise several audio files as one padded batch."""
+        waves = [read_wave(audio_path) for audio_path in audio_paths]
+        feats, lengths = self.get_features(waves)
+
+        emissions, lengths = self.model(feats, lengths)
+        emissions = self.get_logits(emissions).float()
+        return [
+            self.postprocess_sentence(hypos[0]["tokens"])
+            for hypos in self.viterbi_decode(
+                [e[:n] for e, n in zip(emissions, lengths.tolist())]
+            )
+        ]
+
+    def infer(self, audio_path):
+        logging.info(f"Decoding {audio_path}")
+        start_time = time.time()
+        result = self.infer_batch([audio_path])[0]
+        logging.info(f"Inference time: {time.time() - start_time}s")
+        return result
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser()
+    args.add_argument("--model_path", type=str, required=True)
+    args.add_argument("--audio_path", type=str, nargs="+", required=True)
+    args.add_argument("--vocab_path", type=str, default=None)
+    args.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="number of audio files decoded together, at most the "
+        "--max_batch_size of the export",
+    )
+
+    args = args.parse_args()
+
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    inference_processor = InferenceProcessor(args.model_path, args.vocab_path)
+    audio_paths = sorted(args.audio_path, key=lambda path: sf.info(path).frames)
+    start_time = time.time()
+    for i in range(0, len(audio_paths), args.batch_size):
+        batch = audio_paths[i : i + args.batch_size]
+        results = inference_processor.infer_batch(batch)
+        for audio_path, asr_result in zip(batch, results):
+            logging.info(f"{audio_path}: {asr_result}")
+    logging.info(f"Inference time: {time.time() - start_time}s")
@@ -0,0 +1,191 @@
+# -*- coding:utf-8 -*-
+# @FileName  :command_scorer.py
+# @Time      :2024/7/16 10:45
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import logging
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from telespeechasr.decoding.ctc_prefix_beam_search import NEG_INF, log_softmax
+
+
+def load_command_list(path: str) -> List[str]:
+    """Read commands from a txt file (one per line) or an excel annotation sheet.
+
+    For xls/xlsx files the speech content column of the besteasy annotation
+    layout (the second column, see tools/excel_annotation_convert.py) is used.
+    """
+    if os.path.splitext(path)[-1].lower() in (".xls", ".xlsx"):
+        import pandas as pd
+
+        df = pd.read_excel(path)
+        commands = [str(x).strip() for x in df.values[:, 1]]
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            commands = [line.strip() for line in f]
+
+    # keep the order of first occurrence
+    return list(dict.fromkeys(c for c in commands if c))
+
+
+class CommandScorer:
+    """Closed-set recognition by scoring every command with the CTC forward algorithm.
+
+    The commands are tokenised once. ``score`` runs one forward recursion over
+    all of them at the same time: the blank-interleaved label sequences are
+    padded into an N x S matrix and every frame updates the whole matrix with
+    a few vectorised numpy operations.
+    """
+
+    def __init__(
+        self,
+        commands: List[str],
+        vocab2id: Dict[str, int],
+        blank_id: int = 0,
+        rejection_threshold: float = 0.0,
+    ):
+        """
+        Args:
+            commands: command phrases.
+            vocab2id: token to id mapping, i.e. the content of vocab.json.
+            blank_id: id of the CTC blank.
+            rejection_threshold: results whose confidence is below this value
+                are reported as out-of-grammar (``command`` is None).
+        """
+        self.blank_id = blank_id
+        self.rejection_threshold = rejection_threshold
+
+        self.commands = []
+        token_ids = []
+        for command in commands:
+            chars = [c for c in command if not c.isspace()]
+            unknown = [c for c in chars if c not in vocab2id]
+            if unknown or not chars:
+                logging.warning(
+                    f"Skip command {command}: {''.join(unknown)} not in vocabulary"
+                )
+                continue
+            self.commands.append(command)
+            token_ids.append([vocab2id[c] for c in chars])
+
+        assert len(self.commands) > 0, "no valid command to score"
+
+        self.num_tokens = np.array([len(t) for t in token_ids], dtype=np.int64)
+        num_states = 2 * self.num_tokens + 1
+        max_states = int(num_states.max())
+
+        # blank interleaved labels: blank a blank b blank ...
+        labels = np.full((len(token_ids), max_states), blank_id, dtype=np.int64)
+        for i, tokens in enumerate(token_ids):
+            labels[i, 1 : 2 * len(tokens) : 2] = tokens
+        self.labels = labels
+
+        # a state may skip the blank before it if its label differs from the
+        # label two states back
+        can_skip = np.zeros_like(labels, dtype=bool)
+        can_skip[:, 2:] = (labels[:, 2:] != blank_id) & (
+            labels[:, 2:] != labels[:, :-2]
+        )
+        self.can_skip = can_skip
+
+        rows = np.arange(len(token_ids))
+        self.final_states = (rows, num_states - 1)
+        self.final_states_non_blank = (rows, num_states - 2)
+
+    def __len__(self):
+        return len(self.commands)
+
+    def forward_scores(self, log_probs: np.ndarray) -> np.ndarray:
+        """Log-likelihood of every command given T x V log posteriors."""
+        N, S = self.labels.shape
+        # T x N x S emission of each state, gathered once for the whole utterance
+        emissions = log_probs[:, self.labels]
+
+        alpha = np.full((N, S), NEG_INF, dtype=np.float32)
+        alpha[:, 0] = emissions[0, :, 0]
+        alpha[:, 1] = emissions[0, :, 1]
+
+        shift1 = np.full((N, S), NEG_INF, dtype=np.float32)
+        shift2 = np.full((N, S), NEG_INF, dtype=np.float32)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for t in range(1, log_probs.shape[0]):
+                shift1[:, 1:] = alpha[:, :-1]
+                shift2[:, 2:] = alpha[:, :-2]
+                shift2[~self.can_skip] = NEG_INF
+                m = np.maximum(np.maximum(alpha, shift1), shift2)
+                m_safe = np.where(np.isinf(m), 0.0, m)
+                alpha = (
+                    np.log(
+                        np.exp(alpha - m_safe)
+                        + np.exp(shift1 - m_safe)
+                        + np.exp(shift2 - m_safe)
+                    )
+                    + m_safe
+                    + emissions[t]
+                )
+
+        return np.logaddexp(
+            alpha[self.final_states], alpha[self.final_states_non_blank]
+        )
+
+    def score(self, logits: np.ndarray, nbest: int = 1) -> List[Dict]:
+        """Score all commands against the emissions of one utterance.
+
+        Args:
+            logits: T x V emissions (logits or log posteriors).
+            nbest: number of commands returned.
+
+        Returns:
+            Up to ``nbest`` dicts sorted by score with ``command``, ``score``
+            (log-likelihood), ``posterior`` (normalised over the command set)
+            and ``confidence``.  The confidence compares the command with the
+            best unconstrained CTC path, geometrically averaged over the
+            command tokens, so speech that none of the commands explain gets a
+            low value even though its posterior within the set may be high.
+        """
+        log_probs = log_softmax(logits)
+        scores = self.forward_scores(log_probs)
+
+        log_total = np.logaddexp.reduce(scores)
+        if np.isneginf(log_total):
+            # no command fits in the frames, e.g. audio too short for all
+            posteriors = np.zeros_like(scores)
+        else:
+            posteriors = np.exp(scores - log_total)
+        best_path = log_probs.max(axis=-1).sum()
+        confidences = np.exp(
+            np.minimum(scores - best_path, 0.0) / np.maximum(self.num_tokens, 1)
+        )
+
+        results = []
+        for i in np.argsort(-scores)[:nbest]:
+            confidence = float(confidences[i])
+            results.append(
+                {
+                    "command": self.commands[i]
+                    if confidence >= self.rejection_threshold
+                    and np.isfinite(scores[i])
+                    else None,
+                    "candidate": self.commands[i],
+                    "score": float(scores[i]),
+                    "posterior": float(posteriors[i]),
+                    "confidence": confidence,
+                }
+            )
+        return results
+
+
+def build_command_scorer(
+    commands,
+    vocab2id: Dict[str, int],
+    rejection_threshold: float = 0.0,
+) -> Optional[CommandScorer]:
+    """Build a scorer from a list of commands or a path accepted by ``load_command_list``."""
+    if commands is None:
+        return None
+    if isinstance(commands, str):
+        commands = load_command_list(commands)
+    return CommandScorer(commands, vocab2id, rejection_threshold=rejection_threshold)
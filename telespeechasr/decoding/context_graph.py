@@ -0,0 +1,244 @@
+# -*- coding:utf-8 -*-
+# @FileName  :context_graph.py
+# @Time      :2024/7/15 10:21
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import logging
+from collections import deque
+from typing import Dict, List, Optional, Tuple, Union
+
+
+class ContextState:
+    """A node of the hotword prefix trie."""
+
+    def __init__(
+        self,
+        id: int,
+        token: int,
+        token_score: float,
+        node_score: float,
+        output_score: float,
+        is_end: bool,
+        phrase: str = "",
+    ):
+        """
+        Args:
+            id: index of the node in the graph.
+            token: token id on the arc entering this node, -1 for the root.
+            token_score: boost of the arc entering this node.
+            node_score: accumulated boost from the root to this node, i.e. the
+                provisional score a hypothesis holds while it sits on this node.
+            output_score: boost granted permanently when a hotword ends here
+                (or on one of its output links).
+            is_end: whether a hotword ends at this node.
+            phrase: the hotword ending at this node.
+        """
+        self.id = id
+        self.token = token
+        self.token_score = token_score
+        self.node_score = node_score
+        self.output_score = output_score
+        self.is_end = is_end
+        self.phrase = phrase
+        self.next: Dict[int, "ContextState"] = {}
+        self.fail: Optional["ContextState"] = None
+        self.output: Optional["ContextState"] = None
+
+
+class ContextGraph:
+    """Aho-Corasick automaton over hotword token sequences.
+
+    Boosts are handed out one token at a time while a hypothesis walks down
+    the trie.  They are provisional: when the next token breaks the match the
+    hypothesis follows the fail arc and the difference of node scores is
+    returned, which rolls back the boost of the abandoned prefix.  Reaching
+    the end of a hotword adds its score once more through ``output_score`` so
+    that a completed match keeps its boost after the hypothesis moves on.
+    """
+
+    def __init__(self, context_score: float = 1.5):
+        """
+        Args:
+            context_score: default per-token boost for hotwords without an
+                explicit score.
+        """
+        self.context_score = context_score
+        self.num_nodes = 0
+        self.root = ContextState(
+            id=self.num_nodes,
+            token=-1,
+            token_score=0,
+            node_score=0,
+            output_score=0,
+            is_end=False,
+        )
+        self.root.fail = self.root
+
+    def __len__(self):
+        return self.num_nodes
+
+    def build(
+        self,
+        token_ids: List[List[int]],
+        scores: Optional[List[float]] = None,
+        phrases: Optional[List[str]] = None,
+    ) -> "ContextGraph":
+        """Insert hotwords into the trie and fill the fail/output arcs.
+
+        Args:
+            token_ids: token ids of each hotword.
+            scores: per-token boost of each hotword, 0 or None means
+                ``context_score``.
+            phrases: text of each hotword, only kept for reporting matches.
+        """
+        scores = scores or [0.0] * len(token_ids)
+        phrases = phrases or [""] * len(token_ids)
+        assert len(token_ids) == len(scores) == len(phrases)
+
+        for tokens, score, phrase in zip(token_ids, scores, phrases):
+            if len(tokens) == 0:
+                continue
+            context_score = self.context_score if score == 0.0 else score
+            node = self.root
+            for i, token in enumerate(tokens):
+                is_end = i == len(tokens) - 1
+                if token not in node.next:
+                    self.num_nodes += 1
+                    node_score = node.node_score + context_score
+                    node.next[token] = ContextState(
+                        id=self.num_nodes,
+                        token=token,
+                        token_score=context_score,
+                        node_score=node_score,
+                        output_score=node_score if is_end else 0.0,
+                        is_end=is_end,
+                        phrase=phrase if is_end else "",
+                    )
+                else:
+                    child = node.next[token]
+                    child.token_score = max(context_score, child.token_score)
+                    child.node_score = node.node_score + child.token_score
+                    child.is_end = is_end or child.is_end
+                    child.output_score = child.node_score if child.is_end else 0.0
+                    if is_end:
+                        child.phrase = phrase
+                node = node.next[token]
+
+        self._fill_fail_output()
+        return self
+
+    def _fill_fail_output(self):
+        queue = deque()
+        for node in self.root.next.values():
+            node.fail = self.root
+            queue.append(node)
+
+        while queue:
+            current = queue.popleft()
+            for token, node in current.next.items():
+                fail = current.fail
+                while token not in fail.next and fail is not self.root:
+                    fail = fail.fail
+                node.fail = fail.next[token] if token in fail.next else self.root
+
+                output = node.fail
+                while output is not self.root and not output.is_end:
+                    output = output.fail
+                node.output = output if output is not self.root else None
+                if node.output is not None:
+                    node.output_score += node.output.output_score
+                queue.append(node)
+
+    def forward_one_step(
+        self, state: ContextState, token: int
+    ) -> Tuple[float, ContextState, Optional[ContextState]]:
+        """Advance ``state`` by one emitted token.
+
+        Returns:
+            The score delta to add to the hypothesis, the next state and the
+            node of the hotword completed at this step (None if nothing ends).
+        """
+        if token in state.next:
+            node = state.next[token]
+            score = node.token_score
+        else:
+            node = state.fail
+            while token not in node.next and node is not self.root:
+                node = node.fail
+            if token in node.next:
+                node = node.next[token]
+            # roll back the boost of the abandoned prefix
+            score = node.node_score - state.node_score
+
+        matched = node if node.is_end else node.output
+        return score + node.output_score, node, matched
+
+    def finalize(self, state: ContextState) -> Tuple[float, ContextState]:
+        """Roll back the provisional boost of an unfinished match."""
+        return -state.node_score, self.root
+
+    def is_empty(self) -> bool:
+        return self.num_nodes == 0
+
+
+def parse_hotwords(
+    hotwords: Union[str, List[str], Dict[str, float]]
+) -> Dict[str, float]:
+    """Normalise a hotword specification to a ``{phrase: score}`` dict.
+
+    ``hotwords`` may be a dict, a list of lines or a path to a text file with
+    one hotword per line.  A line may carry its own per-token boost after a
+    colon, e.g. ``客厅扫拖 :2.0``; a score of 0 means the graph default.
+    """
+    if isinstance(hotwords, dict):
+        return dict(hotwords)
+
+    if isinstance(hotwords, str):
+        with open(hotwords, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+    else:
+        lines = hotwords
+
+    parsed = {}
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        score = 0.0
+        if ":" in line:
+            phrase, score_str = line.rsplit(":", 1)
+            try:
+                score = float(score_str)
+                line = phrase.strip()
+            except ValueError:
+                pass
+        parsed[line] = score
+    return parsed
+
+
+def build_context_graph(
+    hotwords: Union[str, List[str], Dict[str, float]],
+    vocab2id: Dict[str, int],
+    context_score: float = 1.5,
+) -> Optional[ContextGraph]:
+    """Tokenise hotwords through ``vocab2id`` and compile them into a graph.
+
+    Returns None when no hotword survives tokenisation, so callers can skip
+    biasing entirely.
+    """
+    token_ids, scores, phrases = [], [], []
+    for phrase, score in parse_hotwords(hotwords).items():
+        chars = [c for c in phrase if not c.isspace()]
+        unknown = [c for c in chars if c not in vocab2id]
+        if unknown:
+            logging.warning(
+                f"Skip hotword {phrase}: {''.join(unknown)} not in vocabulary"
+            )
+            continue
+        token_ids.append([vocab2id[c] for c in chars])
+        scores.append(score)
+        phrases.append(phrase)
+
+    if not token_ids:
+        return None
+    return ContextGraph(context_score).build(token_ids, scores, phrases)
@@ -0,0 +1,156 @@
+# -*- coding:utf-8 -*-
+# @FileName  :ctc_prefix_beam_search.py
+# @Time      :2024/7/15 14:02
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import math
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from telespeechasr.decoding.context_graph import ContextGraph, ContextState
+
+NEG_INF = -float("inf")
+
+
+def log_add(a: float, b: float) -> float:
+    if a == NEG_INF:
+        return b
+    if b == NEG_INF:
+        return a
+    if a > b:
+        return a + math.log1p(math.exp(b - a))
+    return b + math.log1p(math.exp(a - b))
+
+
+def log_softmax(logits: np.ndarray) -> np.ndarray:
+    logits = logits.astype(np.float32, copy=False)
+    m = logits.max(axis=-1, keepdims=True)
+    lse = np.log(np.exp(logits - m).sum(axis=-1, keepdims=True)) + m
+    return logits - lse
+
+
+class PrefixHypothesis:
+    __slots__ = (
+        "log_prob_blank",
+        "log_prob_non_blank",
+        "context_state",
+        "context_score",
+    )
+
+    def __init__(
+        self,
+        log_prob_blank: float = NEG_INF,
+        log_prob_non_blank: float = NEG_INF,
+        context_state: Optional[ContextState] = None,
+        context_score: float = 0.0,
+    ):
+        self.log_prob_blank = log_prob_blank
+        self.log_prob_non_blank = log_prob_non_blank
+        self.context_state = context_state
+        self.context_score = context_score
+
+    @property
+    def log_prob(self) -> float:
+        return log_add(self.log_prob_blank, self.log_prob_non_blank)
+
+    @property
+    def score(self) -> float:
+        return self.log_prob + self.context_score
+
+
+def ctc_prefix_beam_search(
+    log_probs: np.ndarray,
+    beam_size: int = 10,
+    context_graph: Optional[ContextGraph] = None,
+    blank_id: int = 0,
+    nbest: int = 1,
+) -> List[Dict[str, np.ndarray]]:
+    """CTC prefix beam search over the emissions of one utterance.
+
+    Args:
+        log_probs: T x V log posteriors.
+        beam_size: number of prefixes kept per frame, also the number of
+            candidate tokens expanded per frame.
+        context_graph: optional hotword graph; its boosts are applied each
+            time a prefix is extended by a new token.
+        blank_id: id of the CTC blank.
+        nbest: number of hypotheses returned.
+
+    Returns:
+        Up to ``nbest`` hypotheses sorted by score, each a dict with ``tokens``
+        and ``score`` like the output of ``viterbi_decode``.
+    """
+    T, V = log_probs.shape
+    beam_size = min(beam_size, V)
+    use_context = context_graph is not None and not context_graph.is_empty()
+    root = context_graph.root if use_context else None
+
+    # candidate tokens of every frame, selected in one vectorised pass
+    if beam_size < V:
+        candidates = np.argpartition(-log_probs, beam_size - 1, axis=-1)[:, :beam_size]
+    else:
+        candidates = np.broadcast_to(np.arange(V), (T, V))
+
+    beam = {(): PrefixHypothesis(0.0, NEG_INF, root, 0.0)}
+    for t in range(T):
+        frame = log_probs[t]
+        next_beam: Dict[tuple, PrefixHypothesis] = {}
+
+        def get_hyp(prefix, parent, token):
+            hyp = next_beam.get(prefix)
+            if hyp is None:
+                if token is None or not use_context:
+                    hyp = PrefixHypothesis(
+                        context_state=parent.context_state,
+                        context_score=parent.context_score,
+                    )
+                else:
+                    delta, state, _ = context_graph.forward_one_step(
+                        parent.context_state, token
+                    )
+                    hyp = PrefixHypothesis(
+                        context_state=state,
+                        context_score=parent.context_score + delta,
+                    )
+                next_beam[prefix] = hyp
+            return hyp
+
+        for prefix, hyp in beam.items():
+            last = prefix[-1] if prefix else None
+            for token in candidates[t]:
+                token = int(token)
+                p = float(frame[token])
+                if token == blank_id:
+                    cur = get_hyp(prefix, hyp, None)
+                    cur.log_prob_blank = log_add(cur.log_prob_blank, hyp.log_prob + p)
+                elif token == last:
+                    # repeated token without blank in between collapses
+                    cur = get_hyp(prefix, hyp, None)
+                    cur.log_prob_non_blank = log_add(
+                        cur.log_prob_non_blank, hyp.log_prob_non_blank + p
+                    )
+                    new = get_hyp(prefix + (token,), hyp, token)
+                    new.log_prob_non_blank = log_add(
+                        new.log_prob_non_blank, hyp.log_prob_blank + p
+                    )
+                else:
+                    new = get_hyp(prefix + (token,), hyp, token)
+                    new.log_prob_non_blank = log_add(
+                        new.log_prob_non_blank, hyp.log_prob + p
+                    )
+
+        beam = dict(
+            sorted(next_beam.items(), key=lambda x: x[1].score, reverse=True)[
+                :beam_size
+            ]
+        )
+
+    hyps = []
+    for prefix, hyp in beam.items():
+        score = hyp.score
+        if use_context:
+            score += context_graph.finalize(hyp.context_state)[0]
+        hyps.append({"tokens": np.array(prefix, dtype=np.int64), "score": score})
+    hyps.sort(key=lambda x: x["score"], reverse=True)
+    return hyps[:nbest]
@@ -0,0 +1,190 @@
+# -*- coding:utf-8 -*-
+# @FileName  :emission_archive.py
+# @Time      :2024/7/18 10:13
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import json
+import os
+from typing import Dict, Iterator, List, Tuple, Union
+
+import numpy as np
+
+from telespeechasr.decoding.ctc_prefix_beam_search import log_softmax
+
+INDEX_FILE = "index.json"
+IDS_FILE = "topk_ids.bin"
+LOGPROBS_FILE = "topk_logprobs.bin"
+REPEATS_FILE = "repeats.bin"
+
+MAX_REPEATS = np.iinfo(np.uint16).max
+
+
+class EmissionArchiveWriter:
+    """Append-only writer of a compact emission archive.
+
+    Each frame keeps only its ``top_k`` log posteriors in float16 together
+    with their token ids.  Consecutive frames whose blank posterior is above
+    ``blank_threshold`` are stored once with a repeat count, which removes
+    most of the silence and the blank frames between tokens.  The data goes
+    to three flat binary files that ``EmissionArchive`` maps into memory, and
+    ``index.json`` records where every utterance starts.
+    """
+
+    def __init__(
+        self,
+        archive_dir: str,
+        top_k: int = 16,
+        blank_threshold: float = 0.999,
+        blank_id: int = 0,
+        frame_shift: float = None,
+    ):
+        os.makedirs(archive_dir, exist_ok=True)
+        self.archive_dir = archive_dir
+        self.top_k = top_k
+        self.log_blank_threshold = float(np.log(blank_threshold))
+        self.blank_threshold = blank_threshold
+        self.blank_id = blank_id
+        self.frame_shift = frame_shift
+        self.vocab_size = None
+
+        self.utterances: List[Dict] = []
+        self.num_stored = 0
+        self.ids_file = open(os.path.join(archive_dir, IDS_FILE), "wb")
+        self.logprobs_file = open(os.path.join(archive_dir, LOGPROBS_FILE), "wb")
+        self.repeats_file = open(os.path.join(archive_dir, REPEATS_FILE), "wb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, key: str, logits: np.ndarray):
+        """Append the T x V emissions (logits or log posteriors) of one utterance."""
+        T, V = logits.shape
+        if self.vocab_size is None:
+            self.vocab_size = V
+        assert V == self.vocab_size, f"vocab size mismatch: {V} vs {self.vocab_size}"
+        k = min(self.top_k, V)
+
+        log_probs = log_softmax(logits)
+
+        # merge runs of confident blank frames into one stored frame
+        is_blank = log_probs[:, self.blank_id] >= self.log_blank_threshold
+        starts_run = np.ones(T, dtype=bool)
+        starts_run[1:] = ~(is_blank[1:] & is_blank[:-1])
+        starts = np.flatnonzero(starts_run)
+        repeats = np.diff(np.append(starts, T))
+        # split runs that do not fit the repeat counter
+        if T and repeats.max() > MAX_REPEATS:
+            starts = np.concatenate(
+                [np.arange(s, s + r, MAX_REPEATS) for s, r in zip(starts, repeats)]
+            )
+            repeats = np.diff(np.append(starts, T))
+
+        kept = log_probs[starts]
+        if k < V:
+            ids = np.argpartition(-kept, k - 1, axis=-1)[:, :k]
+        else:
+            ids = np.broadcast_to(np.arange(V), kept.shape)
+        values = np.take_along_axis(kept, ids, axis=-1)
+
+        ids.astype(np.uint16).tofile(self.ids_file)
+        values.astype(np.float16).tofile(self.logprobs_file)
+        repeats.astype(np.uint16).tofile(self.repeats_file)
+
+        self.utterances.append(
+            {
+                "key": key,
+                "offset": self.num_stored,
+                "num_stored": len(starts),
+                "num_frames": T,
+            }
+        )
+        self.num_stored += len(starts)
+
+    def close(self):
+        if self.ids_file.closed:
+            return
+        for f in (self.ids_file, self.logprobs_file, self.repeats_file):
+            f.close()
+
+        index = {
+            "top_k": min(self.top_k, self.vocab_size or self.top_k),
+            "vocab_size": self.vocab_size,
+            "blank_id": self.blank_id,
+            "blank_threshold": self.blank_threshold,
+            "frame_shift": self.frame_shift,
+            "num_stored": self.num_stored,
+            "utterances": self.utterances,
+        }
+        with open(
+            os.path.join(self.archive_dir, INDEX_FILE), "w", encoding="utf-8"
+        ) as f:
+            json.dump(index, f, ensure_ascii=False, indent=1)
+
+
+class EmissionArchive:
+    """Read-only, memory-mapped view of an archive written by ``EmissionArchiveWriter``."""
+
+    def __init__(self, archive_dir: str):
+        with open(os.path.join(archive_dir, INDEX_FILE), "r", encoding="utf-8") as f:
+            index = json.load(f)
+
+        self.top_k = index["top_k"]
+        self.vocab_size = index["vocab_size"]
+        self.blank_id = index["blank_id"]
+        self.frame_shift = index["frame_shift"]
+        self.utterances = index["utterances"]
+        self.key2index = {u["key"]: i for i, u in enumerate(self.utterances)}
+
+        num_stored = index["num_stored"]
+        shape = (num_stored, self.top_k)
+
+        def memmap(name, dtype, shape):
+            if num_stored == 0:
+                return np.zeros(shape, dtype=dtype)
+            path = os.path.join(archive_dir, name)
+            return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+        self.ids = memmap(IDS_FILE, np.uint16, shape)
+        self.logprobs = memmap(LOGPROBS_FILE, np.float16, shape)
+        self.repeats = memmap(REPEATS_FILE, np.uint16, (num_stored,))
+
+    def __len__(self):
+        return len(self.utterances)
+
+    def keys(self) -> List[str]:
+        return [u["key"] for u in self.utterances]
+
+    def get_sparse(
+        self, key: Union[str, int]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return the stored top-k ids, log posteriors and repeat counts."""
+        index = self.key2index[key] if isinstance(key, str) else key
+        utt = self.utterances[index]
+        s = slice(utt["offset"], utt["offset"] + utt["num_stored"])
+        return self.ids[s], self.logprobs[s], self.repeats[s]
+
+    def __getitem__(self, key: Union[str, int]) -> np.ndarray:
+        """Rebuild the dense T x V log posteriors of one utterance.
+
+        The probability mass outside the stored top-k is spread evenly over
+        the remaining tokens, and merged blank frames are repeated.
+        """
+        ids, logprobs, repeats = self.get_sparse(key)
+        logprobs = logprobs.astype(np.float32)
+        n, k = ids.shape
+
+        rest_mass = 1.0 - np.exp(logprobs).sum(axis=-1, keepdims=True)
+        floor = np.log(
+            np.clip(rest_mass, 1e-10, None) / max(self.vocab_size - k, 1)
+        ).astype(np.float32)
+
+        dense = np.repeat(floor, self.vocab_size, axis=-1)
+        np.put_along_axis(dense, ids.astype(np.int64), logprobs, axis=-1)
+        return np.repeat(dense, repeats.astype(np.int64), axis=0)
+
+    def __iter__(self) -> Iterator[Tuple[str, np.ndarray]]:
+        for i, utt in enumerate(self.utterances):
+            yield utt["key"], self[i]
@@ -0,0 +1,70 @@
+# -*- coding:utf-8 -*-
+# @FileName  :metrics.py
+# @Time      :2024/7/23 11:15
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import glob
+import os
+from typing import Dict, Sequence
+
+
+def edit_distance(ref: Sequence, hyp: Sequence) -> int:
+    """Levenshtein distance between two sequences."""
+    prev = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        curr = [i] + [0] * len(hyp)
+        for j, h in enumerate(hyp, 1):
+            curr[j] = min(prev[j] + 1, curr[j - 1] + 1, prev[j - 1] + (r != h))
+        prev = curr
+    return prev[-1]
+
+
+def normalize_text(text: str) -> str:
+    """Remove whitespace, characters are compared one by one."""
+    return "".join(text.split())
+
+
+def load_references(annotation_path: str) -> Dict[str, str]:
+    """Read reference transcripts keyed by audio basename.
+
+    ``annotation_path`` is either a directory of txt files named after the
+    audio files, whose first line is the content (the layout written by
+    tools/excel_annotation_convert.py), or a kaldi style text file with one
+    ``<audio basename> <content>`` per line.
+    """
+    references = {}
+    if os.path.isdir(annotation_path):
+        for path in glob.glob(os.path.join(annotation_path, "*.txt")):
+            key = os.path.splitext(os.path.basename(path))[0]
+            with open(path, "r", encoding="utf-8") as f:
+                references[key] = f.readline().strip()
+    else:
+        with open(annotation_path, "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.strip().split(maxsplit=1)
+                if parts:
+                    references[parts[0]] = parts[1] if len(parts) > 1 else ""
+    return references
+
+
+def compute_cer(references: Dict[str, str], hypotheses: Dict[str, str]) -> Dict:
+    """Character error rate of the hypotheses that have a reference.
+
+    Returns:
+        A dict with ``cer``, the number of ``errors`` and reference ``chars``
+        and the number of scored utterances ``num_utts``.
+    """
+    errors = chars = num_utts = 0
+    for key, hyp in hypotheses.items():
+        if key not in references:
+            continue
+        ref = normalize_text(references[key])
+        errors += edit_distance(ref, normalize_text(hyp))
+        chars += len(ref)
+        num_utts += 1
+    return {
+        "cer": errors / max(chars, 1),
+        "errors": errors,
+        "chars": chars,
+        "num_utts": num_utts,
+    }
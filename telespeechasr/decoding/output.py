@@ -0,0 +1,55 @@
+# -*- coding:utf-8 -*-
+# @FileName  :output.py
+# @Time      :2024/7/18 15:40
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import json
+import os
+from typing import Tuple
+
+import numpy as np
+
+from telespeechasr.decoding.timestamps import to_json_result, to_srt
+
+
+def format_result(
+    decoder, emissions: np.ndarray, command_mode: bool = False, output_format="txt"
+) -> Tuple[str, str]:
+    """Decode the B x T x V emissions of one audio for saving.
+
+    Args:
+        decoder: an object with the decoding interface of
+            ``TeleSpeechAsrInferSession`` (``decode``, ``get_logits``,
+            ``command_scorer``, ``postprocess_sentence`` and ``id2vocab``).
+        emissions: B x T x V emissions, only the first utterance is used.
+        command_mode: score against ``decoder.command_scorer`` instead of
+            decoding freely.
+        output_format: txt, json or srt.
+
+    Returns:
+        The content to save and its file extension.
+    """
+    if command_mode:
+        # the recognised command (empty if rejected) and its confidence
+        command_result = decoder.command_scorer.score(decoder.get_logits(emissions)[0])[
+            0
+        ]
+        command = command_result["command"] or ""
+        return f"{command}\n{command_result['confidence']:.4f}", "txt"
+
+    hypo = decoder.decode(emissions)[0][0]
+    if output_format == "txt":
+        return decoder.postprocess_sentence(hypo["tokens"]), "txt"
+
+    json_result = to_json_result(hypo, decoder.id2vocab)
+    if output_format == "srt":
+        return to_srt(json_result), "srt"
+    return json.dumps(json_result, ensure_ascii=False, indent=2), "json"
+
+
+def save_result(output_path: str, key: str, content: str, ext: str):
+    os.makedirs(output_path, exist_ok=True)
+    output_file_name = os.path.join(output_path, f"{key}.{ext}")
+    with open(output_file_name, "w", encoding="utf-8") as f:
+        f.write(content)
+        f.write("\n")
@@ -0,0 +1,151 @@
+# -*- coding:utf-8 -*-
+# @FileName  :redecode.py
+# @Time      :2024/7/18 16:05
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import argparse
+import json
+import logging
+import os
+import time
+from typing import Dict, List
+
+import numpy as np
+from tqdm import tqdm
+
+from telespeechasr.decoding.command_scorer import build_command_scorer
+from telespeechasr.decoding.context_graph import build_context_graph
+from telespeechasr.decoding.ctc_prefix_beam_search import (
+    ctc_prefix_beam_search,
+    log_softmax,
+)
+from telespeechasr.decoding.emission_archive import EmissionArchive
+from telespeechasr.decoding.output import format_result, save_result
+from telespeechasr.decoding.timestamps import ctc_greedy_search, get_frame_shift
+
+
+class ArchiveDecoder:
+    """Decoding half of ``TeleSpeechAsrInferSession`` working on archived emissions.
+
+    The archive stores log posteriors instead of logits.  ``blank_mode="add"``
+    gives exactly the same result as on logits since adding to one column
+    commutes with the per-frame normalisation, ``blank_mode="set"`` sets the
+    blank log posterior.
+    """
+
+    def __init__(
+        self,
+        vocab_path=None,
+        decoding_method="greedy_search",
+        beam_size=10,
+        hotwords=None,
+        hotwords_score=1.5,
+        commands=None,
+        command_threshold=0.0,
+        blank_weight=0.0,
+        blank_mode="add",
+        frame_shift=None,
+    ):
+        self.vocab_path = vocab_path or os.path.join(
+            os.path.dirname(__file__), "..", "onnx", "data", "vocab.json"
+        )
+        with open(self.vocab_path, "r", encoding="utf-8") as f:
+            self.vocab2id = json.load(f)
+            self.id2vocab = {v: k for k, v in self.vocab2id.items()}
+
+        self.blank_weight = blank_weight
+        self.blank_mode = blank_mode
+        self.frame_shift = frame_shift or get_frame_shift()
+
+        assert decoding_method in ("greedy_search", "prefix_beam_search")
+        self.decoding_method = decoding_method
+        self.beam_size = beam_size
+        self.context_graph = (
+            build_context_graph(hotwords, self.vocab2id, hotwords_score)
+            if hotwords is not None
+            else None
+        )
+        self.command_scorer = build_command_scorer(
+            commands, self.vocab2id, command_threshold
+        )
+
+    def get_logits(self, logits):
+        if self.blank_weight != 0:
+            if self.blank_mode == "add":
+                logits[..., 0] += self.blank_weight
+            elif self.blank_mode == "set":
+                logits[..., 0] = self.blank_weight
+            else:
+                raise Exception(f"invalid blank mode {self.blank_mode}")
+
+        return logits
+
+    def decode(self, emissions: np.ndarray) -> List[List[Dict[str, np.ndarray]]]:
+        emissions = self.get_logits(emissions)
+        if self.decoding_method == "prefix_beam_search" or self.context_graph:
+            return [
+                ctc_prefix_beam_search(
+                    log_softmax(x), self.beam_size, context_graph=self.context_graph
+                )
+                for x in emissions
+            ]
+        return [[ctc_greedy_search(x, self.frame_shift)] for x in emissions]
+
+    def postprocess_sentence(self, tokens):
+        return "".join(self.id2vocab[t] for t in tokens if t in self.id2vocab)
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(
+        description="decode an emission archive saved by onnx_batch_infer.py "
+        "--save_emissions with other decoding settings"
+    )
+    args.add_argument("--archive", type=str, required=True)
+    args.add_argument("--output_path", type=str, required=True)
+    args.add_argument("--vocab_path", type=str, default=None)
+    args.add_argument(
+        "--decoding_method",
+        type=str,
+        default="greedy_search",
+        choices=["greedy_search", "prefix_beam_search"],
+    )
+    args.add_argument("--beam_size", type=int, default=10)
+    args.add_argument("--hotwords", type=str, default=None)
+    args.add_argument("--hotwords_score", type=float, default=1.5)
+    args.add_argument("--commands", type=str, default=None)
+    args.add_argument("--command_threshold", type=float, default=0.0)
+    args.add_argument("--blank_weight", type=float, default=0.0)
+    args.add_argument("--blank_mode", type=str, default="add", choices=["add", "set"])
+    args.add_argument(
+        "--output_format", type=str, default="txt", choices=["txt", "json", "srt"]
+    )
+
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    args = args.parse_args()
+
+    archive = EmissionArchive(args.archive)
+    decoder = ArchiveDecoder(
+        args.vocab_path,
+        decoding_method=args.decoding_method,
+        beam_size=args.beam_size,
+        hotwords=args.hotwords,
+        hotwords_score=args.hotwords_score,
+        commands=args.commands,
+        command_threshold=args.command_threshold,
+        blank_weight=args.blank_weight,
+        blank_mode=args.blank_mode,
+        frame_shift=archive.frame_shift,
+    )
+
+    start_time = time.time()
+    for key, log_probs in tqdm(archive, total=len(archive), desc="redecode"):
+        content, ext = format_result(
+            decoder, log_probs[None, ...], args.commands is not None, args.output_format
+        )
+        save_result(args.output_path, key, content, ext)
+    logging.info(
+        f"Decoded {len(archive)} utterances in {time.time() - start_time:.4}s, "
+        f"results saved to {args.output_path}"
+    )
@@ -0,0 +1,153 @@
+# -*- coding:utf-8 -*-
+# @FileName  :timestamps.py
+# @Time      :2024/7/17 09:52
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+# same as the default feature_encoder_spec of AudioEncoder
+FEATURE_ENCODER_SPEC = [(512, 3, 2), (512, 3, 2)]
+# frame shift of the mfcc frontend in seconds
+FEATURE_FRAME_SHIFT = 0.01
+
+
+def get_frame_shift(
+    feature_enc_layers: Sequence[Tuple[int, int, int]] = FEATURE_ENCODER_SPEC,
+    feature_frame_shift: float = FEATURE_FRAME_SHIFT,
+) -> float:
+    """Duration in seconds of one output frame of the model.
+
+    The conv feature extractor downsamples the mfcc frames by the product of
+    its strides, e.g. 4x (40ms per frame) for the default spec.
+    """
+    subsampling = 1
+    for _, _, stride in feature_enc_layers:
+        subsampling *= stride
+    return subsampling * feature_frame_shift
+
+
+def ctc_greedy_search(
+    logits: np.ndarray,
+    frame_shift: float = None,
+    blank_id: int = 0,
+) -> Dict[str, np.ndarray]:
+    """Greedy CTC decoding that also returns token timing and confidence.
+
+    Everything is computed from the same argmax pass: runs of identical
+    argmax labels are found with one ``diff`` and reduced with ``reduceat``,
+    so no per-frame python loop is involved.
+
+    Args:
+        logits: T x V emissions of one utterance.
+        frame_shift: seconds per frame, see ``get_frame_shift``.
+        blank_id: id of the CTC blank.
+
+    Returns:
+        A dict with ``tokens``, the ``start``/``end`` time of each token in
+        seconds, ``token_scores`` (mean posterior of the frames emitting the
+        token), the utterance level ``confidence`` and ``score`` (log
+        probability of the best path).
+    """
+    frame_shift = get_frame_shift() if frame_shift is None else frame_shift
+    T = logits.shape[0]
+    if T == 0:
+        empty = np.zeros(0, dtype=np.float32)
+        return {
+            "tokens": np.zeros(0, dtype=np.int64),
+            "start": empty,
+            "end": empty,
+            "token_scores": empty,
+            "confidence": 0.0,
+            "score": 0.0,
+        }
+
+    toks = logits.argmax(axis=-1)
+    # posterior of the argmax label: exp(max - logsumexp)
+    max_logits = logits.max(axis=-1, keepdims=True)
+    probs = 1.0 / np.exp(logits - max_logits).sum(axis=-1)
+
+    is_start = np.empty(T, dtype=bool)
+    is_start[0] = True
+    is_start[1:] = toks[1:] != toks[:-1]
+    starts = np.flatnonzero(is_start)
+    ends = np.append(starts[1:], T)
+
+    seg_tokens = toks[starts]
+    seg_scores = np.add.reduceat(probs, starts) / (ends - starts)
+    keep = seg_tokens != blank_id
+
+    token_scores = seg_scores[keep].astype(np.float32)
+    confidence = (
+        float(token_scores.mean()) if len(token_scores) else float(probs.mean())
+    )
+    return {
+        "tokens": seg_tokens[keep],
+        "start": (starts[keep] * frame_shift).astype(np.float32),
+        "end": (ends[keep] * frame_shift).astype(np.float32),
+        "token_scores": token_scores,
+        "confidence": confidence,
+        "score": float(np.log(probs).sum()),
+    }
+
+
+def to_json_result(hypo: Dict, id2vocab: Dict[int, str]) -> Dict:
+    """Convert a hypothesis with timestamps to a json friendly dict."""
+    tokens = [int(t) for t in hypo["tokens"] if int(t) in id2vocab]
+    result = {"text": "".join(id2vocab[t] for t in tokens)}
+    if "confidence" in hypo:
+        result["confidence"] = round(float(hypo["confidence"]), 4)
+    if "start" in hypo:
+        result["tokens"] = [
+            {
+                "token": id2vocab[int(t)],
+                "start": round(float(s), 3),
+                "end": round(float(e), 3),
+                "confidence": round(float(c), 4),
+            }
+            for t, s, e, c in zip(
+                hypo["tokens"], hypo["start"], hypo["end"], hypo["token_scores"]
+            )
+            if int(t) in id2vocab
+        ]
+    return result
+
+
+def _format_srt_time(seconds: float) -> str:
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d},{milliseconds:03d}"
+
+
+def to_srt(
+    json_result: Dict,
+    max_gap: float = 0.8,
+    max_chars: int = 20,
+) -> str:
+    """Group timed tokens into subtitle cues.
+
+    A new cue starts after a pause longer than ``max_gap`` seconds or when the
+    current cue reaches ``max_chars`` tokens.
+    """
+    cues: List[List[Dict]] = []
+    for token in json_result.get("tokens", []):
+        if (
+            not cues
+            or token["start"] - cues[-1][-1]["end"] > max_gap
+            or len(cues[-1]) >= max_chars
+        ):
+            cues.append([])
+        cues[-1].append(token)
+
+    lines = []
+    for i, cue in enumerate(cues):
+        lines.append(str(i + 1))
+        lines.append(
+            f"{_format_srt_time(cue[0]['start'])} --> {_format_srt_time(cue[-1]['end'])}"
+        )
+        lines.append("".join(token["token"] for token in cue))
+        lines.append("")
+    return "\n".join(lines)
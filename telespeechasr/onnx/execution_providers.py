@@ -0,0 +1,325 @@
+# -*- coding:utf-8 -*-
+# @FileName  :execution_providers.py
+# @Time      :2024/8/1 10:15
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import argparse
+import json
+import logging
+import time
+import warnings
+from typing import Dict, List, Sequence, Tuple, Union
+
+import numpy as np
+from onnxruntime import (
+    GraphOptimizationLevel,
+    InferenceSession,
+    SessionOptions,
+    get_available_providers,
+)
+
+# short name -> onnxruntime execution provider and its default options,
+# ``{device_id}`` and ``{num_threads}`` are filled in by ``get_providers``
+PROVIDERS = {
+    "cpu": ("CPUExecutionProvider", {"arena_extend_strategy": "kSameAsRequested"}),
+    "dnnl": ("DnnlExecutionProvider", {}),
+    "openvino": ("OpenVINOExecutionProvider", {"device_type": "CPU"}),
+    "xnnpack": ("XnnpackExecutionProvider", {"intra_op_num_threads": "{num_threads}"}),
+    "cuda": (
+        "CUDAExecutionProvider",
+        {
+            "device_id": "{device_id}",
+            "arena_extend_strategy": "kNextPowerOfTwo",
+            "cudnn_conv_algo_search": "EXHAUSTIVE",
+            "do_copy_in_default_stream": "true",
+        },
+    ),
+    "tensorrt": ("TensorrtExecutionProvider", {"device_id": "{device_id}"}),
+    "coreml": ("CoreMLExecutionProvider", {}),
+}
+
+# device -> providers tried in order, cpu always comes last
+DEVICES = {
+    "cpu": ["cpu"],
+    "dnnl": ["dnnl", "cpu"],
+    "openvino": ["openvino", "cpu"],
+    "xnnpack": ["xnnpack", "cpu"],
+    "cuda": ["cuda", "cpu"],
+    "tensorrt": ["tensorrt", "cuda", "cpu"],
+    "coreml": ["coreml", "cpu"],
+}
+
+
+def register_provider(
+    name: str, provider: str, options: Dict = None, fallbacks: Sequence[str] = ()
+):
+    """Add an execution provider under ``name``, usable as a ``--device``.
+
+    Args:
+        provider: onnxruntime name, e.g. ``ROCMExecutionProvider``.
+        options: its provider options, may use ``{device_id}`` and
+            ``{num_threads}``.
+        fallbacks: names of the providers tried when this one is missing.
+    """
+    PROVIDERS[name] = (provider, dict(options or {}))
+    DEVICES[name] = [name, *[p for p in fallbacks if p != "cpu"], "cpu"]
+
+
+def parse_device(device: str) -> List[str]:
+    """Provider names of a device, or of a comma separated list like ``openvino,dnnl``."""
+    if device in DEVICES:
+        return list(DEVICES[device])
+    names = [name.strip() for name in device.split(",") if name.strip()]
+    unknown = [name for name in names if name not in PROVIDERS]
+    if not names or unknown:
+        raise ValueError(
+            f"Unsupported device: {device}, expected one of {list(DEVICES)} "
+            f"or a comma separated list of {list(PROVIDERS)}"
+        )
+    if "cpu" not in names:
+        names.append("cpu")
+    return names
+
+
+def get_providers(
+    device: str = "cpu",
+    device_id: int = 0,
+    num_threads: int = 4,
+    provider_options: Dict[str, Dict] = None,
+) -> List[Tuple[str, Dict]]:
+    """Ordered ``(provider, options)`` list of a device, for ``InferenceSession``.
+
+    Providers missing from this onnxruntime build are skipped with a warning,
+    so that the session falls back to the next one.
+
+    Args:
+        provider_options: options overriding the defaults, keyed by short name.
+    """
+    available = get_available_providers()
+    provider_options = provider_options or {}
+    providers = []
+    for name in parse_device(device):
+        provider, options = PROVIDERS[name]
+        if provider not in available:
+            warnings.warn(
+                f"{provider} is not available in this onnxruntime build "
+                f"(available: {available}), falling back to the next provider",
+                RuntimeWarning,
+            )
+            continue
+        options = {
+            key: str(value).format(device_id=max(device_id, 0), num_threads=num_threads)
+            for key, value in {**options, **provider_options.get(name, {})}.items()
+        }
+        providers.append((provider, options))
+    return providers
+
+
+# SessionOptions attributes carried over to the options of an xnnpack session
+_SESSION_OPTION_ATTRS = (
+    "graph_optimization_level",
+    "execution_mode",
+    "inter_op_num_threads",
+    "enable_cpu_mem_arena",
+    "enable_mem_pattern",
+    "log_severity_level",
+)
+
+
+def _provider_session_options(
+    sess_options: SessionOptions, provider: str
+) -> SessionOptions:
+    """Session options for a session whose first provider is ``provider``.
+
+    xnnpack runs its own thread pool, the onnxruntime one would compete with
+    it, so it gets a fresh copy with a single non spinning intra op thread.
+    The options of the caller are left untouched for the fallback providers.
+    """
+    if provider != PROVIDERS["xnnpack"][0]:
+        return sess_options
+    xnnpack_options = SessionOptions()
+    for attr in _SESSION_OPTION_ATTRS:
+        setattr(xnnpack_options, attr, getattr(sess_options, attr))
+    xnnpack_options.intra_op_num_threads = 1
+    xnnpack_options.add_session_config_entry("session.intra_op.allow_spinning", "0")
+    return xnnpack_options
+
+
+def create_session(
+    model: Union[str, bytes],
+    device: str = "cpu",
+    device_id: int = 0,
+    intra_op_num_threads: int = 4,
+    sess_options: SessionOptions = None,
+    provider_options: Dict[str, Dict] = None,
+) -> InferenceSession:
+    """``InferenceSession`` on the first provider of ``device`` that works.
+
+    A provider that is built in but fails to initialise (missing CUDA or
+    TensorRT libraries, unsupported model, ...) is dropped and the session is
+    created again with the remaining ones.
+    """
+    if sess_options is None:
+        sess_options = SessionOptions()
+        sess_options.intra_op_num_threads = intra_op_num_threads
+        sess_options.graph_optimization_level = GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    providers = get_providers(device, device_id, intra_op_num_threads, provider_options)
+    while True:
+        try:
+            session = InferenceSession(
+                model,
+                sess_options=_provider_session_options(sess_options, providers[0][0]),
+                providers=[p for p, _ in providers],
+                provider_options=[o for _, o in providers],
+            )
+            break
+        except Exception as e:
+            if len(providers) == 1:
+                raise
+            warnings.warn(
+                f"{providers[0][0]} failed to initialise ({e}), "
+                f"falling back to {providers[1][0]}",
+                RuntimeWarning,
+            )
+            providers = providers[1:]
+
+    if session.get_providers()[0] != providers[0][0]:
+        warnings.warn(
+            f"{providers[0][0]} was requested but the session runs on "
+            f"{session.get_providers()}",
+            RuntimeWarning,
+        )
+    return session
+
+
+def bench_providers(
+    model_path: str,
+    audio_path: str,
+    devices: Sequence[str] = None,
+    repeat: int = 10,
+    num_threads: int = 4,
+) -> List[Dict]:
+    """Latency and throughput of a model on every available provider.
+
+    The features of ``audio_path`` are computed once and every provider runs
+    the model on them, once to warm up and then ``repeat`` times.  Providers
+    are compared with the first one (cpu by default) on the maximum absolute
+    difference and the argmax agreement of their logits.
+    """
+    import soundfile as sf
+
+    from telespeechasr.onnx.frontend import MfccFrontend
+
+    if devices is None:
+        available = get_available_providers()
+        devices = [
+            name for name, (provider, _) in PROVIDERS.items() if provider in available
+        ]
+
+    # no model is loaded for the features, only the timed sessions
+    feats = MfccFrontend()(audio_path)
+    audio_s = sf.info(audio_path).duration
+
+    report, reference = [], None
+    for device in devices:
+        start = time.perf_counter()
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                session = create_session(
+                    model_path, device=device, intra_op_num_threads=num_threads
+                )
+        except Exception as e:
+            logging.warning(f"{device}: skipped, {e}")
+            continue
+        load_s = time.perf_counter() - start
+        provider = session.get_providers()[0]
+        if device != "cpu" and provider == PROVIDERS["cpu"][0]:
+            logging.warning(f"{device}: skipped, the session fell back to cpu")
+            continue
+
+        logits = session.run(None, {"feats": feats})[0]
+        if reference is None:
+            reference = logits
+        latencies = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            session.run(None, {"feats": feats})
+            latencies.append(time.perf_counter() - start)
+
+        result = {
+            "device": device,
+            "provider": provider,
+            "load_s": round(load_s, 3),
+            "latency_ms": round(float(np.median(latencies)) * 1000, 2),
+            "min_latency_ms": round(min(latencies) * 1000, 2),
+            # seconds of audio per second
+            "throughput": round(audio_s / float(np.median(latencies)), 2),
+            "max_abs_diff": float(np.abs(logits - reference).max()),
+            "argmax_agreement": float(
+                (logits.argmax(-1) == reference.argmax(-1)).mean()
+            ),
+        }
+        logging.info(
+            f"{device} ({provider}): load {result['load_s']:.2f}s, "
+            f"median {result['latency_ms']:.1f}ms (min {result['min_latency_ms']:.1f}ms), "
+            f"{result['throughput']:.1f}x realtime, "
+            f"max abs diff {result['max_abs_diff']:.2e}, "
+            f"argmax agreement {result['argmax_agreement'] * 100:.2f}%"
+        )
+        report.append(result)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="onnxruntime execution providers of the onnx models"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser(
+        "list", help="print the devices, their providers and their availability"
+    )
+    bench = subparsers.add_parser(
+        "bench-providers",
+        help="run one audio through the model on every available provider",
+    )
+    bench.add_argument("--model_path", type=str, required=True)
+    bench.add_argument("--audio_path", type=str, required=True)
+    bench.add_argument(
+        "--devices",
+        type=str,
+        nargs="+",
+        default=None,
+        help="devices to compare, all available providers by default",
+    )
+    bench.add_argument("--repeat", type=int, default=10)
+    bench.add_argument("--num_threads", type=int, default=4)
+    bench.add_argument(
+        "--output", type=str, default=None, help="json file of the results"
+    )
+    args = parser.parse_args()
+
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    if args.command == "list":
+        available = get_available_providers()
+        for device, names in DEVICES.items():
+            chain = " -> ".join(
+                PROVIDERS[name][0]
+                + ("" if PROVIDERS[name][0] in available else " (missing)")
+                for name in names
+            )
+            logging.info(f"{device}: {chain}")
+    else:
+        report = bench_providers(
+            args.model_path,
+            args.audio_path,
+            devices=args.devices,
+            repeat=args.repeat,
+            num_threads=args.num_threads,
+        )
+        if args.output is not None:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
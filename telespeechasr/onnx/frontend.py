@@ -0,0 +1,72 @@
+# -*- coding:utf-8 -*-
+# @FileName  :frontend.py
+# @Time      :2024/8/7 11:20
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+from typing import Tuple
+
+import kaldi_native_fbank as knf
+import numpy as np
+import soundfile as sf
+
+
+class MfccFrontend:
+    """Mfcc features and per-utterance CMVN of the onnx models, without a model.
+
+    Used by ``TeleSpeechAsrInferSession``, and on its own by tools that only
+    need the model inputs (calibration, provider benchmarks).
+    """
+
+    def __init__(self, eps: float = 1e-5):
+        self.eps = eps
+
+    def postprocess(self, feats):
+        m = feats.mean(axis=0, keepdims=True)
+        std = feats.std(axis=0, keepdims=True)
+        feats = (feats - m) / (std + self.eps)
+        return feats
+
+    def load_audio(self, filename: str) -> Tuple[np.ndarray, int]:
+        data, sample_rate = sf.read(
+            filename,
+            always_2d=True,
+            dtype="float32",
+        )
+        data = data[:, 0]  # use only the first channel
+        samples = np.ascontiguousarray(data)
+        return samples, sample_rate
+
+    def get_features(self, file_path: str) -> np.ndarray:
+        samples, sample_rate = self.load_audio(file_path)
+
+        if sample_rate != 16000:
+            import librosa
+
+            samples = librosa.resample(samples, orig_sr=sample_rate, target_sr=16000)
+            sample_rate = 16000
+
+        samples *= 32768
+
+        opts = knf.MfccOptions()
+        # See https://github.com/Tele-AI/TeleSpeech-ASR/blob/master/mfcc_hires.conf
+        opts.frame_opts.dither = 0
+
+        opts.num_ceps = 40
+        opts.use_energy = False
+
+        opts.mel_opts.num_bins = 40
+        opts.mel_opts.low_freq = 40
+        opts.mel_opts.high_freq = -200
+        mfcc = knf.OnlineMfcc(opts)
+        mfcc.accept_waveform(16000, samples)
+        frames = []
+        for i in range(mfcc.num_frames_ready):
+            frames.append(mfcc.get_frame(i))
+
+        frames = np.stack(frames, axis=0)
+        return frames
+
+    def __call__(self, file_path: str) -> np.ndarray:
+        """1 x T x 40 float32 model input of an audio file."""
+        feats = self.postprocess(self.get_features(file_path))
+        return feats[None, ...].astype(np.float32)
@@ -0,0 +1,351 @@
+# -*- coding:utf-8 -*-
+# @FileName  :model_registry.py
+# @Time      :2024/8/6 14:30
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import argparse
+import glob
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, List, Sequence
+
+from onnxruntime import (
+    GraphOptimizationLevel,
+    OrtAllocatorType,
+    OrtArenaCfg,
+    OrtMemoryInfo,
+    OrtMemType,
+    SessionOptions,
+    create_and_register_allocator,
+)
+
+from telespeechasr.onnx.onnx_batch_infer import TeleSpeechAsrInferSession
+from telespeechasr.onnx.utils import read_rss
+
+_env_allocator_lock = threading.Lock()
+_env_allocator_registered = False
+
+
+def register_env_allocator(arena_cfg: Dict = None):
+    """Register one cpu arena in the onnxruntime environment of the process.
+
+    The python binding has a single environment per process, sessions
+    created with ``session.use_env_allocators`` (see ``shared_session_options``)
+    all allocate from this arena instead of creating one each, so the memory
+    freed by a session is reused by the others.  Registering twice is an
+    error in onnxruntime, later calls do nothing.
+
+    Args:
+        arena_cfg: ``OrtArenaCfg`` options, e.g. ``{"arena_extend_strategy": 1}``
+            (kSameAsRequested) or ``{"max_mem": 1 << 30}``.
+    """
+    global _env_allocator_registered
+    with _env_allocator_lock:
+        if _env_allocator_registered:
+            return
+        memory_info = OrtMemoryInfo(
+            "Cpu", OrtAllocatorType.ORT_ARENA_ALLOCATOR, 0, OrtMemType.DEFAULT
+        )
+        create_and_register_allocator(
+            memory_info, OrtArenaCfg(arena_cfg or {"arena_extend_strategy": 1})
+        )
+        _env_allocator_registered = True
+
+
+def shared_session_options(intra_op_num_threads: int = 4) -> SessionOptions:
+    """``SessionOptions`` of a session allocating from the environment arena."""
+    register_env_allocator()
+    sess_options = SessionOptions()
+    sess_options.intra_op_num_threads = intra_op_num_threads
+    sess_options.graph_optimization_level = GraphOptimizationLevel.ORT_ENABLE_ALL
+    sess_options.add_session_config_entry("session.use_env_allocators", "1")
+    return sess_options
+
+
+def model_file_size(model_file) -> int:
+    """Bytes of an onnx model, its split parts and its external data files."""
+    if isinstance(model_file, list):
+        return sum(os.path.getsize(f) for f in model_file)
+
+    import onnx
+
+    graph = onnx.load(model_file, load_external_data=False).graph
+    locations = {
+        entry.value
+        for tensor in graph.initializer
+        if tensor.data_location == onnx.TensorProto.EXTERNAL
+        for entry in tensor.external_data
+        if entry.key == "location"
+    }
+    model_dir = os.path.dirname(model_file)
+    return os.path.getsize(model_file) + sum(
+        os.path.getsize(os.path.join(model_dir, location)) for location in locations
+    )
+
+
+class ModelRegistry:
+    """Several onnx models served by one process, loaded on demand.
+
+    Models are registered under an id and their session is created by the
+    first request routed to them.  At most ``max_models`` sessions stay
+    resident and their memory stays under ``memory_budget_mb``: loading a
+    model first evicts the least recently used ones.  The memory of a model
+    is the growth of the RSS while loading it, at least the size of its
+    files.
+
+    All sessions share the arena of the onnxruntime environment (see
+    ``register_env_allocator``).  A session evicted while another thread
+    runs it is freed when that run returns.  Sessions are created outside the
+    lock of the registry: requests for resident or other models are served
+    while a model loads, and concurrent requests for the model being loaded
+    wait for that one load.
+
+    Args:
+        max_models: number of resident sessions, 0 for no limit.
+        memory_budget_mb: memory of the resident sessions, 0 for no limit.
+        device: see ``execution_providers.py``. The environment arena is only
+            used by the cpu provider.
+    """
+
+    def __init__(
+        self,
+        max_models: int = 2,
+        memory_budget_mb: float = 0,
+        device: str = "cpu",
+        intra_op_num_threads: int = 4,
+    ):
+        self.max_models = max_models
+        self.memory_budget = int(memory_budget_mb * 2**20)
+        self.device = device
+        self.intra_op_num_threads = intra_op_num_threads
+        self.models = {}
+        self.file_sizes = {}
+        # model id -> (session, bytes), the most recently used last
+        self.resident = OrderedDict()
+        # model id -> (future of its session, file bytes) of the loading models
+        self.loading = {}
+        self.stats = {"hits": 0, "loads": 0, "evictions": 0, "load_s": 0.0}
+        self._lock = threading.Lock()
+
+    def register(self, model_id: str, model_file, vocab_path=None, **session_kwargs):
+        """Make ``model_file`` available under ``model_id``, without loading it.
+
+        Args:
+            session_kwargs: other arguments of ``TeleSpeechAsrInferSession``,
+                e.g. ``decoding_method`` or ``hotwords``.
+        """
+        with self._lock:
+            if model_id in self.resident:
+                self._evict(model_id)
+            self.models[model_id] = dict(
+                model_file=model_file, vocab_path=vocab_path, **session_kwargs
+            )
+            self.file_sizes[model_id] = model_file_size(model_file)
+
+    def unregister(self, model_id: str):
+        with self._lock:
+            if model_id in self.resident:
+                self._evict(model_id)
+            del self.models[model_id]
+            del self.file_sizes[model_id]
+
+    @property
+    def used_memory(self) -> int:
+        return sum(size for _, size in self.resident.values())
+
+    def _evict(self, model_id: str):
+        _, size = self.resident.pop(model_id)
+        self.stats["evictions"] += 1
+        logging.info(f"Evicted {model_id} ({size / 2 ** 20:.0f}MB)")
+
+    def _fits(self, size: int) -> bool:
+        # the models being loaded count with the size of their files
+        num_models = len(self.resident) + len(self.loading)
+        if self.max_models > 0 and num_models >= self.max_models:
+            return False
+        loading = sum(file_size for _, file_size in self.loading.values())
+        return (
+            self.memory_budget <= 0
+            or self.used_memory + loading + size <= self.memory_budget
+        )
+
+    def get(self, model_id: str) -> TeleSpeechAsrInferSession:
+        """Session of a model, loaded (and others evicted) if it is not resident."""
+        with self._lock:
+            if model_id not in self.models:
+                raise KeyError(
+                    f"Unknown model {model_id}, registered: {list(self.models)}"
+                )
+            if model_id in self.resident:
+                self.resident.move_to_end(model_id)
+                self.stats["hits"] += 1
+                return self.resident[model_id][0]
+            if model_id in self.loading:
+                # another thread is loading it
+                pending = self.loading[model_id][0]
+            else:
+                pending = None
+                kwargs = self.models[model_id]
+                file_size = self.file_sizes[model_id]
+                if self.memory_budget > 0 and file_size > self.memory_budget:
+                    logging.warning(
+                        f"{model_id} ({file_size / 2 ** 20:.0f}MB) is larger than "
+                        f"the memory budget"
+                    )
+                while self.resident and not self._fits(file_size):
+                    self._evict(next(iter(self.resident)))
+                future = Future()
+                self.loading[model_id] = (future, file_size)
+
+        if pending is not None:
+            return pending.result()
+        return self._load(model_id, kwargs, file_size, future)
+
+    def _load(self, model_id: str, kwargs: Dict, file_size: int, future: Future):
+        """Create the session of a model outside the lock, then make it resident."""
+        try:
+            start_time = time.time()
+            rss = read_rss()
+            session = TeleSpeechAsrInferSession(
+                device=self.device,
+                intra_op_num_threads=self.intra_op_num_threads,
+                sess_options=shared_session_options(self.intra_op_num_threads),
+                **kwargs,
+            )
+            # concurrent loads of other models also grow the RSS
+            size = max(read_rss() - rss, file_size)
+            load_s = time.time() - start_time
+        except BaseException as e:
+            with self._lock:
+                del self.loading[model_id]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self.loading[model_id]
+            self.stats["loads"] += 1
+            self.stats["load_s"] += load_s
+            logging.info(f"Loaded {model_id} in {load_s:.2f}s ({size / 2 ** 20:.0f}MB)")
+            # not kept when the model was registered again or unregistered meanwhile
+            if self.models.get(model_id) is kwargs:
+                self.resident[model_id] = (session, size)
+                # the measured size may be larger than the files
+                while (
+                    len(self.resident) > 1
+                    and self.memory_budget > 0
+                    and self.used_memory > self.memory_budget
+                ):
+                    self._evict(next(iter(self.resident)))
+        future.set_result(session)
+        return session
+
+    def infer(self, model_id: str, audio_path: str, hotwords=None) -> str:
+        """Recognise one audio file with the model ``model_id``."""
+        return self.get(model_id).infer(audio_path, hotwords)
+
+    def transcribe(self, model_id: str, audio_path: str, hotwords=None) -> Dict:
+        return self.get(model_id).transcribe(audio_path, hotwords)
+
+    def infer_command(self, model_id: str, audio_path: str, commands=None, nbest=1):
+        return self.get(model_id).infer_command(audio_path, commands, nbest)
+
+    def report(self) -> Dict:
+        """Resident models and their memory, and the hit/load/eviction counts."""
+        with self._lock:
+            return {
+                "resident": {
+                    model_id: round(size / 2**20, 1)
+                    for model_id, (_, size) in self.resident.items()
+                },
+                "used_mb": round(self.used_memory / 2**20, 1),
+                "rss_mb": round(read_rss() / 2**20, 1),
+                **self.stats,
+            }
+
+
+def simulate(
+    registry: ModelRegistry,
+    model_ids: Sequence[str],
+    audio_paths: List[str],
+    num_requests: int = 100,
+    skew: float = 1.0,
+    seed: int = 0,
+) -> Dict:
+    """Route random requests to the models and report the cache behaviour.
+
+    Model ``i`` (in the order of ``model_ids``) gets a request with a
+    probability proportional to ``1 / (i + 1) ** skew``, a few hot models and
+    a tail of cold ones.
+    """
+    rng = random.Random(seed)
+    weights = [1 / (i + 1) ** skew for i in range(len(model_ids))]
+    peak_rss = 0
+    start_time = time.time()
+    for _ in range(num_requests):
+        model_id = rng.choices(model_ids, weights)[0]
+        registry.infer(model_id, rng.choice(audio_paths))
+        peak_rss = max(peak_rss, read_rss())
+    report = registry.report()
+    report["requests"] = num_requests
+    report["total_s"] = round(time.time() - start_time, 2)
+    report["peak_rss_mb"] = round(peak_rss / 2**20, 1)
+    logging.info(
+        f"{num_requests} requests in {report['total_s']:.1f}s: "
+        f"{report['hits']} hits, {report['loads']} loads "
+        f"({report['load_s']:.1f}s), {report['evictions']} evictions, "
+        f"peak RSS {report['peak_rss_mb']:.0f}MB, resident {report['resident']}"
+    )
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="serve several onnx models from one process under a memory "
+        "budget, and simulate random requests routed by model id"
+    )
+    parser.add_argument(
+        "--models",
+        type=str,
+        nargs="+",
+        required=True,
+        help="model_id=/path/model.onnx, the first ones are requested the most",
+    )
+    parser.add_argument(
+        "--audio_path", type=str, required=True, help="directory of wav files"
+    )
+    parser.add_argument("--max_models", type=int, default=2)
+    parser.add_argument(
+        "--memory_budget", type=float, default=0, help="MB of the resident models"
+    )
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--num_threads", type=int, default=4)
+    parser.add_argument("--num_requests", type=int, default=100)
+    parser.add_argument("--skew", type=float, default=1.0)
+    args = parser.parse_args()
+
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    registry = ModelRegistry(
+        max_models=args.max_models,
+        memory_budget_mb=args.memory_budget,
+        device=args.device,
+        intra_op_num_threads=args.num_threads,
+    )
+    model_ids = []
+    for model in args.models:
+        model_id, model_file = model.split("=", 1)
+        registry.register(model_id, model_file)
+        model_ids.append(model_id)
+    simulate(
+        registry,
+        model_ids,
+        sorted(glob.glob(os.path.join(args.audio_path, "*.wav"))),
+        num_requests=args.num_requests,
+        skew=args.skew,
+    )
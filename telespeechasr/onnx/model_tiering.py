@@ -0,0 +1,306 @@
+# -*- coding:utf-8 -*-
+# @FileName  :model_tiering.py
+# @Time      :2024/8/7 16:05
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import argparse
+import glob
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from telespeechasr.onnx.model_registry import ModelRegistry
+
+
+class TierPolicy:
+    """Tier of the next request, from the queue depth and the p95 latency.
+
+    Tier 0 is the full quality model, higher tiers are cheaper.  The policy
+    steps one tier down when the queue holds ``max_queue_depth`` requests or
+    the p95 of the latencies of the last ``window_s`` seconds reaches
+    ``max_p95_s``, and one tier back up when both are below
+    ``recover_ratio`` of their threshold.
+    Every step waits ``cooldown_s`` after the previous one, so that the
+    latencies of the new tier are measured before moving again.
+
+    Args:
+        max_queue_depth: requests waiting or running, 0 to ignore.
+        max_p95_s: p95 latency in seconds, queueing included, 0 to ignore.
+    """
+
+    def __init__(
+        self,
+        num_tiers: int,
+        max_queue_depth: int = 8,
+        max_p95_s: float = 2.0,
+        recover_ratio: float = 0.5,
+        cooldown_s: float = 2.0,
+        window_s: float = 5.0,
+    ):
+        self.num_tiers = num_tiers
+        self.max_queue_depth = max_queue_depth
+        self.max_p95_s = max_p95_s
+        self.recover_ratio = recover_ratio
+        self.cooldown_s = cooldown_s
+        self.window_s = window_s
+        # (end time, latency) of the finished requests
+        self.latencies = deque()
+        self.tier = 0
+        self.last_change = float("-inf")
+
+    def add_latency(self, latency_s: float, now: float = None):
+        now = time.monotonic() if now is None else now
+        self.latencies.append((now, latency_s))
+
+    def p95(self, now: float = None) -> float:
+        now = time.monotonic() if now is None else now
+        while self.latencies and self.latencies[0][0] < now - self.window_s:
+            self.latencies.popleft()
+        if not self.latencies:
+            return 0.0
+        return float(np.percentile([l for _, l in self.latencies], 95))
+
+    def update(self, queue_depth: int, now: float = None) -> int:
+        """Tier for a request starting now with ``queue_depth`` requests in flight."""
+        now = time.monotonic() if now is None else now
+        if now - self.last_change < self.cooldown_s:
+            return self.tier
+
+        p95 = self.p95(now)
+        # without latencies since the last change only the queue decides
+        measured = self.max_p95_s > 0 and len(self.latencies) > 0
+        overloaded = (
+            self.max_queue_depth > 0 and queue_depth >= self.max_queue_depth
+        ) or (measured and p95 >= self.max_p95_s)
+        recovered = (
+            self.max_queue_depth <= 0
+            or queue_depth <= self.max_queue_depth * self.recover_ratio
+        ) and (
+            self.max_p95_s <= 0
+            or (measured and p95 <= self.max_p95_s * self.recover_ratio)
+        )
+
+        tier = self.tier
+        if overloaded and tier < self.num_tiers - 1:
+            tier += 1
+        elif recovered and tier > 0:
+            tier -= 1
+        if tier != self.tier:
+            logging.info(
+                f"Tier {self.tier} -> {tier} (queue depth {queue_depth}, "
+                f"p95 {p95:.2f}s)"
+            )
+            self.tier = tier
+            self.last_change = now
+            # the latencies of the previous tier do not apply any more
+            self.latencies.clear()
+        return tier
+
+
+class TieredAsrServer:
+    """Recognition served by a ladder of models of the same vocabulary.
+
+    ``tiers`` lists the models from the full quality one to the cheapest
+    (e.g. fp32, int8, 4-bit, a truncated model).  They are all kept
+    resident in a ``ModelRegistry`` so that no model is loaded under load.
+    Every request gets the tier of the ``TierPolicy`` when a worker starts
+    it, so requests queued during a spike are served by cheaper models, and
+    its result records that tier.
+
+    Args:
+        tiers: ``(name, model_file)`` pairs, the full quality model first.
+        num_workers: requests run at the same time.
+        policy_kwargs: arguments of ``TierPolicy``.
+    """
+
+    def __init__(
+        self,
+        tiers: Sequence[Tuple[str, str]],
+        vocab_path: str = None,
+        num_workers: int = 1,
+        device: str = "cpu",
+        intra_op_num_threads: int = 4,
+        **policy_kwargs,
+    ):
+        self.tier_names = [name for name, _ in tiers]
+        self.registry = ModelRegistry(
+            max_models=len(tiers),
+            device=device,
+            intra_op_num_threads=intra_op_num_threads,
+        )
+        vocab_sizes = {}
+        for name, model_file in tiers:
+            self.registry.register(name, model_file, vocab_path=vocab_path)
+            session = self.registry.get(name).session.session
+            vocab_sizes[name] = session.get_outputs()[0].shape[-1]
+        if len({v for v in vocab_sizes.values() if isinstance(v, int)}) > 1:
+            raise ValueError(f"the tiers have different vocabularies: {vocab_sizes}")
+
+        self.policy = TierPolicy(len(tiers), **policy_kwargs)
+        self.executor = ThreadPoolExecutor(num_workers)
+        self.queue_depth = 0
+        self._lock = threading.Lock()
+
+    def _run(self, audio_path: str, submit_time: float, hotwords=None) -> Dict:
+        start_time = time.monotonic()
+        with self._lock:
+            tier = self.policy.update(self.queue_depth, start_time)
+        name = self.tier_names[tier]
+        try:
+            text = self.registry.infer(name, audio_path, hotwords)
+        finally:
+            end_time = time.monotonic()
+            with self._lock:
+                self.queue_depth -= 1
+                self.policy.add_latency(end_time - submit_time, end_time)
+        return {
+            "text": text,
+            "tier": tier,
+            "model": name,
+            "queue_s": start_time - submit_time,
+            "latency_s": end_time - submit_time,
+        }
+
+    def submit(self, audio_path: str, hotwords=None) -> Future:
+        """Queue one audio file, the future gives ``text``, ``tier``,
+        ``model``, ``queue_s`` and ``latency_s`` (queueing included)."""
+        with self._lock:
+            self.queue_depth += 1
+        return self.executor.submit(self._run, audio_path, time.monotonic(), hotwords)
+
+    def infer(self, audio_path: str, hotwords=None) -> Dict:
+        return self.submit(audio_path, hotwords).result()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def simulate_load(
+    server: TieredAsrServer,
+    audio_paths: List[str],
+    rates: Sequence[float],
+    phase_s: float = 10.0,
+    seed: int = 0,
+) -> List[Dict]:
+    """Send requests at Poisson arrival ``rates`` (per second), one phase each.
+
+    Returns, for every phase, the number of requests served by every tier
+    and the p50 and p95 latencies of the requests sent during the phase.
+    """
+    rng = random.Random(seed)
+    # the phases follow each other without waiting for the queue to drain
+    futures = []
+    for rate in rates:
+        futures.append([])
+        phase_end = time.monotonic() + phase_s
+        next_time = time.monotonic()
+        while next_time < phase_end:
+            time.sleep(max(next_time - time.monotonic(), 0))
+            futures[-1].append(server.submit(rng.choice(audio_paths)))
+            next_time += rng.expovariate(rate)
+
+    phases = []
+    for rate, phase_futures in zip(rates, futures):
+        results = [f.result() for f in phase_futures]
+        latencies = [r["latency_s"] for r in results]
+        tiers = Counter(r["model"] for r in results)
+        phase = {
+            "rate": rate,
+            "requests": len(results),
+            "tiers": {name: tiers[name] for name in server.tier_names},
+            "p50_s": round(float(np.percentile(latencies, 50)), 3),
+            "p95_s": round(float(np.percentile(latencies, 95)), 3),
+        }
+        logging.info(
+            f"{rate:.1f} req/s: {phase['requests']} requests, p50 "
+            f"{phase['p50_s']:.2f}s, p95 {phase['p95_s']:.2f}s, tiers {phase['tiers']}"
+        )
+        phases.append(phase)
+    return phases
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="serve a ladder of models of the same vocabulary and move "
+        "requests to cheaper models when the queue or the latency grows"
+    )
+    parser.add_argument(
+        "--tiers",
+        type=str,
+        nargs="+",
+        required=True,
+        help="name=/path/model.onnx from the full quality model to the cheapest, "
+        "e.g. fp32=model_export.onnx int8=model_export_int8.onnx",
+    )
+    parser.add_argument(
+        "--audio_path", type=str, required=True, help="directory of wav files"
+    )
+    parser.add_argument("--vocab_path", type=str, default=None)
+    parser.add_argument("--num_workers", type=int, default=1)
+    parser.add_argument("--num_threads", type=int, default=1)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--max_queue_depth", type=int, default=8)
+    parser.add_argument(
+        "--max_p95", type=float, default=2.0, help="p95 latency threshold in seconds"
+    )
+    parser.add_argument(
+        "--recover_ratio",
+        type=float,
+        default=0.5,
+        help="go back to a better tier below this fraction of the thresholds",
+    )
+    parser.add_argument("--cooldown", type=float, default=2.0)
+    parser.add_argument(
+        "--window", type=float, default=5.0, help="seconds of latencies of the p95"
+    )
+    parser.add_argument(
+        "--rates",
+        type=float,
+        nargs="+",
+        default=[1.0, 10.0, 1.0],
+        help="requests per second of every phase of the simulation",
+    )
+    parser.add_argument("--phase_s", type=float, default=10.0)
+    parser.add_argument(
+        "--output", type=str, default=None, help="json file of the results"
+    )
+    args = parser.parse_args()
+
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    with TieredAsrServer(
+        [tuple(tier.split("=", 1)) for tier in args.tiers],
+        vocab_path=args.vocab_path,
+        num_workers=args.num_workers,
+        device=args.device,
+        intra_op_num_threads=args.num_threads,
+        max_queue_depth=args.max_queue_depth,
+        max_p95_s=args.max_p95,
+        recover_ratio=args.recover_ratio,
+        cooldown_s=args.cooldown,
+        window_s=args.window,
+    ) as server:
+        phases = simulate_load(
+            server,
+            sorted(glob.glob(os.path.join(args.audio_path, "*.wav"))),
+            args.rates,
+            phase_s=args.phase_s,
+        )
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(phases, f, ensure_ascii=False, indent=2)
@@ -12,30 +12,35 @@ from tqdm import tqdm
 import time
 import warnings
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, List
 
-import kaldi_native_fbank as knf
 import numpy as np
-import soundfile as sf
-from onnxruntime import (
-    GraphOptimizationLevel,
-    InferenceSession,
-    SessionOptions,
-    get_available_providers,
-    get_device,
+
+from telespeechasr.decoding.command_scorer import CommandScorer, build_command_scorer
+from telespeechasr.decoding.context_graph import ContextGraph, build_context_graph
+from telespeechasr.decoding.ctc_prefix_beam_search import (
+    ctc_prefix_beam_search,
+    log_softmax,
+)
+from telespeechasr.decoding.emission_archive import EmissionArchiveWriter
+from telespeechasr.decoding.output import format_result
+from telespeechasr.decoding.timestamps import (
+    ctc_greedy_search,
+    get_frame_shift,
+    to_json_result,
 )
+from telespeechasr.onnx.execution_providers import DEVICES, create_session
+from telespeechasr.onnx.frontend import MfccFrontend
 
 class OrtInferRuntimeSession:
-    def __init__(self, model_file, device='cpu', device_id=-1, intra_op_num_threads=4):
-        if device == 'cpu':
-            EP_list = ['CPUExecutionProvider']
-        elif device == 'cuda':
-            EP_list = ['CUDAExecutionProvider']
-        elif device == 'tensorrt':
-            EP_list = ['TensorrtExecutionProvider']
-        else:
-            raise ValueError('Unsupported device: ', device)
-
+    def __init__(
+        self,
+        model_file,
+        device='cpu',
+        device_id=-1,
+        intra_op_num_threads=4,
+        sess_options=None,
+    ):
         if isinstance(model_file, list):
             merged_model_file = b""
             for file in sorted(model_file):
@@ -45,23 +50,18 @@ class OrtInferRuntimeSession:
             model_file = merged_model_file
         else:
             self._verify_model(model_file)
-        self.session = InferenceSession(
-            #model_file, sess_options=sess_opt, providers=EP_list
-            model_file, providers=EP_list
+        # falls back along the providers of the device, see execution_providers.py
+        self.session = create_session(
+            model_file,
+            device=device,
+            device_id=device_id,
+            intra_op_num_threads=intra_op_num_threads,
+            sess_options=sess_options,
         )
 
         # delete binary of model file to save memory
         del model_file
 
-        #if device_id != "-1" and cuda_ep not in self.session.get_providers():
-            #warnings.warn(
-                #f"{cuda_ep} is not avaiable for current env, the inference part is automatically shifted to be executed under {cpu_ep}.\n"
-                #"Please ensure the installed onnxruntime-gpu version matches your cuda and cudnn version, "
-                #"you can check their relations from the offical web site: "
-                #"https://onnxruntime.ai/docs/execution-providers/CUDA-ExecutionProvider.html",
-                #RuntimeWarning,
-            #)
-
     def __call__(self, input_content: np.ndarray) -> np.ndarray:
         input_dict = dict(zip(self.get_input_names(), input_content[None, ...]))
         try:
@@ -98,9 +98,21 @@ class OrtInferRuntimeSession:
             raise FileExistsError(f"{model_path} is not a file.")
 
 
-class TeleSpeechAsrInferSession:
+class TeleSpeechAsrInferSession(MfccFrontend):
     def __init__(
-        self, model_file, vocab_path=None, device='cpu', device_id=-1, intra_op_num_threads=4
+        self,
+        model_file,
+        vocab_path=None,
+        device='cpu',
+        device_id=-1,
+        intra_op_num_threads=4,
+        decoding_method="greedy_search",
+        beam_size=10,
+        hotwords=None,
+        hotwords_score=1.5,
+        commands=None,
+        command_threshold=0.0,
+        sess_options=None,
     ):
         self.vocab_path = vocab_path or os.path.join(
             os.path.dirname(__file__), "data", "vocab.json"
@@ -114,19 +126,46 @@ class TeleSpeechAsrInferSession:
 
         logging.info(f"Loading model from {model_file}")
         self.session = OrtInferRuntimeSession(
-            model_file, device=device, device_id=device_id, intra_op_num_threads=intra_op_num_threads
+            model_file,
+            device=device,
+            device_id=device_id,
+            intra_op_num_threads=intra_op_num_threads,
+            sess_options=sess_options,
         )
 
-        self.eps = 1e-5
+        super().__init__()
 
         self.blank_weight = 0.0
         self.blank_mode = "add"
+        self.frame_shift = get_frame_shift()
+
+        assert decoding_method in ("greedy_search", "prefix_beam_search")
+        self.decoding_method = decoding_method
+        self.beam_size = beam_size
+        self.hotwords_score = hotwords_score
+        self.context_graph = None
+        if hotwords is not None:
+            self.set_hotwords(hotwords)
+        self.command_threshold = command_threshold
+        self.command_scorer = None
+        if commands is not None:
+            self.set_commands(commands)
+
+    def build_context_graph(self, hotwords) -> ContextGraph:
+        """Compile hotwords (dict, list of lines or file path) into a graph."""
+        return build_context_graph(hotwords, self.vocab2id, self.hotwords_score)
+
+    def set_hotwords(self, hotwords):
+        """Replace the default hotwords used when ``infer`` gets none."""
+        self.context_graph = (
+            self.build_context_graph(hotwords) if hotwords is not None else None
+        )
 
-    def postprocess(self, feats):
-        m = feats.mean(axis=0, keepdims=True)
-        std = feats.std(axis=0, keepdims=True)
-        feats = (feats - m) / (std + self.eps)
-        return feats
+    def set_commands(self, commands):
+        """Set the command list (list or txt/xlsx path) used by ``infer_command``."""
+        self.command_scorer = build_command_scorer(
+            commands, self.vocab2id, self.command_threshold
+        )
 
     def get_logits(self, logits):
         if self.blank_weight != 0:
@@ -143,11 +182,19 @@ class TeleSpeechAsrInferSession:
         self,
         emissions: np.ndarray,
     ) -> List[List[Dict[str, np.ndarray]]]:
-        def get_pred(e):
-            toks = e.argmax(-1)
-            return toks[toks != 0]
+        return [[ctc_greedy_search(x, self.frame_shift)] for x in emissions]
 
-        return [[{"tokens": get_pred(x), "score": 0}] for x in emissions]
+    def prefix_beam_search(
+        self,
+        emissions: np.ndarray,
+        context_graph: ContextGraph = None,
+    ) -> List[List[Dict[str, np.ndarray]]]:
+        return [
+            ctc_prefix_beam_search(
+                log_softmax(x), self.beam_size, context_graph=context_graph
+            )
+            for x in emissions
+        ]
 
     def postprocess_sentence(self, tokens):
         text = ""
@@ -157,61 +204,91 @@ class TeleSpeechAsrInferSession:
                 text += token
         return text
 
-    def load_audio(self, filename: str) -> Tuple[np.ndarray, int]:
-        data, sample_rate = sf.read(
-            filename,
-            always_2d=True,
-            dtype="float32",
-        )
-        data = data[:, 0]  # use only the first channel
-        samples = np.ascontiguousarray(data)
-        return samples, sample_rate
-
-    def get_features(self, file_path: str) -> np.ndarray:
-        samples, sample_rate = self.load_audio(file_path)
-
-        if sample_rate != 16000:
-            import librosa
-
-            samples = librosa.resample(samples, orig_sr=sample_rate, target_sr=16000)
-            sample_rate = 16000
-
-        samples *= 32768
+    def forward(self, audio_path) -> np.ndarray:
+        """Run the frontend and the model, return B x T x V raw emissions.
 
-        opts = knf.MfccOptions()
-        # See https://github.com/Tele-AI/TeleSpeech-ASR/blob/master/mfcc_hires.conf
-        opts.frame_opts.dither = 0
-
-        opts.num_ceps = 40
-        opts.use_energy = False
-
-        opts.mel_opts.num_bins = 40
-        opts.mel_opts.low_freq = 40
-        opts.mel_opts.high_freq = -200
-        mfcc = knf.OnlineMfcc(opts)
-        mfcc.accept_waveform(16000, samples)
-        frames = []
-        for i in range(mfcc.num_frames_ready):
-            frames.append(mfcc.get_frame(i))
-
-        frames = np.stack(frames, axis=0)
-        return frames
-
-    def infer(self, audio_path):
+        The blank weight is applied later by ``decode``, so the output can be
+        stored and decoded again with other settings.
+        """
         feats = self.get_features(audio_path)
         feats = self.postprocess(feats)[None, ...]
 
+        model_output = self.session(feats)
+        return model_output[0].transpose((1, 0, 2))
+
+    def decode(self, emissions, hotwords=None) -> List[List[Dict[str, np.ndarray]]]:
+        """Decode B x T x V emissions with the configured decoding method.
+
+        Args:
+            emissions: B x T x V emissions returned by ``forward``.
+            hotwords: hotwords for this call only, either a compiled
+                ``ContextGraph`` or anything ``build_context_graph`` accepts.
+                Defaults to the hotwords set on the session.
+        """
+        if hotwords is None:
+            context_graph = self.context_graph
+        elif isinstance(hotwords, ContextGraph):
+            context_graph = hotwords
+        else:
+            context_graph = self.build_context_graph(hotwords)
+
+        emissions = self.get_logits(emissions)
+        if self.decoding_method == "prefix_beam_search" or context_graph is not None:
+            return self.prefix_beam_search(emissions, context_graph)
+        return self.viterbi_decode(emissions)
+
+    def infer(self, audio_path, hotwords=None):
+        """Recognise one audio file, see ``decode`` for ``hotwords``."""
         #logging.info("Decoding ...")
         start_time = time.time()
-        model_output = self.session(feats)
-        emissions = self.get_logits(model_output)
-        emissions = emissions[0].transpose((1, 0, 2))
-        hypos = self.viterbi_decode(emissions)
+        emissions = self.forward(audio_path)
+        hypos = self.decode(emissions, hotwords)
         result = self.postprocess_sentence(hypos[0][0]["tokens"])
         #logging.info(f"Inference time: {time.time() - start_time:.4}s")
 
         return result
 
+    def transcribe(self, audio_path, hotwords=None) -> Dict:
+        """Recognise one audio file and return text, confidence and, for
+        greedy search, the start/end time and confidence of every token."""
+        emissions = self.forward(audio_path)
+        hypos = self.decode(emissions, hotwords)
+        return to_json_result(hypos[0][0], self.id2vocab)
+
+    def infer_command(self, audio_path, commands=None, nbest=1):
+        """Recognise one audio file against a closed command set.
+
+        Args:
+            audio_path: path of the audio file.
+            commands: a ``CommandScorer`` or a command list/path for this call
+                only. Defaults to the commands set on the session.
+            nbest: number of candidates returned.
+
+        Returns:
+            A list of ``CommandScorer.score`` results, ``command`` of the
+            first one is None when the audio is rejected as out-of-grammar.
+        """
+        if commands is None:
+            command_scorer = self.command_scorer
+        elif isinstance(commands, CommandScorer):
+            command_scorer = commands
+        else:
+            command_scorer = build_command_scorer(
+                commands, self.vocab2id, self.command_threshold
+            )
+        assert command_scorer is not None, "no command list is set"
+
+        emissions = self.get_logits(self.forward(audio_path))
+        return command_scorer.score(emissions[0], nbest=nbest)
+
+
+def recognize(model, audio_file, command_mode=False, output_format='txt', emission_writer=None):
+    """Recognise one audio file, optionally saving its emissions to an archive."""
+    emissions = model.forward(audio_file)
+    if emission_writer is not None:
+        audio_file_basename = os.path.splitext(os.path.split(audio_file)[-1])[0]
+        emission_writer.add(audio_file_basename, emissions[0])
+    return format_result(model, emissions, command_mode, output_format)
 
 if __name__ == "__main__":
     args = argparse.ArgumentParser()
@@ -220,13 +297,73 @@ if __name__ == "__main__":
     args.add_argument("--vocab_path", type=str, default=None)
     args.add_argument('--output_path', type=str, required=False, default=None)
     args.add_argument(
-        "--device", type=str, default="cpu", choices=["cpu", "cuda", "tensorrt"]
+        "--device",
+        type=str,
+        default="cpu",
+        help=f"one of {list(DEVICES)}, or a comma separated list of execution "
+        "providers tried in order, e.g. openvino,dnnl. Unavailable providers "
+        "fall back to the next one and finally to cpu",
+    )
+    args.add_argument(
+        "--decoding_method",
+        type=str,
+        default="greedy_search",
+        choices=["greedy_search", "prefix_beam_search"],
+    )
+    args.add_argument("--beam_size", type=int, default=10)
+    args.add_argument(
+        "--hotwords",
+        type=str,
+        default=None,
+        help="hotwords file, one hotword per line, optionally followed by "
+        "':score' as its per-token boost. Implies prefix_beam_search",
+    )
+    args.add_argument("--hotwords_score", type=float, default=1.5)
+    args.add_argument(
+        "--commands",
+        type=str,
+        default=None,
+        help="command list (txt, one per line, or xlsx annotation sheet). "
+        "When given, every audio is scored against the commands instead of "
+        "being decoded freely",
+    )
+    args.add_argument(
+        "--command_threshold",
+        type=float,
+        default=0.0,
+        help="reject the best command when its confidence is below this value",
+    )
+    args.add_argument(
+        "--output_format",
+        type=str,
+        default="txt",
+        choices=["txt", "json", "srt"],
+        help="txt: text only, json: text with per-token timestamps and "
+        "confidences, srt: subtitles. Timestamps need greedy_search",
+    )
+    args.add_argument(
+        "--save_emissions",
+        type=str,
+        default=None,
+        help="directory to save a compact emission archive, which "
+        "telespeechasr/decoding/redecode.py can decode again with other "
+        "decoding settings without rerunning the model",
+    )
+    args.add_argument(
+        "--emission_top_k",
+        type=int,
+        default=16,
+        help="number of log posteriors kept per frame in the emission archive",
     )
 
     formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
     logging.basicConfig(format=formatter, level=logging.INFO)
 
     args = args.parse_args()
+    assert (
+        args.output_format != "srt"
+        or (args.decoding_method == "greedy_search" and args.hotwords is None)
+    ), 'srt output needs the timestamps of greedy_search'
 
     # get audio file list or single audio file
     if os.path.isfile(args.audio_path):
@@ -234,18 +371,35 @@ if __name__ == "__main__":
     else:
         audio_list = glob.glob(os.path.join(args.audio_path, '*.wav'))
 
-    model = TeleSpeechAsrInferSession(args.model_path, args.vocab_path, args.device)
+    model = TeleSpeechAsrInferSession(
+        args.model_path,
+        args.vocab_path,
+        args.device,
+        decoding_method=args.decoding_method,
+        beam_size=args.beam_size,
+        hotwords=args.hotwords,
+        hotwords_score=args.hotwords_score,
+        commands=args.commands,
+        command_threshold=args.command_threshold,
+    )
+    emission_writer = None
+    if args.save_emissions is not None:
+        emission_writer = EmissionArchiveWriter(
+            args.save_emissions, top_k=args.emission_top_k, frame_shift=model.frame_shift
+        )
 
     if len(audio_list) == 1:
         audio_file = audio_list[0]
-        asr_result = model.infer(audio_file)
+        asr_result, ext = recognize(
+            model, audio_file, args.commands is not None, args.output_format, emission_writer
+        )
         if args.output_path is None:
             logging.info(asr_result)
         else:
             os.makedirs(args.output_path, exist_ok=True)
             audio_file_basename = os.path.splitext(os.path.split(audio_file)[-1])[0]
-            output_file_name = os.path.join(args.output_path, audio_file_basename+'.txt')
-            output_file = open(output_file_name, 'w')
+            output_file_name = os.path.join(args.output_path, audio_file_basename+'.'+ext)
+            output_file = open(output_file_name, 'w', encoding='utf-8')
             output_file.write(asr_result)
             output_file.write('\n')
             output_file.close()
@@ -254,15 +408,19 @@ if __name__ == "__main__":
 
         pbar = tqdm(total=len(audio_list), desc='Telespeech-ASR ONNX inference')
         for audio_file in audio_list:
-            asr_result = model.infer(audio_file)
+            asr_result, ext = recognize(
+                model, audio_file, args.commands is not None, args.output_format, emission_writer
+            )
 
             os.makedirs(args.output_path, exist_ok=True)
             audio_file_basename = os.path.splitext(os.path.split(audio_file)[-1])[0]
-            output_file_name = os.path.join(args.output_path, audio_file_basename+'.txt')
-            output_file = open(output_file_name, 'w')
+            output_file_name = os.path.join(args.output_path, audio_file_basename+'.'+ext)
+            output_file = open(output_file_name, 'w', encoding='utf-8')
             output_file.write(asr_result)
             output_file.write('\n')
             output_file.close()
             pbar.update(1)
         pbar.close()
+    if emission_writer is not None:
+        emission_writer.close()
     print('\nInference done, ASR result has been saved to %s' % args.output_path)
@@ -0,0 +1,157 @@
+# -*- coding:utf-8 -*-
+# @FileName  :onnx_benchmark.py
+# @Time      :2024/7/25 15:40
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import time
+from typing import Dict, List
+
+import soundfile as sf
+
+from telespeechasr.decoding.metrics import compute_cer, load_references
+
+
+def run_model(
+    model_path: str,
+    audio_paths: List[str],
+    device: str = "cpu",
+    num_threads: int = 4,
+) -> Dict:
+    """Decode all audio files with one onnx model, in a fresh process.
+
+    Returns the hypotheses keyed by audio basename, the model load time, the
+    decoding time (after one warm-up utterance) and the peak RSS of the process.
+    """
+    from telespeechasr.onnx.onnx_batch_infer import TeleSpeechAsrInferSession
+
+    start_time = time.time()
+    session = TeleSpeechAsrInferSession(
+        model_path, device=device, intra_op_num_threads=num_threads
+    )
+    load_s = time.time() - start_time
+
+    session.infer(audio_paths[0])
+
+    hypotheses = {}
+    start_time = time.time()
+    for audio_path in audio_paths:
+        key = os.path.splitext(os.path.basename(audio_path))[0]
+        hypotheses[key] = session.infer(audio_path)
+    decode_s = time.time() - start_time
+
+    return {
+        "model": model_path,
+        "hypotheses": hypotheses,
+        "load_s": load_s,
+        "decode_s": decode_s,
+        # kilobytes on linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "size_mb": os.path.getsize(model_path) / 2**20,
+    }
+
+
+def benchmark(
+    model_paths: List[str],
+    audio_paths: List[str],
+    references: Dict[str, str],
+    device: str = "cpu",
+    num_threads: int = 4,
+) -> List[Dict]:
+    """Compare onnx models (fp32, int8, ...) on speed, memory and CER.
+
+    Every model runs in its own process so that the peak RSS is its own.
+    The first model is the baseline of ``cer_delta`` and of
+    ``diff_to_baseline``, the CER of the hypotheses against the baseline ones.
+    """
+    audio_s = sum(sf.info(path).duration for path in audio_paths)
+
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for model_path in model_paths:
+        logging.info(f"Running {model_path}")
+        with context.Pool(1) as pool:
+            result = pool.apply(
+                run_model, (model_path, audio_paths, device, num_threads)
+            )
+        result["rtf"] = result["decode_s"] / audio_s
+        result.update(compute_cer(references, result["hypotheses"]))
+        results.append(result)
+
+    baseline = results[0]
+    for result in results:
+        result["cer_delta"] = result["cer"] - baseline["cer"]
+        result["diff_to_baseline"] = compute_cer(
+            baseline["hypotheses"], result["hypotheses"]
+        )["cer"]
+        logging.info(
+            f"{os.path.basename(result['model'])}: {result['size_mb']:.0f}MB, "
+            f"load {result['load_s']:.2f}s, RTF {result['rtf']:.4f}, "
+            f"peak RSS {result['peak_rss_mb']:.0f}MB, "
+            f"CER {result['cer'] * 100:.2f}% ({result['cer_delta'] * 100:+.2f}), "
+            f"differs from the baseline by {result['diff_to_baseline'] * 100:.2f}%"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(
+        description="compare speed, peak memory and CER of exported onnx models "
+        "(e.g. fp32 and its quantised versions) on a reference set"
+    )
+    args.add_argument(
+        "--model_path",
+        type=str,
+        nargs="+",
+        required=True,
+        help="onnx models to compare, the first one is the baseline",
+    )
+    args.add_argument(
+        "--audio_path", type=str, required=True, help="directory of wav files"
+    )
+    args.add_argument(
+        "--annotation_path",
+        type=str,
+        required=True,
+        help="directory of txt annotations named after the audio files, or a "
+        "kaldi style text file",
+    )
+    args.add_argument(
+        "--device",
+        type=str,
+        default="cpu",
+        help="device or comma separated execution providers, see "
+        "execution_providers.py",
+    )
+    args.add_argument("--num_threads", type=int, default=4)
+    args.add_argument("--max_utts", type=int, default=0)
+    args.add_argument(
+        "--output", type=str, default=None, help="json file of the results"
+    )
+
+    args = args.parse_args()
+
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    audio_paths = sorted(glob.glob(os.path.join(args.audio_path, "*.wav")))
+    if args.max_utts > 0:
+        audio_paths = audio_paths[: args.max_utts]
+    references = load_references(args.annotation_path)
+
+    results = benchmark(
+        args.model_path,
+        audio_paths,
+        references,
+        device=args.device,
+        num_threads=args.num_threads,
+    )
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,378 @@
+# -*- coding:utf-8 -*-
+# @FileName  :onnx_buckets.py
+# @Time      :2024/7/29 10:15
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import argparse
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import onnx
+from onnx import numpy_helper
+from onnxruntime import InferenceSession, OrtValue, SessionOptions
+
+from telespeechasr.onnx.utils import read_rss
+
+MANIFEST_FILE = "buckets.json"
+WEIGHTS_FILE = "weights.bin"
+
+# input mfcc frames (10ms) and batch sizes of the exported models
+DEFAULT_FRAMES = (256, 512, 1024, 2048)
+DEFAULT_BATCH_SIZES = (1, 4, 8)
+
+
+def share_initializers(model_paths: List[str], output_dir: str) -> Dict:
+    """Move the initializers of several models into one external weights file.
+
+    Identical tensors (the weights, repeated in every bucket model) are
+    written once under one name, so that the runtime can hand one copy to all
+    sessions.  The models are rewritten in
+    ``output_dir`` next to ``WEIGHTS_FILE``.
+
+    Returns:
+        name -> offset, length, dtype and shape of every tensor in the file.
+    """
+    index = {}
+    name_of_digest = {}
+    offset = 0
+    with open(os.path.join(output_dir, WEIGHTS_FILE), "wb") as weights_file:
+        for model_path in model_paths:
+            model = onnx.load(model_path)
+            renamed = {}
+            for tensor in model.graph.initializer:
+                array = numpy_helper.to_array(tensor)
+                data = np.ascontiguousarray(array).tobytes()
+                digest = hashlib.sha1(
+                    data + str((array.dtype, array.shape)).encode()
+                ).hexdigest()
+                if digest not in name_of_digest:
+                    # constants of different shapes may share a name across models
+                    name = tensor.name
+                    while name in index:
+                        name += "_"
+                    name_of_digest[digest] = name
+                    # aligned for the memory mapping of the runtime
+                    offset = -(-offset // 64) * 64
+                    weights_file.seek(offset)
+                    weights_file.write(data)
+                    index[name] = {
+                        "offset": offset,
+                        "length": len(data),
+                        "dtype": str(array.dtype),
+                        "shape": list(array.shape),
+                    }
+                    offset += len(data)
+                name = name_of_digest[digest]
+                if name != tensor.name:
+                    renamed[tensor.name] = name
+                entry = index[name]
+                tensor.name = name
+                tensor.ClearField("raw_data")
+                for field in ("float_data", "int32_data", "int64_data", "double_data"):
+                    tensor.ClearField(field)
+                tensor.data_location = onnx.TensorProto.EXTERNAL
+                del tensor.external_data[:]
+                for key, value in (
+                    ("location", WEIGHTS_FILE),
+                    ("offset", str(entry["offset"])),
+                    ("length", str(entry["length"])),
+                ):
+                    tensor.external_data.add(key=key, value=value)
+            for node in model.graph.node:
+                for i, name in enumerate(node.input):
+                    if name in renamed:
+                        node.input[i] = renamed[name]
+            onnx.save(model, os.path.join(output_dir, os.path.basename(model_path)))
+    return index
+
+
+def export_buckets(
+    model,
+    output_dir: str,
+    frames: Sequence[int] = DEFAULT_FRAMES,
+    batch_sizes: Sequence[int] = DEFAULT_BATCH_SIZES,
+    feature_dim: int = 40,
+    opset_version: int = 11,
+):
+    """Export one static shape model per (batch size, frames) bucket.
+
+    Every model takes B x T x C padded features and the B lengths, and
+    returns B x T' x V logits and the B output lengths, so that the padding of
+    the bucket does not change the results.  The weights are stored once,
+    see ``share_initializers``, and ``MANIFEST_FILE`` lists the buckets.
+    """
+    import torch
+
+    os.makedirs(output_dir, exist_ok=True)
+    model = model.eval()
+    buckets = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_paths = []
+        for batch_size in sorted(batch_sizes):
+            for num_frames in sorted(frames):
+                path = os.path.join(tmp_dir, f"model_b{batch_size}_t{num_frames}.onnx")
+                torch.onnx.export(
+                    model,
+                    (
+                        torch.randn(batch_size, num_frames, feature_dim),
+                        torch.full((batch_size,), num_frames, dtype=torch.long),
+                    ),
+                    path,
+                    verbose=False,
+                    opset_version=opset_version,
+                    input_names=["feats", "lengths"],
+                    output_names=["logits", "out_lengths"],
+                )
+                model_paths.append(path)
+                buckets.append(
+                    {
+                        "batch_size": batch_size,
+                        "frames": num_frames,
+                        "model": os.path.basename(path),
+                    }
+                )
+                logging.info(f"Exported bucket {batch_size} x {num_frames}")
+        index = share_initializers(model_paths, output_dir)
+
+    with open(os.path.join(output_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "feature_dim": feature_dim,
+                "weights": WEIGHTS_FILE,
+                "initializers": index,
+                "buckets": buckets,
+            },
+            f,
+            indent=1,
+        )
+
+
+class BucketedOrtSession:
+    """Runtime of the models written by ``export_buckets``.
+
+    All bucket sessions are created up front and use the same weights, mapped
+    once from the weights file (tensors of at least ``min_shared_bytes``).
+    Every batch goes to the smallest bucket that fits it, batches larger than
+    the largest batch size are split and utterances longer than the largest
+    bucket go to ``fallback``, a session of the dynamic model of
+    onnx_export.py.
+
+    onnxruntime prepacks the MatMul weights into a copy of its own in every
+    session, ``disable_prepacking`` turns it off so that the weights really
+    are shared, at the cost of slower MatMuls.  ``rss_bytes`` is the memory
+    taken by loading the buckets.
+    """
+
+    def __init__(
+        self,
+        model_dir: str,
+        intra_op_num_threads: int = 4,
+        fallback: Optional[InferenceSession] = None,
+        min_shared_bytes: int = 1 << 16,
+        disable_prepacking: bool = True,
+    ):
+        rss = read_rss()
+        with open(os.path.join(model_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        self.feature_dim = manifest["feature_dim"]
+        self.fallback = fallback
+
+        weights = np.memmap(
+            os.path.join(model_dir, manifest["weights"]), dtype=np.uint8, mode="r"
+        )
+        # kept alive as long as the sessions. Small tensors (norms, biases) are
+        # loaded by every session: the graph optimisations of onnxruntime fail
+        # on some of them when they are shared, and they weigh nothing
+        self.initializers = {}
+        for name, entry in manifest["initializers"].items():
+            if entry["length"] < min_shared_bytes:
+                continue
+            array = weights[entry["offset"] : entry["offset"] + entry["length"]]
+            array = array.view(entry["dtype"]).reshape(entry["shape"])
+            self.initializers[name] = OrtValue.ortvalue_from_numpy(array)
+
+        self.buckets = sorted(
+            manifest["buckets"], key=lambda b: (b["frames"], b["batch_size"])
+        )
+        self.sessions = {}
+        for bucket in self.buckets:
+            model_path = os.path.join(model_dir, bucket["model"])
+            sess_opt = SessionOptions()
+            sess_opt.intra_op_num_threads = intra_op_num_threads
+            if disable_prepacking:
+                sess_opt.add_session_config_entry("session.disable_prepacking", "1")
+            graph = onnx.load(model_path, load_external_data=False).graph
+            for tensor in graph.initializer:
+                if tensor.name in self.initializers:
+                    sess_opt.add_initializer(
+                        tensor.name, self.initializers[tensor.name]
+                    )
+            self.sessions[bucket["batch_size"], bucket["frames"]] = InferenceSession(
+                model_path,
+                sess_options=sess_opt,
+                providers=["CPUExecutionProvider"],
+            )
+        self.max_batch_size = max(b["batch_size"] for b in self.buckets)
+        self.max_frames = max(b["frames"] for b in self.buckets)
+        self.rss_bytes = read_rss() - rss
+
+    def route(self, batch_size: int, num_frames: int) -> Optional[Dict]:
+        """Smallest bucket holding ``batch_size`` utterances of ``num_frames``."""
+        fits = [
+            b
+            for b in self.buckets
+            if b["batch_size"] >= batch_size and b["frames"] >= num_frames
+        ]
+        return min(fits, key=lambda b: b["batch_size"] * b["frames"], default=None)
+
+    def run_bucket(self, feats: List[np.ndarray]) -> List[np.ndarray]:
+        bucket = self.route(len(feats), max(f.shape[0] for f in feats))
+        batch = np.zeros(
+            (bucket["batch_size"], bucket["frames"], self.feature_dim),
+            dtype=np.float32,
+        )
+        # the rows filling the bucket are full length zeros
+        lengths = np.full((bucket["batch_size"],), bucket["frames"], dtype=np.int64)
+        for i, f in enumerate(feats):
+            batch[i, : f.shape[0]] = f
+            lengths[i] = f.shape[0]
+        session = self.sessions[bucket["batch_size"], bucket["frames"]]
+        logits, out_lengths = session.run(None, {"feats": batch, "lengths": lengths})
+        return [logits[i, : out_lengths[i]] for i in range(len(feats))]
+
+    def __call__(self, feats: List[np.ndarray]) -> List[np.ndarray]:
+        """T x C normalised features of every utterance -> T' x V logits."""
+        emissions = [None] * len(feats)
+        short = [i for i, f in enumerate(feats) if f.shape[0] <= self.max_frames]
+        for i, f in enumerate(feats):
+            if f.shape[0] > self.max_frames:
+                assert self.fallback is not None, (
+                    f"{f.shape[0]} frames is longer than the largest bucket "
+                    f"({self.max_frames}) and there is no fallback model"
+                )
+                # T' x 1 x V
+                emissions[i] = self.fallback.run(None, {"feats": f[None]})[0][:, 0]
+
+        # similar lengths together, so that batches have little padding
+        short.sort(key=lambda i: feats[i].shape[0])
+        for start in range(0, len(short), self.max_batch_size):
+            batch = short[start : start + self.max_batch_size]
+            for i, e in zip(batch, self.run_bucket([feats[i] for i in batch])):
+                emissions[i] = e
+        return emissions
+
+
+def compare_throughput(
+    bucketed: BucketedOrtSession,
+    dynamic: InferenceSession,
+    num_utts: int = 32,
+    min_frames: int = 100,
+    max_frames: Optional[int] = None,
+    seed: int = 0,
+) -> Dict:
+    """Utterances per second of the bucketed models and of the dynamic model.
+
+    The dynamic model of onnx_export.py runs one utterance at a time, the
+    bucketed models run batches.  Both decode the same random features.  The
+    report also has the memory taken by the buckets once loaded, and once
+    every bucket ran (the mapped weights are only read by the first run).
+    """
+    rng = np.random.default_rng(seed)
+    max_frames = max_frames or bucketed.max_frames
+    feats = [
+        rng.standard_normal((int(t), bucketed.feature_dim)).astype(np.float32)
+        for t in rng.integers(min_frames, max_frames + 1, num_utts)
+    ]
+    # warm up every session once
+    rss = read_rss()
+    for bucket in bucketed.buckets:
+        bucketed.run_bucket(
+            [np.zeros((bucket["frames"], bucketed.feature_dim), dtype=np.float32)]
+            * bucket["batch_size"]
+        )
+    warm_rss = bucketed.rss_bytes + read_rss() - rss
+    dynamic.run(None, {"feats": feats[0][None]})
+
+    start = time.perf_counter()
+    bucketed_emissions = bucketed(feats)
+    bucketed_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    dynamic_emissions = [dynamic.run(None, {"feats": f[None]})[0][:, 0] for f in feats]
+    dynamic_s = time.perf_counter() - start
+
+    report = {
+        "num_utts": num_utts,
+        "frames": int(sum(f.shape[0] for f in feats)),
+        "bucketed_utts_per_s": num_utts / bucketed_s,
+        "dynamic_utts_per_s": num_utts / dynamic_s,
+        "speedup": dynamic_s / bucketed_s,
+        "buckets_load_rss_mb": round(bucketed.rss_bytes / 2**20, 1),
+        "buckets_rss_mb": round(warm_rss / 2**20, 1),
+        "max_abs_diff": max(
+            float(np.abs(b - d).max())
+            for b, d in zip(bucketed_emissions, dynamic_emissions)
+        ),
+    }
+    logging.info(
+        f"bucketed {report['bucketed_utts_per_s']:.2f} utt/s, dynamic "
+        f"{report['dynamic_utts_per_s']:.2f} utt/s ({report['speedup']:.2f}x), "
+        f"max abs diff {report['max_abs_diff']:.2e}, "
+        f"{len(bucketed.buckets)} buckets {report['buckets_load_rss_mb']:.0f}MB "
+        f"loaded, {report['buckets_rss_mb']:.0f}MB after a run"
+    )
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="compare the throughput of the bucketed models written by "
+        "onnx_export.py --buckets with the dynamic model"
+    )
+    parser.add_argument(
+        "--model_dir", type=str, required=True, help="directory of the buckets"
+    )
+    parser.add_argument(
+        "--dynamic_model_path", type=str, required=True, help="model_export.onnx"
+    )
+    parser.add_argument("--num_utts", type=int, default=32)
+    parser.add_argument("--min_frames", type=int, default=100)
+    parser.add_argument("--max_frames", type=int, default=None)
+    parser.add_argument("--num_threads", type=int, default=4)
+    parser.add_argument(
+        "--prepacking",
+        action="store_true",
+        help="let onnxruntime prepack the weights of every bucket, faster "
+        "MatMuls but one copy of the weights per bucket",
+    )
+    args = parser.parse_args()
+
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    sess_opt = SessionOptions()
+    sess_opt.intra_op_num_threads = args.num_threads
+    dynamic = InferenceSession(
+        args.dynamic_model_path,
+        sess_options=sess_opt,
+        providers=["CPUExecutionProvider"],
+    )
+    bucketed = BucketedOrtSession(
+        args.model_dir,
+        intra_op_num_threads=args.num_threads,
+        fallback=dynamic,
+        disable_prepacking=not args.prepacking,
+    )
+    compare_throughput(
+        bucketed,
+        dynamic,
+        num_utts=args.num_utts,
+        min_frames=args.min_frames,
+        max_frames=args.max_frames,
+    )
@@ -4,11 +4,12 @@
 # @Author    :lovemefan
 # @Email     :lovemefan@outlook.com
 import argparse
+import logging
 import os
 
 import torch
 
-from telespeechasr.torch.model.data2vec_multi_model import Data2VecMultiModel
+from telespeechasr.torch.model.data2vec_ctc_inference import Data2VecCtcInference
 from telespeechasr.torch.utils.utils import load_checkpoint
 from telespeechasr.torchscript.torchscript_export import data2vec_multo_model_export
 
@@ -36,10 +37,85 @@ def get_parser():
         action="store_true",
         help="Whether to quantize the model",
     )
+    parser.add_argument(
+        "--quantize_4bit",
+        action="store_true",
+        help="Also write a model with 4-bit blockwise weight-only MatMul "
+        "weights (MatMulNBits), for memory bound devices",
+    )
+    parser.add_argument(
+        "--block_size",
+        type=int,
+        default=32,
+        help="Number of weights sharing one scale in the 4-bit model",
+    )
+    parser.add_argument(
+        "--accuracy_level",
+        type=int,
+        default=None,
+        choices=[0, 1, 2, 3, 4],
+        help="Lowest compute precision of the 4-bit MatMuls on cpu: "
+        "1 fp32, 2 fp16, 3 bf16, 4 int8",
+    )
+    parser.add_argument(
+        "--alibi_max_frames",
+        type=int,
+        default=3000,
+        help="Bake the ALiBi bias of inputs up to this many mfcc frames (10ms) "
+        "as a constant table that is sliced at inference, longer inputs "
+        "compute it. 0 computes it for every input",
+    )
+    parser.add_argument(
+        "--fuse",
+        action="store_true",
+        help="Experimental, also write an opset 17 model with onnxruntime "
+        "fused attention, LayerNorm and GELU ops, and report its node count, "
+        "latency and parity against the plain model, it warns when the fused "
+        "model is slower",
+    )
+    parser.add_argument(
+        "--buckets",
+        type=int,
+        nargs="*",
+        default=None,
+        help="Also write static shape models for these numbers of mfcc frames "
+        "to output_dir/buckets, 256 512 1024 2048 when none is given, see "
+        "onnx_buckets.py",
+    )
+    parser.add_argument("--bucket_batch_sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument(
+        "--num_layers",
+        type=int,
+        default=None,
+        help="Export only the first blocks (24 with the prenet) before the "
+        "output layer, a cheaper tier for model_tiering.py",
+    )
     args = parser.parse_args()
     return args
 
 
+def export_fused_onnx(args, model):
+    from telespeechasr.onnx.onnx_optimize import (
+        compare_models,
+        count_nodes,
+        export_fused,
+    )
+
+    model_path = os.path.join(args.output_dir, "model_export.onnx")
+    fused_model_path = os.path.join(args.output_dir, "model_export_fused.onnx")
+    fused_ops = export_fused(model, fused_model_path)
+    logging.info(f"Nodes before fusion: {count_nodes(model_path)}")
+    logging.info(f"Nodes after fusion: {count_nodes(fused_model_path)}")
+    logging.info(f"Fused ops: {fused_ops}")
+    report = compare_models(model_path, fused_model_path)
+    slower = [result["length"] for result in report if result["speedup"] < 1]
+    if slower:
+        logging.warning(
+            f"The fused model is slower than {model_path} at {slower} frames, "
+            f"keep using the plain model"
+        )
+
+
 def export_onnx(args, model):
     model_path = os.path.join(args.output_dir, f"model_export.onnx")
     torch.onnx.export(
@@ -71,11 +147,43 @@ def export_onnx(args, model):
                 reduce_range=False,
                 weight_type=QuantType.QUInt8,
             )
+    if args.quantize_4bit:
+        from telespeechasr.onnx.onnx_quantize import quantize_4bit
+
+        quant_model_path = os.path.join(
+            args.output_dir, f"model_export_int4_block{args.block_size}.onnx"
+        )
+        quantize_4bit(
+            model_path,
+            quant_model_path,
+            block_size=args.block_size,
+            accuracy_level=args.accuracy_level,
+        )
 
 
 if __name__ == "__main__":
     args = get_parser()
-    model = Data2VecMultiModel(vocab_size=7535)
+    model = Data2VecCtcInference(vocab_size=7535)
     model = load_checkpoint(args.model_path, model)
-    model_export = data2vec_multo_model_export(model)
+    if args.num_layers is not None:
+        model.truncate(args.num_layers)
+    model.bake_alibi_table(
+        int(model.get_output_lengths(torch.tensor(args.alibi_max_frames)))
+        if args.alibi_max_frames > 0
+        else 0
+    )
+    model_export = data2vec_multo_model_export(model.eval())
     export_onnx(args, model_export)
+    if args.buckets is not None:
+        from telespeechasr.onnx.onnx_buckets import DEFAULT_FRAMES, export_buckets
+
+        export_buckets(
+            model.eval(),
+            os.path.join(args.output_dir, "buckets"),
+            frames=args.buckets or DEFAULT_FRAMES,
+            batch_sizes=args.bucket_batch_sizes,
+        )
+    if args.fuse:
+        formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+        logging.basicConfig(format=formatter, level=logging.INFO)
+        export_fused_onnx(args, model.eval())
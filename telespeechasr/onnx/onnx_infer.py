@@ -8,52 +8,44 @@ import json
 import logging
 import os
 import time
-import warnings
 from pathlib import Path
 from typing import Dict, List, Tuple
 
 import kaldi_native_fbank as knf
 import numpy as np
 import soundfile as sf
-from onnxruntime import (
-    GraphOptimizationLevel,
-    InferenceSession,
-    SessionOptions,
-    get_available_providers,
-    get_device,
+from onnxruntime import GraphOptimizationLevel, SessionOptions
+
+from telespeechasr.decoding.command_scorer import CommandScorer, build_command_scorer
+from telespeechasr.decoding.context_graph import ContextGraph, build_context_graph
+from telespeechasr.decoding.ctc_prefix_beam_search import (
+    ctc_prefix_beam_search,
+    log_softmax,
+)
+from telespeechasr.decoding.timestamps import (
+    ctc_greedy_search,
+    get_frame_shift,
+    to_json_result,
 )
+from telespeechasr.onnx.execution_providers import DEVICES, create_session
 
 
 class OrtInferRuntimeSession:
-    def __init__(self, model_file, device_id=-1, intra_op_num_threads=4):
-        device_id = str(device_id)
+    def __init__(self, model_file, device_id=-1, intra_op_num_threads=4, device=None):
+        """
+        Args:
+            device: device or comma separated providers, see
+                execution_providers.py. Defaults to cuda when ``device_id``
+                is set and to cpu otherwise.
+        """
+        if device is None:
+            device = "cpu" if str(device_id) == "-1" else "cuda"
         sess_opt = SessionOptions()
         sess_opt.intra_op_num_threads = intra_op_num_threads
         sess_opt.log_severity_level = 4
         sess_opt.enable_cpu_mem_arena = False
         sess_opt.graph_optimization_level = GraphOptimizationLevel.ORT_ENABLE_ALL
 
-        cuda_ep = "CUDAExecutionProvider"
-        cuda_provider_options = {
-            "device_id": device_id,
-            "arena_extend_strategy": "kNextPowerOfTwo",
-            "cudnn_conv_algo_search": "EXHAUSTIVE",
-            "do_copy_in_default_stream": "true",
-        }
-        cpu_ep = "CPUExecutionProvider"
-        cpu_provider_options = {
-            "arena_extend_strategy": "kSameAsRequested",
-        }
-
-        EP_list = []
-        if (
-            device_id != "-1"
-            and get_device() == "GPU"
-            and cuda_ep in get_available_providers()
-        ):
-            EP_list = [(cuda_ep, cuda_provider_options)]
-        EP_list.append((cpu_ep, cpu_provider_options))
-
         if isinstance(model_file, list):
             merged_model_file = b""
             for file in sorted(model_file):
@@ -63,22 +55,18 @@ class OrtInferRuntimeSession:
             model_file = merged_model_file
         else:
             self._verify_model(model_file)
-        self.session = InferenceSession(
-            model_file, sess_options=sess_opt, providers=EP_list
+        # unavailable providers fall back to the next one and finally to cpu
+        self.session = create_session(
+            model_file,
+            device=device,
+            device_id=int(device_id),
+            intra_op_num_threads=intra_op_num_threads,
+            sess_options=sess_opt,
         )
 
         # delete binary of model file to save memory
         del model_file
 
-        if device_id != "-1" and cuda_ep not in self.session.get_providers():
-            warnings.warn(
-                f"{cuda_ep} is not avaiable for current env, the inference part is automatically shifted to be executed under {cpu_ep}.\n"
-                "Please ensure the installed onnxruntime-gpu version matches your cuda and cudnn version, "
-                "you can check their relations from the offical web site: "
-                "https://onnxruntime.ai/docs/execution-providers/CUDA-ExecutionProvider.html",
-                RuntimeWarning,
-            )
-
     def __call__(self, input_content: np.ndarray) -> np.ndarray:
         input_dict = dict(zip(self.get_input_names(), input_content[None, ...]))
         try:
@@ -117,7 +105,18 @@ class OrtInferRuntimeSession:
 
 class TeleSpeechAsrInferSession:
     def __init__(
-        self, model_file, vocab_path=None, device_id=-1, intra_op_num_threads=4
+        self,
+        model_file,
+        vocab_path=None,
+        device_id=-1,
+        intra_op_num_threads=4,
+        decoding_method="greedy_search",
+        beam_size=10,
+        hotwords=None,
+        hotwords_score=1.5,
+        commands=None,
+        command_threshold=0.0,
+        device=None,
     ):
         self.vocab_path = vocab_path or os.path.join(
             os.path.dirname(__file__), "data", "vocab.json"
@@ -131,7 +130,10 @@ class TeleSpeechAsrInferSession:
 
         logging.info(f"Loading model from {model_file}")
         self.session = OrtInferRuntimeSession(
-            model_file, device_id=device_id, intra_op_num_threads=intra_op_num_threads
+            model_file,
+            device_id=device_id,
+            intra_op_num_threads=intra_op_num_threads,
+            device=device,
         )
 
         opts = knf.MfccOptions()
@@ -149,6 +151,35 @@ class TeleSpeechAsrInferSession:
 
         self.blank_weight = 0.0
         self.blank_mode = "add"
+        self.frame_shift = get_frame_shift()
+
+        assert decoding_method in ("greedy_search", "prefix_beam_search")
+        self.decoding_method = decoding_method
+        self.beam_size = beam_size
+        self.hotwords_score = hotwords_score
+        self.context_graph = None
+        if hotwords is not None:
+            self.set_hotwords(hotwords)
+        self.command_threshold = command_threshold
+        self.command_scorer = None
+        if commands is not None:
+            self.set_commands(commands)
+
+    def build_context_graph(self, hotwords) -> ContextGraph:
+        """Compile hotwords (dict, list of lines or file path) into a graph."""
+        return build_context_graph(hotwords, self.vocab2id, self.hotwords_score)
+
+    def set_hotwords(self, hotwords):
+        """Replace the default hotwords used when ``infer`` gets none."""
+        self.context_graph = (
+            self.build_context_graph(hotwords) if hotwords is not None else None
+        )
+
+    def set_commands(self, commands):
+        """Set the command list (list or txt/xlsx path) used by ``infer_command``."""
+        self.command_scorer = build_command_scorer(
+            commands, self.vocab2id, self.command_threshold
+        )
 
     def postprocess(self, feats):
         m = feats.mean(axis=0, keepdims=True)
@@ -171,11 +202,19 @@ class TeleSpeechAsrInferSession:
         self,
         emissions: np.ndarray,
     ) -> List[List[Dict[str, np.ndarray]]]:
-        def get_pred(e):
-            toks = e.argmax(-1)
-            return toks[toks != 0]
+        return [[ctc_greedy_search(x, self.frame_shift)] for x in emissions]
 
-        return [[{"tokens": get_pred(x), "score": 0}] for x in emissions]
+    def prefix_beam_search(
+        self,
+        emissions: np.ndarray,
+        context_graph: ContextGraph = None,
+    ) -> List[List[Dict[str, np.ndarray]]]:
+        return [
+            ctc_prefix_beam_search(
+                log_softmax(x), self.beam_size, context_graph=context_graph
+            )
+            for x in emissions
+        ]
 
     def postprocess_sentence(self, tokens):
         text = ""
@@ -214,21 +253,83 @@ class TeleSpeechAsrInferSession:
         frames = np.stack(frames, axis=0)
         return frames
 
-    def infer(self, audio_path):
+    def forward(self, audio_path) -> np.ndarray:
+        """Run the frontend and the model, return B x T x V raw emissions.
+
+        The blank weight is applied later by ``decode``, so the output can be
+        stored and decoded again with other settings.
+        """
         feats = self.get_features(audio_path)
         feats = self.postprocess(feats)[None, ...]
 
+        model_output = self.session(feats)
+        return model_output[0].transpose((1, 0, 2))
+
+    def decode(self, emissions, hotwords=None) -> List[List[Dict[str, np.ndarray]]]:
+        """Decode B x T x V emissions with the configured decoding method.
+
+        Args:
+            emissions: B x T x V emissions returned by ``forward``.
+            hotwords: hotwords for this call only, either a compiled
+                ``ContextGraph`` or anything ``build_context_graph`` accepts.
+                Defaults to the hotwords set on the session.
+        """
+        if hotwords is None:
+            context_graph = self.context_graph
+        elif isinstance(hotwords, ContextGraph):
+            context_graph = hotwords
+        else:
+            context_graph = self.build_context_graph(hotwords)
+
+        emissions = self.get_logits(emissions)
+        if self.decoding_method == "prefix_beam_search" or context_graph is not None:
+            return self.prefix_beam_search(emissions, context_graph)
+        return self.viterbi_decode(emissions)
+
+    def infer(self, audio_path, hotwords=None):
+        """Recognise one audio file, see ``decode`` for ``hotwords``."""
         logging.info("Decoding ...")
         start_time = time.time()
-        model_output = self.session(feats)
-        emissions = self.get_logits(model_output)
-        emissions = emissions[0].transpose((1, 0, 2))
-        hypos = self.viterbi_decode(emissions)
+        emissions = self.forward(audio_path)
+        hypos = self.decode(emissions, hotwords)
         result = self.postprocess_sentence(hypos[0][0]["tokens"])
         logging.info(f"Inference time: {time.time() - start_time:.4}s")
 
         return result
 
+    def transcribe(self, audio_path, hotwords=None) -> Dict:
+        """Recognise one audio file and return text, confidence and, for
+        greedy search, the start/end time and confidence of every token."""
+        emissions = self.forward(audio_path)
+        hypos = self.decode(emissions, hotwords)
+        return to_json_result(hypos[0][0], self.id2vocab)
+
+    def infer_command(self, audio_path, commands=None, nbest=1):
+        """Recognise one audio file against a closed command set.
+
+        Args:
+            audio_path: path of the audio file.
+            commands: a ``CommandScorer`` or a command list/path for this call
+                only. Defaults to the commands set on the session.
+            nbest: number of candidates returned.
+
+        Returns:
+            A list of ``CommandScorer.score`` results, ``command`` of the
+            first one is None when the audio is rejected as out-of-grammar.
+        """
+        if commands is None:
+            command_scorer = self.command_scorer
+        elif isinstance(commands, CommandScorer):
+            command_scorer = commands
+        else:
+            command_scorer = build_command_scorer(
+                commands, self.vocab2id, self.command_threshold
+            )
+        assert command_scorer is not None, "no command list is set"
+
+        emissions = self.get_logits(self.forward(audio_path))
+        return command_scorer.score(emissions[0], nbest=nbest)
+
 
 if __name__ == "__main__":
     args = argparse.ArgumentParser()
@@ -236,13 +337,65 @@ if __name__ == "__main__":
     args.add_argument("--audio_path", type=str, required=True)
     args.add_argument("--vocab_path", type=str, default=None)
     args.add_argument(
-        "--device", type=str, default="cuda", choices=["cpu", "cuda", "mps"]
+        "--device",
+        type=str,
+        default="cpu",
+        help=f"one of {list(DEVICES)}, or a comma separated list of execution "
+        "providers tried in order, e.g. openvino,dnnl. Unavailable providers "
+        "fall back to the next one and finally to cpu",
+    )
+    args.add_argument(
+        "--decoding_method",
+        type=str,
+        default="greedy_search",
+        choices=["greedy_search", "prefix_beam_search"],
+    )
+    args.add_argument("--beam_size", type=int, default=10)
+    args.add_argument(
+        "--hotwords",
+        type=str,
+        default=None,
+        help="hotwords file, one hotword per line, optionally followed by "
+        "':score' as its per-token boost. Implies prefix_beam_search",
+    )
+    args.add_argument("--hotwords_score", type=float, default=1.5)
+    args.add_argument(
+        "--commands",
+        type=str,
+        default=None,
+        help="command list (txt, one per line, or xlsx annotation sheet). "
+        "When given, every audio is scored against the commands instead of "
+        "being decoded freely",
+    )
+    args.add_argument(
+        "--command_threshold",
+        type=float,
+        default=0.0,
+        help="reject the best command when its confidence is below this value",
     )
 
     formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
     logging.basicConfig(format=formatter, level=logging.INFO)
 
     args = args.parse_args()
-    model = TeleSpeechAsrInferSession(args.model_path, args.vocab_path)
-    asr_result = model.infer(args.audio_path)
-    logging.info(asr_result)
+    model = TeleSpeechAsrInferSession(
+        args.model_path,
+        args.vocab_path,
+        device=args.device,
+        decoding_method=args.decoding_method,
+        beam_size=args.beam_size,
+        hotwords=args.hotwords,
+        hotwords_score=args.hotwords_score,
+        commands=args.commands,
+        command_threshold=args.command_threshold,
+    )
+    if args.commands is not None:
+        command_result = model.infer_command(args.audio_path)[0]
+        logging.info(
+            f"{command_result['command']} "
+            f"(best candidate {command_result['candidate']}, "
+            f"confidence {command_result['confidence']:.4f})"
+        )
+    else:
+        asr_result = model.infer(args.audio_path)
+        logging.info(asr_result)
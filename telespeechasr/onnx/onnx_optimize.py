@@ -0,0 +1,235 @@
+# -*- coding:utf-8 -*-
+# @FileName  :onnx_optimize.py
+# @Time      :2024/7/26 10:30
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import collections
+import copy
+import logging
+import time
+from typing import Dict, List, Sequence
+
+import numpy as np
+import onnx
+import torch
+from onnxruntime import InferenceSession, SessionOptions
+from torch import nn
+from torch.nn import functional as F
+
+from telespeechasr.torch.model.data2vec_ctc_inference import (
+    Data2VecCtcInference,
+    InferenceAttention,
+)
+from telespeechasr.torchscript.torchscript_export import data2vec_multo_model_export
+
+# LayerNormalization is a standard op from opset 17
+FUSED_OPSET_VERSION = 17
+# ops the optimizer must fuse for the fused model to pay off
+FUSED_OPS = ("SkipLayerNormalization", "BiasGelu")
+
+
+class MultiHeadAttentionFunction(torch.autograd.Function):
+    """Attention exported as one onnxruntime ``com.microsoft.MultiHeadAttention``.
+
+    ``bias`` is the 3 * D bias of the q, k and v projections, added inside the
+    fused op, and ``attn_bias`` the additive 1 (or B) x H x T x T ALiBi and
+    padding bias.
+    """
+
+    @staticmethod
+    def forward(ctx, q, k, v, bias, attn_bias, num_heads: int):
+        B, N, C = q.shape
+        q, k, v = (
+            (x + b).reshape(B, N, num_heads, C // num_heads).transpose(1, 2)
+            for x, b in zip((q, k, v), bias.chunk(3))
+        )
+        attn = (q * (C // num_heads) ** -0.5) @ k.transpose(-2, -1)
+        attn = (attn.float() + attn_bias).softmax(dim=-1).to(v.dtype)
+        return (attn @ v).transpose(1, 2).reshape(B, N, C)
+
+    @staticmethod
+    def symbolic(g, q, k, v, bias, attn_bias, num_heads: int):
+        # no key padding mask, the padding is in attn_bias
+        key_padding_mask = g.op("prim::Constant").setType(
+            torch._C.OptionalType.ofTensor()
+        )
+        return g.op(
+            "com.microsoft::MultiHeadAttention",
+            q,
+            k,
+            v,
+            bias,
+            key_padding_mask,
+            attn_bias,
+            num_heads_i=num_heads,
+        )
+
+
+class FusedExportAttention(nn.Module):
+    """Export twin of ``InferenceAttention`` sharing its weights.
+
+    The qkv projection runs without its bias as one MatMul, whose output is
+    split into q, k and v for ``MultiHeadAttentionFunction``.
+    """
+
+    def __init__(self, attn: InferenceAttention):
+        super().__init__()
+        self.num_heads = attn.num_heads
+        self.qkv = attn.qkv
+        self.proj = attn.proj
+
+    def forward(self, x, attn_bias):
+        q, k, v = F.linear(x, self.qkv.weight).chunk(3, dim=-1)
+        x = MultiHeadAttentionFunction.apply(
+            q, k, v, self.qkv.bias, attn_bias, self.num_heads
+        )
+        return self.proj(x)
+
+
+def fuse_attention(model: Data2VecCtcInference) -> Data2VecCtcInference:
+    """Copy of the model whose attention exports as ``MultiHeadAttention``.
+
+    The ALiBi bias is computed from the slopes, the baked table would add
+    an If node on which the shape inference of the optimizer fails.
+    """
+    # a shallow copy would share _modules and swap the caller's attention
+    model = copy.deepcopy(model)
+    model.alibi_from_slopes = True
+    for blk in model.blocks:
+        blk.attn = FusedExportAttention(blk.attn)
+    return model
+
+
+def export_fused(
+    model: Data2VecCtcInference, output_path: str, opt_level: int = 0
+) -> Dict[str, int]:
+    """Export the model with onnxruntime fused ops and save it.
+
+    Attention becomes ``MultiHeadAttention`` (with the qkv bias and the ALiBi
+    bias inside) at export, then the transformer optimizer of onnxruntime
+    fuses LayerNorm, the residual add and the bias of the previous MatMul into
+    ``SkipLayerNormalization`` and the mlp bias and GELU into ``BiasGelu``.
+    The model needs onnxruntime to run.
+
+    Returns the number of nodes of every fused op of the optimizer, it raises
+    when its shape inference failed or no ``SkipLayerNormalization`` or
+    ``BiasGelu`` was fused, such a model is no faster than the plain export.
+
+    Args:
+        opt_level: onnxruntime graph optimisations also saved in the model,
+            0 keeps the model portable across hardware.
+    """
+    from onnxruntime.transformers.fusion_options import FusionOptions
+    from onnxruntime.transformers.optimizer import optimize_model
+
+    model_export = data2vec_multo_model_export(fuse_attention(model.eval()))
+    torch.onnx.export(
+        model_export,
+        (torch.randn(1, 155, 40)),
+        output_path,
+        verbose=False,
+        opset_version=FUSED_OPSET_VERSION,
+        input_names=["feats"],
+        output_names=["logits"],
+        dynamic_axes={
+            "feats": {1: "T"},
+            "logits": {0: "T"},
+        },
+        custom_opsets={"com.microsoft": 1},
+    )
+
+    embed_dim = model.proj.in_features
+    fusion_options = FusionOptions("bert")
+    # attention is already fused at export
+    fusion_options.enable_attention = False
+    optimizer = optimize_model(
+        output_path,
+        model_type="bert",
+        num_heads=model.num_heads,
+        hidden_size=embed_dim,
+        optimization_options=fusion_options,
+        opt_level=opt_level,
+    )
+    optimizer.save_model_to_file(output_path)
+
+    statistics = {
+        op: count
+        for op, count in optimizer.get_fused_operator_statistics().items()
+        if count > 0 or op in FUSED_OPS
+    }
+    # the optimizer disables its shape inference when it fails
+    if not optimizer.enable_shape_infer:
+        raise RuntimeError(
+            f"Shape inference of the optimizer failed on {output_path}, "
+            f"fused ops: {statistics}"
+        )
+    missing = [op for op in FUSED_OPS if statistics[op] == 0]
+    if missing:
+        raise RuntimeError(
+            f"No {', '.join(missing)} fused in {output_path}, fused ops: {statistics}"
+        )
+    return statistics
+
+
+def count_nodes(model_path: str) -> Dict[str, int]:
+    """Number of nodes of every op type, the total under ``total``."""
+    graph = onnx.load(model_path, load_external_data=False).graph
+    counts = collections.Counter(node.op_type for node in graph.node)
+    counts = dict(counts.most_common())
+    counts["total"] = len(graph.node)
+    return counts
+
+
+def compare_models(
+    baseline_path: str,
+    optimized_path: str,
+    lengths: Sequence[int] = (155, 500, 1000),
+    repeat: int = 5,
+    intra_op_num_threads: int = 4,
+) -> List[Dict]:
+    """Latency and parity of an optimised model against its baseline.
+
+    Both models run on the same random B=1 features of every length, on cpu
+    with the same number of threads.
+    """
+    sessions = []
+    for path in (baseline_path, optimized_path):
+        sess_opt = SessionOptions()
+        sess_opt.intra_op_num_threads = intra_op_num_threads
+        sessions.append(
+            InferenceSession(
+                path, sess_options=sess_opt, providers=["CPUExecutionProvider"]
+            )
+        )
+
+    report = []
+    for length in lengths:
+        feats = np.random.randn(1, length, 40).astype(np.float32)
+        outputs, latencies = [], []
+        for session in sessions:
+            outputs.append(session.run(None, {"feats": feats})[0])
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                session.run(None, {"feats": feats})
+                times.append(time.perf_counter() - start)
+            latencies.append(min(times))
+        baseline, optimized = outputs
+        result = {
+            "length": length,
+            "baseline_ms": round(latencies[0] * 1000, 2),
+            "optimized_ms": round(latencies[1] * 1000, 2),
+            "speedup": round(latencies[0] / latencies[1], 3),
+            "max_abs_diff": float(np.abs(baseline - optimized).max()),
+            "argmax_agreement": float(
+                (baseline.argmax(-1) == optimized.argmax(-1)).mean()
+            ),
+        }
+        logging.info(
+            f"{length} frames: {result['baseline_ms']:.1f}ms -> "
+            f"{result['optimized_ms']:.1f}ms ({result['speedup']:.2f}x), "
+            f"max abs diff {result['max_abs_diff']:.2e}, "
+            f"argmax agreement {result['argmax_agreement'] * 100:.2f}%"
+        )
+        report.append(result)
+    return report
@@ -0,0 +1,388 @@
+# -*- coding:utf-8 -*-
+# @FileName  :onnx_quantize.py
+# @Time      :2024/7/25 10:20
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import argparse
+import glob
+import json
+import logging
+import os
+import re
+import tempfile
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import onnx
+from onnxruntime import InferenceSession
+from onnx import version_converter
+from onnxruntime.quantization import (
+    CalibrationDataReader,
+    CalibrationMethod,
+    QuantFormat,
+    QuantType,
+    quantize_static,
+)
+from onnxruntime.quantization.shape_inference import quant_pre_process
+
+try:
+    from onnxruntime.quantization.matmul_nbits_quantizer import MatMulNBitsQuantizer
+except ImportError:  # onnxruntime < 1.20
+    from onnxruntime.quantization.matmul_4bits_quantizer import (
+        MatMul4BitsQuantizer as MatMulNBitsQuantizer,
+    )
+
+from telespeechasr.onnx.frontend import MfccFrontend
+
+# node name prefix of every layer of the exported model, see onnx_export.py
+LAYER_PATTERN = re.compile(
+    r"^/model/(local_encoder/conv_layers\.\d+|project_features|pos_conv\.\d+"
+    r"|blocks\.\d+|proj)/"
+)
+
+# the first conv sees the raw mfcc and the CTC projection decides the tokens,
+# both lose the most accuracy in int8
+DEFAULT_FLOAT_LAYERS = ("local_encoder/conv_layers.0", "proj")
+
+CALIBRATE_METHODS = {
+    "minmax": CalibrationMethod.MinMax,
+    "percentile": CalibrationMethod.Percentile,
+    "entropy": CalibrationMethod.Entropy,
+}
+
+
+class AudioCalibrationReader(CalibrationDataReader):
+    """Feed the features of audio files to the calibration of ``quantize_static``.
+
+    The features are computed once by ``frontend`` (mfcc and per-utterance
+    CMVN, as at inference, without loading the model) and kept in memory, so
+    that the reader can be rewound for every quantisation of a sensitivity
+    analysis.
+    """
+
+    def __init__(
+        self,
+        audio_paths: Sequence[str],
+        input_name: str = "feats",
+        frontend: MfccFrontend = None,
+    ):
+        self.input_name = input_name
+        frontend = frontend or MfccFrontend()
+        self.feats = [frontend(path) for path in audio_paths]
+        self.rewind()
+
+    def get_next(self) -> Optional[Dict[str, np.ndarray]]:
+        return next(self.iterator, None)
+
+    def rewind(self):
+        self.iterator = iter({self.input_name: feats} for feats in self.feats)
+
+    def __len__(self):
+        return len(self.feats)
+
+
+def get_layers(
+    model_path: str, op_types: Sequence[str] = ("MatMul", "Conv")
+) -> Dict[str, List[str]]:
+    """Group the quantisable nodes of an exported model by layer, in graph order."""
+    model = onnx.load(model_path, load_external_data=False)
+    layers = OrderedDict()
+    for node in model.graph.node:
+        match = LAYER_PATTERN.match(node.name)
+        if node.op_type in op_types and match:
+            layers.setdefault(match.group(1), []).append(node.name)
+    return layers
+
+
+def preprocess(model_path: str, output_path: str, opset_version: int = 13):
+    """Prepare an exported model for ``quantize_qdq``.
+
+    Per channel QDQ needs opset 13, the export is opset 11, and the
+    quantiser needs the shapes of the intermediate tensors.  The graph is not
+    optimised here so that the node names stay those of ``get_layers``.
+    """
+    model = onnx.load(model_path)
+    if model.opset_import[0].version < opset_version:
+        model = version_converter.convert_version(model, opset_version)
+    onnx.save(model, output_path)
+    # the symbolic shape inference of onnxruntime gives up on the ALiBi bias,
+    # the onnx one is enough for the quantiser
+    quant_pre_process(
+        output_path, output_path, skip_optimization=True, skip_symbolic_shape=True
+    )
+
+
+def quantize_qdq(
+    model_path: str,
+    output_path: str,
+    reader: AudioCalibrationReader,
+    float_layers: Sequence[str] = DEFAULT_FLOAT_LAYERS,
+    nodes_to_quantize: Optional[List[str]] = None,
+    op_types: Sequence[str] = ("MatMul", "Conv"),
+    per_channel: bool = True,
+    calibrate_method: str = "minmax",
+):
+    """Static int8 quantisation of an exported model in the QDQ format.
+
+    Weights are quantised symmetrically to int8 (per output channel by
+    default) and activations to uint8 with the ranges seen on ``reader``.
+
+    Args:
+        model_path: fp32 model written by onnx_export.py, after ``preprocess``.
+        output_path: path of the quantised model.
+        reader: calibration data.
+        float_layers: layers (keys of ``get_layers``) kept in float.
+        nodes_to_quantize: quantise only these nodes, defaults to all.
+        op_types: op types to quantise.
+        per_channel: per output channel scales of the weights.
+        calibrate_method: minmax, percentile or entropy.
+    """
+    layers = get_layers(model_path, op_types)
+    nodes_to_exclude = [
+        name for layer in float_layers for name in layers.get(layer, [])
+    ]
+    reader.rewind()
+    quantize_static(
+        model_input=model_path,
+        model_output=output_path,
+        calibration_data_reader=reader,
+        quant_format=QuantFormat.QDQ,
+        op_types_to_quantize=list(op_types),
+        per_channel=per_channel,
+        reduce_range=False,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        nodes_to_quantize=nodes_to_quantize,
+        nodes_to_exclude=nodes_to_exclude,
+        calibrate_method=CALIBRATE_METHODS[calibrate_method],
+        extra_options={"WeightSymmetric": True, "ActivationSymmetric": False},
+    )
+
+
+def quantize_4bit(
+    model_path: str,
+    output_path: str,
+    block_size: int = 32,
+    accuracy_level: Optional[int] = None,
+    is_symmetric: bool = True,
+    float_layers: Sequence[str] = (),
+):
+    """Blockwise 4-bit weight-only quantisation of the MatMul weights.
+
+    The constant weights of the qkv, attention proj, mlp and CTC head MatMuls
+    become ``MatMulNBits`` nodes with one scale (and zero point unless
+    ``is_symmetric``) per ``block_size`` input channels, the activations stay
+    in float.  The attention matmuls between activations are left unchanged.
+
+    Args:
+        block_size: power of 2 not smaller than 16, smaller blocks are more
+            accurate and larger.
+        accuracy_level: lowest precision of the computation on cpu, 0 unset,
+            1 fp32, 2 fp16, 3 bf16, 4 int8.  Defaults to the onnxruntime one.
+        float_layers: layers (keys of ``get_layers``) kept in float.
+    """
+    layers = get_layers(model_path, ("MatMul",))
+    nodes_to_exclude = [
+        name for layer in float_layers for name in layers.get(layer, [])
+    ]
+    model = onnx.load(model_path)
+    quantizer = MatMulNBitsQuantizer(
+        model,
+        block_size=block_size,
+        is_symmetric=is_symmetric,
+        accuracy_level=accuracy_level,
+        nodes_to_exclude=nodes_to_exclude,
+    )
+    quantizer.process()
+    quantizer.model.save_model_to_file(output_path, use_external_data_format=False)
+
+
+def run_model(model_path: str, reader: AudioCalibrationReader) -> List[np.ndarray]:
+    session = InferenceSession(model_path, providers=["CPUExecutionProvider"])
+    output_name = session.get_outputs()[0].name
+    reader.rewind()
+    return [
+        session.run([output_name], inputs)[0] for inputs in iter(reader.get_next, None)
+    ]
+
+
+def compare_outputs(reference: List[np.ndarray], outputs: List[np.ndarray]) -> Dict:
+    """Frame argmax disagreement and SNR (dB) of ``outputs`` against ``reference``."""
+    frames = diff_frames = 0
+    signal = noise = 0.0
+    for ref, out in zip(reference, outputs):
+        diff_frames += int((ref.argmax(-1) != out.argmax(-1)).sum())
+        frames += ref.shape[0] * ref.shape[1]
+        signal += float(np.square(ref.astype(np.float64)).sum())
+        noise += float(np.square((ref - out).astype(np.float64)).sum())
+    return {
+        "frame_error": diff_frames / max(frames, 1),
+        "snr_db": 10 * np.log10(signal / max(noise, 1e-20)),
+    }
+
+
+def sensitivity_analysis(
+    model_path: str,
+    reader: AudioCalibrationReader,
+    op_types: Sequence[str] = ("MatMul", "Conv"),
+    per_channel: bool = True,
+    calibrate_method: str = "minmax",
+) -> List[Dict]:
+    """Quantise one layer at a time and measure the damage on the outputs.
+
+    ``model_path`` is a model after ``preprocess``.  Every layer is quantised alone, the rest of the model stays in float,
+    and its outputs on the calibration data are compared with the fp32 ones.
+    This quantises and calibrates the model once per layer, so a few dozen
+    utterances of calibration data are enough.
+
+    Returns:
+        One dict per layer with its ``layer`` name, ``frame_error`` and
+        ``snr_db``, the most sensitive layer first.
+    """
+    reference = run_model(model_path, reader)
+    report = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_path = os.path.join(tmp_dir, "layer_quant.onnx")
+        for layer, nodes in get_layers(model_path, op_types).items():
+            quantize_qdq(
+                model_path,
+                output_path,
+                reader,
+                float_layers=(),
+                nodes_to_quantize=nodes,
+                op_types=op_types,
+                per_channel=per_channel,
+                calibrate_method=calibrate_method,
+            )
+            result = {
+                "layer": layer,
+                **compare_outputs(reference, run_model(output_path, reader)),
+            }
+            logging.info(
+                f"{layer}: frame error {result['frame_error'] * 100:.2f}%, "
+                f"SNR {result['snr_db']:.1f}dB"
+            )
+            report.append(result)
+    report.sort(key=lambda r: (-r["frame_error"], r["snr_db"]))
+    return report
+
+
+def select_float_layers(
+    report: List[Dict],
+    max_frame_error: float = 0.001,
+    min_snr_db: float = 20.0,
+    max_layers: int = 4,
+) -> List[str]:
+    """The most sensitive layers of a report, among those too damaged by int8.
+
+    At most ``max_layers`` layers are returned, the speedup is gone when most
+    of the model stays in float.
+    """
+    return [
+        r["layer"]
+        for r in report
+        if r["frame_error"] > max_frame_error or r["snr_db"] < min_snr_db
+    ][:max_layers]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="static int8 (QDQ) quantisation of an exported onnx model, "
+        "calibrated on audio files",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--model_path", type=str, required=True, help="fp32 model")
+    parser.add_argument("--output_path", type=str, required=True)
+    parser.add_argument(
+        "--calibration_path",
+        type=str,
+        required=True,
+        help="directory of wav files representative of the deployment audio",
+    )
+    parser.add_argument("--num_calibration", type=int, default=64)
+    parser.add_argument(
+        "--calibrate_method",
+        type=str,
+        default="minmax",
+        choices=list(CALIBRATE_METHODS),
+    )
+    parser.add_argument(
+        "--per_tensor",
+        action="store_true",
+        help="one scale per weight tensor instead of per output channel",
+    )
+    parser.add_argument("--op_types", type=str, nargs="+", default=["MatMul", "Conv"])
+    parser.add_argument(
+        "--float_layers",
+        type=str,
+        nargs="*",
+        default=list(DEFAULT_FLOAT_LAYERS),
+        help="layers kept in float, e.g. proj, local_encoder/conv_layers.0, "
+        "pos_conv.0, blocks.3",
+    )
+    parser.add_argument(
+        "--sensitivity",
+        action="store_true",
+        help="quantise the layers one at a time first and also keep in float "
+        "the layers above --max_frame_error or below --min_snr_db",
+    )
+    parser.add_argument("--max_frame_error", type=float, default=0.001)
+    parser.add_argument("--min_snr_db", type=float, default=20.0)
+    parser.add_argument(
+        "--max_float_layers",
+        type=int,
+        default=4,
+        help="keep at most this many layers in float after the sensitivity analysis",
+    )
+    parser.add_argument(
+        "--report", type=str, default=None, help="json file of the sensitivity report"
+    )
+    args = parser.parse_args()
+
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    audio_paths = sorted(glob.glob(os.path.join(args.calibration_path, "*.wav")))
+    audio_paths = audio_paths[: args.num_calibration]
+    assert audio_paths, f"no wav file in {args.calibration_path}"
+    reader = AudioCalibrationReader(audio_paths)
+    logging.info(f"Calibrating on {len(reader)} utterances")
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    model_path = os.path.join(tmp_dir.name, "model_preprocessed.onnx")
+    preprocess(args.model_path, model_path)
+
+    float_layers = list(args.float_layers)
+    if args.sensitivity:
+        report = sensitivity_analysis(
+            model_path,
+            reader,
+            op_types=args.op_types,
+            per_channel=not args.per_tensor,
+            calibrate_method=args.calibrate_method,
+        )
+        if args.report is not None:
+            with open(args.report, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+        for layer in select_float_layers(
+            report, args.max_frame_error, args.min_snr_db, args.max_float_layers
+        ):
+            if layer not in float_layers:
+                float_layers.append(layer)
+    logging.info(f"Layers kept in float: {float_layers}")
+
+    quantize_qdq(
+        model_path,
+        args.output_path,
+        reader,
+        float_layers=float_layers,
+        op_types=args.op_types,
+        per_channel=not args.per_tensor,
+        calibrate_method=args.calibrate_method,
+    )
+    tmp_dir.cleanup()
+    logging.info(
+        f"Saved int8 model to {args.output_path} "
+        f"({os.path.getsize(args.output_path) / 2 ** 20:.0f}MB)"
+    )
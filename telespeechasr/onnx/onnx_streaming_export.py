@@ -0,0 +1,281 @@
+# -*- coding:utf-8 -*-
+# @FileName  :onnx_streaming_export.py
+# @Time      :2024/7/30 10:40
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import argparse
+import logging
+import os
+from typing import Tuple
+
+import onnx
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from telespeechasr.torch.model.data2vec_ctc_inference import Data2VecCtcInference
+from telespeechasr.torch.utils.utils import load_checkpoint
+
+
+class Data2VecCtcStreaming(nn.Module):
+    """Chunk by chunk ``Data2VecCtcInference`` with explicit state tensors.
+
+    Every call takes ``chunk_frames`` new mfcc frames and the state returned
+    by the previous call (``init_state`` for the first one), and returns the
+    logits of ``chunk_frames / 4`` new encoder frames and the new state, so
+    the cost of a chunk does not depend on the length of the stream:
+
+    - ``feat_cache``: the last mfcc frames of the previous chunk, the overlap
+      of the receptive fields of the conv extractor, which is then exact.
+    - ``pos_cache``: the last input frames of every positional conv layer,
+      its left context. The right context stops at the end of the chunk.
+    - ``attn_cache``: keys and values of the last ``left_context`` encoder
+      frames of every layer, a chunk attends to them and to itself.
+    - ``num_frames``: number of encoder frames already output, which masks
+      the part of the caches before the start of the stream.
+
+    ``chunk_lengths`` is the number of valid encoder frames of a zero padded
+    last chunk: as in ``Data2VecCtcInference.embed``, the frames after them
+    are zeroed before every positional conv and masked as attention keys.
+
+    The model is trained on whole utterances, so the limited attention
+    context and the missing right context cost some accuracy compared with
+    the offline model.  The weights are those of ``model``.
+    """
+
+    def __init__(
+        self,
+        model: Data2VecCtcInference,
+        chunk_frames: int = 64,
+        left_context: int = 64,
+    ):
+        super().__init__()
+        self.model = model
+        self.num_heads = model.num_heads
+        self.embed_dim = model.proj.in_features
+
+        receptive_field, subsampling = 1, 1
+        for _, kernel_size, stride in reversed(model.feature_enc_layers):
+            receptive_field = (receptive_field - 1) * stride + kernel_size
+            subsampling *= stride
+        assert (
+            chunk_frames % subsampling == 0
+        ), f"chunk_frames must be a multiple of {subsampling}"
+        self.subsampling = subsampling
+        self.chunk_frames = chunk_frames
+        self.chunk_size = chunk_frames // subsampling
+        self.feat_cache_frames = receptive_field - subsampling
+        self.feature_dim = model.local_encoder.conv_layers[0][0].in_channels
+        self.left_context = left_context
+
+        self.pos_left = model.pos_conv[0].conv.padding[0]
+        self.pos_right = self.pos_left - model.pos_conv[0].remove
+
+        # H x chunk x (left_context + chunk) ALiBi bias of every distinct slopes
+        q = torch.arange(self.chunk_size) + left_context
+        k = torch.arange(left_context + self.chunk_size)
+        distance = -(q[:, None] - k[None, :]).abs().float()
+        slopes = model.alibi_slopes[:1] if model.shared_alibi else model.alibi_slopes
+        self.register_buffer(
+            "alibi_bias", slopes[:, :, None, None] * distance, persistent=False
+        )
+
+    def init_state(
+        self, batch_size: int = 1
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """State before the first chunk, the caches are empty."""
+        feat_cache = torch.zeros(batch_size, self.feat_cache_frames, self.feature_dim)
+        pos_cache = torch.zeros(
+            len(self.model.pos_conv), batch_size, self.embed_dim, self.pos_left
+        )
+        attn_cache = torch.zeros(
+            len(self.model.blocks), 2, batch_size, self.left_context, self.embed_dim
+        )
+        num_frames = torch.zeros(batch_size, dtype=torch.long)
+        return feat_cache, pos_cache, attn_cache, num_frames
+
+    def attention(self, i: int, x, k_cache, v_cache, key_bias):
+        blk = self.model.blocks[i]
+        B, N, C = x.shape
+        H = self.num_heads
+        q, k, v = blk.attn.qkv(x).chunk(3, dim=-1)
+        k = torch.cat([k_cache, k], dim=1)
+        v = torch.cat([v_cache, v], dim=1)
+
+        def heads(t):
+            return t.reshape(B, -1, H, C // H).transpose(1, 2)
+
+        attn = (heads(q) * blk.attn.scale) @ heads(k).transpose(-2, -1)
+        alibi_bias = self.alibi_bias[0 if self.model.shared_alibi else i]
+        attn = (attn.float() + alibi_bias.unsqueeze(0) + key_bias).softmax(dim=-1)
+        out = (attn.to(v.dtype) @ heads(v)).transpose(1, 2).reshape(B, N, C)
+        return (
+            blk.attn.proj(out),
+            k[:, -self.left_context :],
+            v[:, -self.left_context :],
+        )
+
+    def forward(
+        self, feats, feat_cache, pos_cache, attn_cache, num_frames, chunk_lengths
+    ):
+        """
+        Args:
+            feats: B x chunk_frames x C normalised mfcc features.
+            feat_cache, pos_cache, attn_cache, num_frames: state of the
+                previous call or of ``init_state``.
+            chunk_lengths: B valid encoder frames of the chunk, ``chunk_size``
+                but for the last chunk of a stream.
+
+        Returns:
+            B x chunk_frames/4 x V logits and the new state.
+        """
+        model = self.model
+        feats = torch.cat([feat_cache, feats], dim=1)
+        new_feat_cache = feats[:, -self.feat_cache_frames :]
+
+        x = model.project_features(model.local_encoder(feats))
+        chunk_positions = torch.arange(self.chunk_size, device=x.device)
+        padding_mask = chunk_positions[None, :] >= chunk_lengths[:, None]
+
+        # positional convs over their left context and the chunk, the padded
+        # frames are zeroed before every layer
+        x_pos = x.transpose(1, 2)
+        keep = (~padding_mask).unsqueeze(1).type_as(x)
+        new_pos_cache = []
+        for j, layer in enumerate(model.pos_conv):
+            x_pos = torch.cat([pos_cache[j], x_pos * keep], dim=2)
+            new_pos_cache.append(x_pos[:, :, -self.pos_left :])
+            x_pos = F.conv1d(
+                F.pad(x_pos, (0, self.pos_right)),
+                layer.conv.weight,
+                layer.conv.bias,
+                groups=layer.conv.groups,
+            )
+            x_pos = layer.norm(x_pos.transpose(1, 2)).transpose(1, 2)
+            x_pos = F.gelu(x_pos)
+        x = model.prenet_norm(x + x_pos.transpose(1, 2))
+
+        # cached frames from before the start of the stream and padded frames
+        # are masked
+        key_positions = torch.arange(
+            -self.left_context, self.chunk_size, device=x.device
+        )
+        key_mask = (key_positions[None, :] + num_frames[:, None] < 0) | (
+            key_positions[None, :] >= chunk_lengths[:, None]
+        )
+        key_bias = torch.zeros(
+            x.size(0), 1, 1, key_positions.size(0), device=x.device
+        ).masked_fill(key_mask[:, None, None, :], float("-inf"))
+
+        new_attn_cache = []
+        for i, blk in enumerate(model.blocks):
+            attn, k_cache, v_cache = self.attention(
+                i, x, attn_cache[i, 0], attn_cache[i, 1], key_bias
+            )
+            new_attn_cache.append(torch.stack([k_cache, v_cache]))
+            x = blk.norm1(x + attn)
+            x = blk.norm2(x + blk.mlp(x))
+
+        return (
+            model.proj(x),
+            new_feat_cache,
+            torch.stack(new_pos_cache),
+            torch.stack(new_attn_cache),
+            num_frames + self.chunk_size,
+        )
+
+
+def export_streaming_onnx(streaming: Data2VecCtcStreaming, model_path: str):
+    """Export one chunk step, the chunk size and contexts go to the metadata."""
+    state = streaming.init_state()
+    feats = torch.randn(1, streaming.chunk_frames, streaming.feature_dim)
+    chunk_lengths = torch.full((1,), streaming.chunk_size, dtype=torch.long)
+    torch.onnx.export(
+        streaming.eval(),
+        (feats, *state, chunk_lengths),
+        model_path,
+        verbose=False,
+        opset_version=13,
+        input_names=[
+            "feats",
+            "feat_cache",
+            "pos_cache",
+            "attn_cache",
+            "num_frames",
+            "chunk_lengths",
+        ],
+        output_names=[
+            "logits",
+            "new_feat_cache",
+            "new_pos_cache",
+            "new_attn_cache",
+            "new_num_frames",
+        ],
+        dynamic_axes={
+            "feats": {0: "B"},
+            "feat_cache": {0: "B"},
+            "pos_cache": {1: "B"},
+            "attn_cache": {2: "B"},
+            "num_frames": {0: "B"},
+            "chunk_lengths": {0: "B"},
+            "logits": {0: "B"},
+            "new_feat_cache": {0: "B"},
+            "new_pos_cache": {1: "B"},
+            "new_attn_cache": {2: "B"},
+            "new_num_frames": {0: "B"},
+        },
+    )
+
+    onnx_model = onnx.load(model_path)
+    meta = {
+        "model_type": "data2vec_ctc_streaming",
+        "chunk_frames": streaming.chunk_frames,
+        "chunk_size": streaming.chunk_size,
+        "subsampling": streaming.subsampling,
+        "left_context": streaming.left_context,
+        "feat_cache_frames": streaming.feat_cache_frames,
+        "vocab_size": streaming.model.proj.out_features,
+    }
+    for key, value in meta.items():
+        onnx_model.metadata_props.add(key=key, value=str(value))
+    onnx.save(onnx_model, model_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--model_path", type=str, required=True, help="Path to model checkpoint"
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        required=True,
+        help="Output dir of model checkpoint",
+    )
+    parser.add_argument(
+        "--chunk_frames",
+        type=int,
+        default=64,
+        help="mfcc frames (10ms) of every chunk, a multiple of 4",
+    )
+    parser.add_argument(
+        "--left_context",
+        type=int,
+        default=64,
+        help="encoder frames (40ms) of past keys and values every layer attends to",
+    )
+    args = parser.parse_args()
+
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    model = Data2VecCtcInference(vocab_size=7535)
+    model = load_checkpoint(args.model_path, model)
+    streaming = Data2VecCtcStreaming(
+        model.eval(), chunk_frames=args.chunk_frames, left_context=args.left_context
+    )
+    model_path = os.path.join(args.output_dir, "model_export_streaming.onnx")
+    export_streaming_onnx(streaming, model_path)
+    logging.info(f"Saved streaming model to {model_path}")
@@ -0,0 +1,213 @@
+# -*- coding:utf-8 -*-
+# @FileName  :onnx_streaming_infer.py
+# @Time      :2024/7/30 15:20
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import argparse
+import json
+import logging
+import os
+import time
+from typing import List
+
+import kaldi_native_fbank as knf
+import numpy as np
+import soundfile as sf
+from onnxruntime import InferenceSession, SessionOptions
+
+from telespeechasr.decoding.timestamps import ctc_greedy_search, get_frame_shift
+
+
+class StreamingAsrSession:
+    """Runtime of the chunk model written by onnx_streaming_export.py.
+
+    Audio is pushed with ``accept_waveform`` as it arrives, every complete
+    chunk of mfcc frames runs the model once, and ``input_finished`` runs the
+    last partial chunk.  The features are normalised with the mean and
+    standard deviation of the frames seen so far, the offline runtimes use
+    those of the whole utterance.
+    """
+
+    def __init__(self, model_file, vocab_path=None, intra_op_num_threads=4):
+        self.vocab_path = vocab_path or os.path.join(
+            os.path.dirname(__file__), "data", "vocab.json"
+        )
+        with open(self.vocab_path, "r", encoding="utf-8") as f:
+            self.vocab2id = json.load(f)
+            self.id2vocab = {v: k for k, v in self.vocab2id.items()}
+
+        logging.info(f"Loading model from {model_file}")
+        sess_opt = SessionOptions()
+        sess_opt.intra_op_num_threads = intra_op_num_threads
+        self.session = InferenceSession(
+            model_file, sess_options=sess_opt, providers=["CPUExecutionProvider"]
+        )
+        meta = self.session.get_modelmeta().custom_metadata_map
+        assert (
+            meta.get("model_type") == "data2vec_ctc_streaming"
+        ), f"{model_file} is not a streaming model"
+        self.chunk_frames = int(meta["chunk_frames"])
+        self.subsampling = int(meta["subsampling"])
+        self.chunk_size = int(meta["chunk_size"])
+        self.feat_cache_frames = int(meta["feat_cache_frames"])
+        # inputs other than the chunk are the state, returned after the logits
+        self.state_shapes = {
+            i.name: [1 if isinstance(d, str) else d for d in i.shape]
+            for i in self.session.get_inputs()
+            if i.name not in ("feats", "chunk_lengths")
+        }
+
+        self.opts = knf.MfccOptions()
+        # See https://github.com/Tele-AI/TeleSpeech-ASR/blob/master/mfcc_hires.conf
+        self.opts.frame_opts.dither = 0
+        self.opts.num_ceps = 40
+        self.opts.use_energy = False
+        self.opts.mel_opts.num_bins = 40
+        self.opts.mel_opts.low_freq = 40
+        self.opts.mel_opts.high_freq = -200
+        self.eps = 1e-5
+        self.frame_shift = get_frame_shift()
+        self.reset()
+
+    def reset(self):
+        """Start a new stream."""
+        self.mfcc = knf.OnlineMfcc(self.opts)
+        self.num_read = 0
+        self.count = 0
+        self.sum = 0.0
+        self.sum_sq = 0.0
+        self.pending = np.zeros((0, self.opts.num_ceps), dtype=np.float32)
+        self.state = None
+        self.emissions: List[np.ndarray] = []
+
+    def normalize(self, frames: np.ndarray) -> np.ndarray:
+        """CMVN with the statistics of all frames up to these ones."""
+        self.count += frames.shape[0]
+        self.sum = self.sum + frames.sum(axis=0, dtype=np.float64)
+        self.sum_sq = self.sum_sq + np.square(frames, dtype=np.float64).sum(axis=0)
+        mean = self.sum / self.count
+        var = (self.sum_sq - self.count * mean**2) / max(self.count - 1, 1)
+        std = np.sqrt(np.clip(var, 0, None))
+        return ((frames - mean) / (std + self.eps)).astype(np.float32)
+
+    def run_chunk(self, feats: np.ndarray, num_valid: int = None) -> np.ndarray:
+        """T' x V logits of one chunk, of its ``num_valid`` first frames if set."""
+        if self.state is None:
+            # the first frames only fill the cache of the conv extractor
+            self.state = {
+                name: np.zeros(
+                    shape, dtype=np.int64 if name == "num_frames" else np.float32
+                )
+                for name, shape in self.state_shapes.items()
+            }
+            self.state["feat_cache"] = feats[None, : self.feat_cache_frames]
+            feats = feats[self.feat_cache_frames :]
+        num_valid = self.chunk_size if num_valid is None else num_valid
+        logits, *state = self.session.run(
+            None,
+            {
+                "feats": feats[None],
+                "chunk_lengths": np.array([num_valid], dtype=np.int64),
+                **self.state,
+            },
+        )
+        self.state = dict(zip(self.state_shapes, state))
+        return logits[0, :num_valid]
+
+    def accept_waveform(
+        self, samples: np.ndarray, sample_rate: int = 16000
+    ) -> List[np.ndarray]:
+        """Push float samples in [-1, 1], return the T x V logits of new chunks."""
+        self.mfcc.accept_waveform(sample_rate, samples * 32768)
+        return self.process(final=False)
+
+    def input_finished(self) -> List[np.ndarray]:
+        """Flush the stream, return the logits of the last chunk."""
+        self.mfcc.input_finished()
+        return self.process(final=True)
+
+    def process(self, final: bool) -> List[np.ndarray]:
+        new_frames = [
+            self.mfcc.get_frame(i)
+            for i in range(self.num_read, self.mfcc.num_frames_ready)
+        ]
+        self.num_read = self.mfcc.num_frames_ready
+        if new_frames:
+            frames = self.normalize(np.stack(new_frames).astype(np.float32))
+            self.pending = np.concatenate([self.pending, frames])
+
+        outputs = []
+        while True:
+            needed = self.chunk_frames
+            if self.state is None:
+                needed += self.feat_cache_frames
+            if self.pending.shape[0] >= needed:
+                chunk, self.pending = self.pending[:needed], self.pending[needed:]
+                outputs.append(self.run_chunk(chunk))
+            elif final and self.pending.shape[0] > 0:
+                # zero padded last chunk, only its valid frames are kept and
+                # seen by the attention and the positional convs
+                valid = self.pending.shape[0]
+                if self.state is not None:
+                    valid += self.feat_cache_frames
+                receptive_field = self.feat_cache_frames + self.subsampling
+                num_valid = max((valid - receptive_field) // self.subsampling + 1, 0)
+                chunk = np.zeros((needed, self.pending.shape[1]), dtype=np.float32)
+                chunk[: self.pending.shape[0]] = self.pending
+                self.pending = self.pending[:0]
+                outputs.append(self.run_chunk(chunk, num_valid))
+            else:
+                break
+        self.emissions.extend(outputs)
+        return outputs
+
+    def get_result(self) -> str:
+        """Greedy search over the logits of the stream so far."""
+        if not self.emissions:
+            return ""
+        hyp = ctc_greedy_search(np.concatenate(self.emissions), self.frame_shift)
+        return "".join(self.id2vocab.get(token, "") for token in hyp["tokens"])
+
+    def infer(self, audio_path: str, step_s: float = 0.1) -> str:
+        """Stream an audio file ``step_s`` seconds at a time, logging partial results."""
+        samples, sample_rate = sf.read(audio_path, always_2d=True, dtype="float32")
+        samples = np.ascontiguousarray(samples[:, 0])
+        if sample_rate != 16000:
+            import librosa
+
+            samples = librosa.resample(samples, orig_sr=sample_rate, target_sr=16000)
+            sample_rate = 16000
+
+        self.reset()
+        step = int(step_s * sample_rate)
+        for start in range(0, len(samples), step):
+            if self.accept_waveform(samples[start : start + step], sample_rate):
+                logging.info(f"Partial: {self.get_result()}")
+        self.input_finished()
+        return self.get_result()
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser()
+    args.add_argument("--model_path", type=str, required=True)
+    args.add_argument("--audio_path", type=str, required=True)
+    args.add_argument("--vocab_path", type=str, default=None)
+    args.add_argument("--num_threads", type=int, default=4)
+    args.add_argument(
+        "--step_s",
+        type=float,
+        default=0.1,
+        help="seconds of audio pushed at a time, to simulate a live stream",
+    )
+
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    args = args.parse_args()
+    session = StreamingAsrSession(
+        args.model_path, args.vocab_path, intra_op_num_threads=args.num_threads
+    )
+    start_time = time.time()
+    result = session.infer(args.audio_path, step_s=args.step_s)
+    logging.info(f"Inference time: {time.time() - start_time:.4}s")
+    logging.info(result)
@@ -0,0 +1,15 @@
+# -*- coding:utf-8 -*-
+# @FileName  :utils.py
+# @Time      :2024/8/6 14:30
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import os
+
+
+def read_rss() -> int:
+    """Resident memory of this process in bytes, 0 where /proc is missing."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
@@ -0,0 +1,172 @@
+# -*- coding:utf-8 -*-
+# @FileName  :benchmark.py
+# @Time      :2024/7/23 14:20
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import time
+from typing import Dict, List
+
+import soundfile as sf
+import torch
+
+from telespeechasr.decoding.metrics import compute_cer, load_references
+
+# name -> InferenceProcessor arguments of every benchmarked configuration
+CONFIGS = {
+    "fp32": {},
+    "bf16": {"dtype": "bfloat16"},
+    "int8": {"dtype": "int8"},
+}
+
+
+def run_config(
+    name: str,
+    model_path: str,
+    audio_paths: List[str],
+    batch_size: int = 1,
+    device: str = "cpu",
+    num_threads: int = 0,
+) -> Dict:
+    """Decode all audio files with one configuration, in a fresh process.
+
+    Returns the hypotheses keyed by audio basename, the model load time, the
+    decoding time (after one warm-up batch) and the peak RSS of the process.
+    """
+    from telespeechasr.torch.infer import InferenceProcessor
+
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+
+    start_time = time.time()
+    processor = InferenceProcessor(model_path, device=device, **CONFIGS[name])
+    load_s = time.time() - start_time
+
+    processor.infer_batch(audio_paths[:batch_size], device=device)
+
+    hypotheses = {}
+    start_time = time.time()
+    for i in range(0, len(audio_paths), batch_size):
+        batch = audio_paths[i : i + batch_size]
+        results = processor.infer_batch(batch, device=device)
+        for audio_path, result in zip(batch, results):
+            hypotheses[os.path.splitext(os.path.basename(audio_path))[0]] = result
+    decode_s = time.time() - start_time
+
+    return {
+        "config": name,
+        "hypotheses": hypotheses,
+        "load_s": load_s,
+        "decode_s": decode_s,
+        # kilobytes on linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def benchmark(
+    model_path: str,
+    audio_paths: List[str],
+    references: Dict[str, str],
+    configs: List[str],
+    batch_size: int = 1,
+    device: str = "cpu",
+    num_threads: int = 0,
+) -> List[Dict]:
+    """Compare configurations on speed, memory and CER.
+
+    Every configuration runs in its own process so that the peak RSS is its
+    own.  The first configuration is the baseline of ``cer_delta`` and of
+    ``diff_to_baseline``, the CER of the hypotheses against the baseline ones.
+    """
+    # sort by duration so that batches have little padding
+    audio_paths = sorted(audio_paths, key=lambda path: sf.info(path).frames)
+    audio_s = sum(sf.info(path).duration for path in audio_paths)
+
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name in configs:
+        logging.info(f"Running {name}")
+        with context.Pool(1) as pool:
+            result = pool.apply(
+                run_config,
+                (name, model_path, audio_paths, batch_size, device, num_threads),
+            )
+        result["rtf"] = result["decode_s"] / audio_s
+        result.update(compute_cer(references, result["hypotheses"]))
+        results.append(result)
+
+    baseline = results[0]
+    for result in results:
+        result["cer_delta"] = result["cer"] - baseline["cer"]
+        result["diff_to_baseline"] = compute_cer(
+            baseline["hypotheses"], result["hypotheses"]
+        )["cer"]
+        logging.info(
+            f"{result['config']:>8}: load {result['load_s']:.2f}s, "
+            f"RTF {result['rtf']:.4f}, peak RSS {result['peak_rss_mb']:.0f}MB, "
+            f"CER {result['cer'] * 100:.2f}% ({result['cer_delta'] * 100:+.2f}), "
+            f"differs from {baseline['config']} by {result['diff_to_baseline'] * 100:.2f}%"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(
+        description="compare speed, peak memory and CER of torch inference "
+        "configurations (fp32, bf16, int8) on a reference set"
+    )
+    args.add_argument("--model_path", type=str, required=True)
+    args.add_argument(
+        "--audio_path", type=str, required=True, help="directory of wav files"
+    )
+    args.add_argument(
+        "--annotation_path",
+        type=str,
+        required=True,
+        help="directory of txt annotations named after the audio files, or a "
+        "kaldi style text file",
+    )
+    args.add_argument(
+        "--configs",
+        type=str,
+        nargs="+",
+        default=list(CONFIGS),
+        choices=list(CONFIGS),
+        help="configurations to compare, the first one is the baseline",
+    )
+    args.add_argument("--batch_size", type=int, default=1)
+    args.add_argument("--device", type=str, default="cpu", choices=["cpu", "cuda"])
+    args.add_argument("--num_threads", type=int, default=0)
+    args.add_argument("--max_utts", type=int, default=0)
+    args.add_argument(
+        "--output", type=str, default=None, help="json file of the results"
+    )
+
+    args = args.parse_args()
+
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    audio_paths = sorted(glob.glob(os.path.join(args.audio_path, "*.wav")))
+    if args.max_utts > 0:
+        audio_paths = audio_paths[: args.max_utts]
+    references = load_references(args.annotation_path)
+
+    results = benchmark(
+        args.model_path,
+        audio_paths,
+        references,
+        args.configs,
+        batch_size=args.batch_size,
+        device=args.device,
+        num_threads=args.num_threads,
+    )
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,231 @@
+# -*- coding:utf-8 -*-
+# @FileName  :early_exit_benchmark.py
+# @Time      :2024/8/8 11:10
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import argparse
+import glob
+import json
+import logging
+import os
+import time
+from collections import Counter
+from typing import Dict, List, Sequence
+
+import torch
+
+from telespeechasr.decoding.metrics import compute_cer, load_references
+from telespeechasr.torch.utils.utils import read_wave
+
+
+def synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def decode(processor, emissions: torch.Tensor) -> str:
+    """Greedy text of 1 x T' x V emissions (blank weight already applied)."""
+    emissions = emissions.float().cpu()
+    return processor.postprocess_sentence(
+        processor.viterbi_decode(emissions)[0][0]["tokens"]
+    )
+
+
+@torch.no_grad()
+def measure_exit_points(
+    processor,
+    audio_paths: List[str],
+    references: Dict[str, str],
+    exit_layers: Sequence[int],
+    device: str = "cpu",
+) -> List[Dict]:
+    """CER and latency of the model stopped after each of ``exit_layers``.
+
+    Every utterance runs once through the blocks (``iter_layers``) and
+    ``proj`` is applied at every exit point, the latency of an exit point is
+    the time of the blocks up to it plus its own ``proj``, without the
+    features and the decoding.  The last layer is always measured, it is the
+    baseline of ``speedup`` and ``cer_delta``.
+    """
+    device = torch.device(device)
+    model = processor.model
+    exits = sorted({layer for layer in exit_layers if 0 < layer < model.num_layers})
+    exits.append(model.num_layers)
+
+    features = []
+    for audio_path in audio_paths:
+        feats, lengths = processor.get_features([read_wave(audio_path)])
+        features.append((feats.to(device), lengths.to(device)))
+    # warm up
+    with processor.autocast(device):
+        model(*features[0])
+
+    hypotheses = {layer: {} for layer in exits}
+    latencies = Counter()
+    for audio_path, (feats, lengths) in zip(audio_paths, features):
+        key = os.path.splitext(os.path.basename(audio_path))[0]
+        model_s = 0.0
+        with processor.autocast(device):
+            start = time.perf_counter()
+            for layer, x, out_lengths in model.iter_layers(feats, lengths):
+                synchronize(device)
+                model_s += time.perf_counter() - start
+                if layer in exits:
+                    start = time.perf_counter()
+                    emissions = model.proj(x)
+                    synchronize(device)
+                    latencies[layer] += model_s + time.perf_counter() - start
+                    hypotheses[layer][key] = decode(
+                        processor, processor.get_logits(emissions.float())
+                    )
+                start = time.perf_counter()
+
+    results = []
+    for layer in exits:
+        result = {
+            "layer": layer,
+            "latency_ms": latencies[layer] / len(audio_paths) * 1000,
+            **compute_cer(references, hypotheses[layer]),
+        }
+        results.append(result)
+    baseline = results[-1]
+    for result in results:
+        result["speedup"] = baseline["latency_ms"] / result["latency_ms"]
+        result["cer_delta"] = result["cer"] - baseline["cer"]
+        logging.info(
+            f"layer {result['layer']:>2}: {result['latency_ms']:.1f}ms "
+            f"({result['speedup']:.2f}x), CER {result['cer'] * 100:.2f}% "
+            f"({result['cer_delta'] * 100:+.2f})"
+        )
+    return results
+
+
+@torch.no_grad()
+def measure_adaptive(
+    processor,
+    audio_paths: List[str],
+    references: Dict[str, str],
+    exit_layers: Sequence[int],
+    thresholds: Sequence[float],
+    device: str = "cpu",
+) -> List[Dict]:
+    """CER, latency and exit layers of the adaptive early exit at every threshold."""
+    device = torch.device(device)
+    features = []
+    for audio_path in audio_paths:
+        feats, lengths = processor.get_features([read_wave(audio_path)])
+        features.append((feats.to(device), lengths.to(device)))
+
+    results = []
+    saved = processor.exit_layers, processor.exit_threshold
+    processor.exit_layers = list(exit_layers)
+    try:
+        for threshold in thresholds:
+            processor.exit_threshold = threshold
+            processor.forward(*features[0])
+            hypotheses = {}
+            exits = Counter()
+            model_s = 0.0
+            for audio_path, (feats, lengths) in zip(audio_paths, features):
+                start = time.perf_counter()
+                emissions, _ = processor.forward(feats, lengths)
+                synchronize(device)
+                model_s += time.perf_counter() - start
+                key = os.path.splitext(os.path.basename(audio_path))[0]
+                hypotheses[key] = decode(processor, emissions)
+                exits[processor.exit_layer] += 1
+            result = {
+                "threshold": threshold,
+                "latency_ms": model_s / len(audio_paths) * 1000,
+                "mean_exit_layer": sum(k * v for k, v in exits.items())
+                / len(audio_paths),
+                "exit_layers": dict(sorted(exits.items())),
+                **compute_cer(references, hypotheses),
+            }
+            logging.info(
+                f"threshold {threshold:.2f}: {result['latency_ms']:.1f}ms, "
+                f"CER {result['cer'] * 100:.2f}%, exits {result['exit_layers']}"
+            )
+            results.append(result)
+    finally:
+        processor.exit_layers, processor.exit_threshold = saved
+    return results
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(
+        description="CER against latency of the model stopped after every "
+        "exit layer, and of the adaptive early exit, on a reference set"
+    )
+    args.add_argument("--model_path", type=str, required=True)
+    args.add_argument(
+        "--audio_path", type=str, required=True, help="directory of wav files"
+    )
+    args.add_argument(
+        "--annotation_path",
+        type=str,
+        required=True,
+        help="directory of txt annotations named after the audio files, or a "
+        "kaldi style text file",
+    )
+    args.add_argument(
+        "--exit_layers",
+        type=int,
+        nargs="+",
+        default=[8, 12, 16, 20],
+        help="layers after which the output layer is applied, 1-8 are the "
+        "prenet blocks and 9-24 the model blocks, the last one is always added",
+    )
+    args.add_argument(
+        "--thresholds",
+        type=float,
+        nargs="*",
+        default=[0.8, 0.9, 0.95],
+        help="mean max posterior thresholds of the adaptive early exit",
+    )
+    args.add_argument("--vocab_path", type=str, default=None)
+    args.add_argument("--device", type=str, default="cpu", choices=["cpu", "cuda"])
+    args.add_argument(
+        "--dtype",
+        type=str,
+        default="float32",
+        choices=["float32", "bfloat16", "int8"],
+    )
+    args.add_argument("--num_threads", type=int, default=0)
+    args.add_argument("--max_utts", type=int, default=0)
+    args.add_argument(
+        "--output", type=str, default=None, help="json file of the results"
+    )
+    args = args.parse_args()
+
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    from telespeechasr.torch.infer import InferenceProcessor
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    audio_paths = sorted(glob.glob(os.path.join(args.audio_path, "*.wav")))
+    if args.max_utts > 0:
+        audio_paths = audio_paths[: args.max_utts]
+    references = load_references(args.annotation_path)
+
+    processor = InferenceProcessor(
+        args.model_path, args.vocab_path, device=args.device, dtype=args.dtype
+    )
+    report = {
+        "exit_points": measure_exit_points(
+            processor, audio_paths, references, args.exit_layers, args.device
+        ),
+        "adaptive": measure_adaptive(
+            processor,
+            audio_paths,
+            references,
+            args.exit_layers,
+            args.thresholds,
+            args.device,
+        ),
+    }
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
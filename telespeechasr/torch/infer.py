@@ -8,17 +8,62 @@ import json
 import logging
 import os
 import time
-from typing import Dict, List
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import kaldifeat
+import numpy as np
+import soundfile as sf
 import torch
+from torch.nn.utils.rnn import pad_sequence
 
-from telespeechasr.torch.model.data2vec_multi_model import Data2VecMultiModel
-from telespeechasr.torch.utils.utils import load_checkpoint, read_wave
+from telespeechasr.decoding.timestamps import ctc_greedy_search, get_frame_shift
+from telespeechasr.torch.model.data2vec_ctc_inference import (
+    Data2VecCtcInference,
+    masked_mean,
+)
+from telespeechasr.torch.utils.compile import (
+    DEFAULT_BUCKETS,
+    compile_model,
+    pad_to_bucket,
+    report_speedup,
+)
+from telespeechasr.torch.utils.precision import convert_to_bf16
+from telespeechasr.torch.utils.quantization import load_int8_checkpoint
+from telespeechasr.torch.utils.utils import load_model, read_wave
 
 
 class InferenceProcessor:
-    def __init__(self, model_path, vocab_path=None, device: str = "cuda"):
+    def __init__(
+        self,
+        model_path,
+        vocab_path=None,
+        device: str = "cuda",
+        compile: bool = False,
+        buckets: Sequence[int] = DEFAULT_BUCKETS,
+        compile_cache_dir: str = None,
+        dtype: str = "float32",
+        num_layers: int = None,
+        exit_layers: Sequence[int] = None,
+        exit_threshold: float = 0.9,
+    ):
+        """
+        Args:
+            compile: run the model through ``torch.compile``. Inputs are
+                padded to one of ``buckets`` (in mfcc frames) so that only a
+                few shapes get compiled.
+            compile_cache_dir: directory keeping the compiled graphs for the
+                next processes.
+            dtype: float32, bfloat16 to store the weights in bf16 and run
+                under autocast (see ``convert_to_bf16``) or int8 for dynamic
+                int8 quantisation on cpu (see ``quantize_int8``). With int8
+                the model may also be an int8 checkpoint written by
+                telespeechasr/torch/utils/quantization.py.
+            num_layers: run only the first blocks (24 with the prenet), the
+                others are dropped, see ``Data2VecCtcInference.truncate``.
+            exit_layers: stop at the first of these layers whose mean max
+                CTC posterior reaches ``exit_threshold``, see
+                ``Data2VecCtcInference.forward_early_exit``.
+        """
         self.model_path = model_path
         self.vocab_path = vocab_path or os.path.join(
             os.path.dirname(__file__), "data", "vocab.json"
@@ -30,10 +75,27 @@ class InferenceProcessor:
             for k, v in self.vocab2id.items():
                 self.id2vocab[v] = k
         logging.info(f"Loading model from {self.model_path}")
-        self.model = Data2VecMultiModel()
-        load_checkpoint(model_path, self.model)
+        assert dtype in ("float32", "bfloat16", "int8"), f"unsupported dtype {dtype}"
+        self.dtype = dtype
+        if dtype == "int8":
+            assert device == "cpu", "int8 dynamic quantisation only runs on cpu"
+            self.model = load_int8_checkpoint(model_path, Data2VecCtcInference())
+        else:
+            # no random init, a safetensors checkpoint is memory mapped
+            self.model = load_model(model_path, Data2VecCtcInference)
         self.model.eval()
+        if dtype == "bfloat16":
+            self.model = convert_to_bf16(self.model)
         self.model = self.model.to(device)
+        if num_layers is not None:
+            self.model.truncate(num_layers)
+        assert not (
+            compile and exit_layers
+        ), "early exit does not run the compiled model"
+        self.exit_layers = exit_layers
+        self.exit_threshold = exit_threshold
+        # layer of the last forward, the last one without early exit
+        self.exit_layer = self.model.num_layers
 
         opts = kaldifeat.MfccOptions()
         opts.device = torch.device("cpu")
@@ -48,6 +110,12 @@ class InferenceProcessor:
 
         self.blank_weight = 0.0
         self.blank_mode = "add"
+        self.frame_shift = get_frame_shift(self.model.feature_enc_layers)
+
+        self.buckets = buckets
+        self.compiled_model = None
+        if compile:
+            self.compiled_model = compile_model(self.model, compile_cache_dir)
 
     def postprocess(self, feats):
         assert feats.dim() == 2, feats.dim()
@@ -70,12 +138,10 @@ class InferenceProcessor:
     def viterbi_decode(
         self,
         emissions: torch.FloatTensor,
-    ) -> List[List[Dict[str, torch.LongTensor]]]:
-        def get_pred(e):
-            toks = e.argmax(dim=-1).unique_consecutive()
-            return toks[toks != 0].cpu().numpy()
-
-        return [[{"tokens": get_pred(x), "score": 0}] for x in emissions]
+    ) -> List[List[Dict]]:
+        return [
+            [ctc_greedy_search(x.cpu().numpy(), self.frame_shift)] for x in emissions
+        ]
 
     def postprocess_sentence(self, tokens):
         text = ""
@@ -85,6 +151,87 @@ class InferenceProcessor:
                 text += token
         return text
 
+    def postprocess_batch(self, feats, lengths):
+        """Per-utterance CMVN of B x T x C padded features, same as ``postprocess``.
+
+        Statistics only cover the valid frames and the padded frames are set to
+        zero afterwards.
+        """
+        mask = (
+            torch.arange(feats.size(1), device=feats.device)[None, :] < lengths[:, None]
+        ).unsqueeze(-1)
+        n = lengths.to(feats.dtype)[:, None, None]
+        feats = feats * mask
+        m = feats.sum(dim=1, keepdim=True) / n
+        # unbiased, as torch.std
+        var = ((feats - m) * mask).pow(2).sum(dim=1, keepdim=True) / (n - 1)
+        feats = (feats - m) / (var.sqrt() + self.eps)
+        return feats * mask
+
+    def get_features(
+        self, waves: List[torch.Tensor]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Compute the normalised mfcc of a list of 1-D waves in one call.
+
+        Returns:
+            B x T x C zero padded features and the number of frames of each wave.
+        """
+        feats = self.mfcc([wave.cpu() for wave in waves])
+        lengths = torch.tensor([f.size(0) for f in feats], dtype=torch.long)
+        feats = pad_sequence(feats, batch_first=True)
+        feats = self.postprocess_batch(feats, lengths)
+        return feats, lengths
+
+    def autocast(self, device: torch.device):
+        return torch.autocast(
+            device.type, dtype=torch.bfloat16, enabled=self.dtype == "bfloat16"
+        )
+
+    @torch.no_grad()
+    def forward(
+        self, feats: torch.Tensor, lengths: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Run the model on B x T x C features.
+
+        Returns:
+            B x T' x V emissions and the number of valid output frames of
+            every utterance.
+        """
+        if self.exit_layers:
+            with self.autocast(feats.device):
+                emissions, lengths, self.exit_layer = self.model.forward_early_exit(
+                    feats, lengths, self.exit_layers, self.exit_threshold
+                )
+            return self.get_logits(emissions.float()), lengths
+        if self.compiled_model is None:
+            with self.autocast(feats.device):
+                emissions, lengths = self.model(feats, lengths)
+            return self.get_logits(emissions.float()), lengths
+
+        if lengths is None:
+            lengths = torch.full(
+                (feats.size(0),), feats.size(1), dtype=torch.long, device=feats.device
+            )
+        with self.autocast(feats.device):
+            emissions, lengths = self.compiled_model(
+                pad_to_bucket(feats, self.buckets), lengths
+            )
+        # drop the frames that only exist because of the bucket padding
+        emissions = emissions[:, : int(lengths.max())]
+        return self.get_logits(emissions.float()), lengths
+
+    def report_speedup(self, batch_size: int = 1, device="cuda") -> List[Dict]:
+        """Compare the compiled and the eager model at every bucket size."""
+        assert self.compiled_model is not None, "compile is not enabled"
+        with self.autocast(torch.device(device)):
+            return report_speedup(
+                self.model,
+                self.compiled_model,
+                self.buckets,
+                batch_size=batch_size,
+                device=device,
+            )
+
     @torch.no_grad()
     def infer(self, audio_path, device="cuda"):
         logging.info(f"Decoding {audio_path}")
@@ -94,60 +241,165 @@ class InferenceProcessor:
         feats = self.mfcc(wave.cpu())
         feats = self.postprocess(feats).unsqueeze(0).to(device)
 
-        extractor_out = self.model.modality_encoders(
-            feats,
-            torch.zeros(feats.shape[:2], dtype=torch.bool),
-            False,
-            remove_masked=False,
-            clone_batch=1,
-            mask_seeds=None,
-            precomputed_mask=None,
-        )
+        emissions, _ = self.forward(feats)
+        emissions = emissions.float().cpu().contiguous()
+        hypos = self.viterbi_decode(emissions)
 
-        x = extractor_out["x"]
-        encoder_mask = extractor_out["encoder_mask"]
-        masked_padding_mask = extractor_out["padding_mask"]
-        masked_alibi_bias = extractor_out.get("alibi_bias", None)
-        alibi_scale = extractor_out.get("alibi_scale", None)
-
-        layer_results = []
-        for i, blk in enumerate(self.model.blocks):
-            ab = masked_alibi_bias
-            if ab is not None and alibi_scale is not None:
-                scale = (
-                    alibi_scale[i]
-                    if alibi_scale.size(0) > 1
-                    else alibi_scale.squeeze(0)
-                )
-                ab = ab * scale.type_as(ab)
+        result = self.postprocess_sentence(hypos[0][0]["tokens"])
+        logging.info(f"Inference time: {time.time() - start_time}s")
+        return result
+
+    @torch.no_grad()
+    def infer_batch(self, audio_paths: List[str], device="cuda") -> List[str]:
+        """Recognise several audio files as one padded batch.
+
+        The results are the same as calling ``infer`` on each file.
+        """
+        device = torch.device(device)
+        waves = [read_wave(audio_path) for audio_path in audio_paths]
+        feats, lengths = self.get_features(waves)
 
-            x, lr = blk(
-                x,
-                padding_mask=masked_padding_mask,
-                alibi_bias=ab,
+        emissions, lengths = self.forward(feats.to(device), lengths.to(device))
+        emissions = emissions.float().cpu()
+        return [
+            self.postprocess_sentence(hypos[0]["tokens"])
+            for hypos in self.viterbi_decode(
+                [e[:n] for e, n in zip(emissions, lengths.tolist())]
             )
+        ]
 
-            layer_results.append((x, lr))
+    @torch.no_grad()
+    def infer_with_layers(
+        self,
+        audio_paths: List[str],
+        layers: List[int],
+        pooled: bool = True,
+        device="cuda",
+    ) -> List[Dict]:
+        """Recognise audio files and return intermediate layer outputs of the same pass.
 
-        x.transpose_(0, 1)
-        model_output = self.model.proj(x)
-        emissions = self.get_logits(model_output)
-        emissions = emissions.transpose(0, 1).float().cpu().contiguous()
-        hypos = self.viterbi_decode(emissions)
+        Args:
+            audio_paths: audio files decoded as one padded batch.
+            layers: layer indices, see ``Data2VecCtcInference.extract_features``.
+            pooled: average the frames of every utterance, otherwise return
+                the frame level outputs.
 
-        result = self.postprocess_sentence(hypos[0][0]["tokens"])
-        logging.info(f"Inference time: {time.time() - start_time}s")
-        return result
+        Returns:
+            One dict per file with the recognised ``text`` and ``layers``, which
+            maps every requested layer to a D (pooled) or T' x D array.
+        """
+        device = torch.device(device)
+        waves = [read_wave(audio_path) for audio_path in audio_paths]
+        feats, lengths = self.get_features(waves)
+
+        with self.autocast(device):
+            x, lengths, layer_results = self.model.extract_features(
+                feats.to(device), lengths.to(device), layers
+            )
+            emissions = self.model.proj(x)
+        emissions = self.get_logits(emissions.float()).cpu()
+        if pooled:
+            layer_results = [masked_mean(h, lengths) for h in layer_results]
+        layer_results = [h.float().cpu().numpy() for h in layer_results]
+
+        results = []
+        for i, n in enumerate(lengths.tolist()):
+            hypo = self.viterbi_decode([emissions[i, :n]])[0][0]
+            results.append(
+                {
+                    "text": self.postprocess_sentence(hypo["tokens"]),
+                    "layers": {
+                        layer: h[i] if pooled else h[i, :n]
+                        for layer, h in zip(layers, layer_results)
+                    },
+                }
+            )
+        return results
 
 
 if __name__ == "__main__":
     args = argparse.ArgumentParser()
     args.add_argument("--model_path", type=str, required=True)
-    args.add_argument("--audio_path", type=str, required=True)
+    args.add_argument("--audio_path", type=str, nargs="+", required=True)
     args.add_argument("--vocab_path", type=str, default=None)
+    args.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="number of audio files decoded together, files are sorted by "
+        "duration so that each batch has little padding",
+    )
     args.add_argument(
         "--device", type=str, default="cuda", choices=["cpu", "cuda", "mps"]
     )
+    args.add_argument(
+        "--dtype",
+        type=str,
+        default="float32",
+        choices=["float32", "bfloat16", "int8"],
+        help="bfloat16 stores the weights in bf16 and runs under autocast, "
+        "softmax, LayerNorm and the ALiBi bias stay in fp32. int8 quantises "
+        "the Linear layers of the blocks and the output projection (cpu only)",
+    )
+    args.add_argument(
+        "--num_layers",
+        type=int,
+        default=None,
+        help="run only the first blocks before the output layer, 1-8 are the "
+        "prenet blocks and 9-24 the model blocks",
+    )
+    args.add_argument(
+        "--exit_layers",
+        type=int,
+        nargs="*",
+        default=None,
+        help="early exit: apply the output layer after these layers and stop "
+        "at the first one whose mean max posterior reaches --exit_threshold",
+    )
+    args.add_argument("--exit_threshold", type=float, default=0.9)
+    args.add_argument(
+        "--compile",
+        action="store_true",
+        help="run the model through torch.compile, inputs are padded to "
+        "the --buckets sizes",
+    )
+    args.add_argument(
+        "--buckets",
+        type=int,
+        nargs="+",
+        default=list(DEFAULT_BUCKETS),
+        help="input sizes in mfcc frames (10ms) of the compiled model",
+    )
+    args.add_argument(
+        "--compile_cache_dir",
+        type=str,
+        default=None,
+        help="directory caching the compiled model across runs",
+    )
+    args.add_argument(
+        "--report_speedup",
+        action="store_true",
+        help="time the compiled model against eager at every bucket",
+    )
+    args.add_argument(
+        "--layers",
+        type=int,
+        nargs="*",
+        default=None,
+        help="also save the outputs of these layers, 0 is the input of the "
+        "first block, 1-8 the prenet blocks and 9-24 the model blocks",
+    )
+    args.add_argument(
+        "--frame_level",
+        action="store_true",
+        help="save the frame level layer outputs instead of their average",
+    )
+    args.add_argument(
+        "--embedding_dir",
+        type=str,
+        default=None,
+        help="directory of the layer outputs, one npz file per audio",
+    )
 
     args = args.parse_args()
 
@@ -155,7 +407,45 @@ if __name__ == "__main__":
     logging.basicConfig(format=formatter, level=logging.INFO)
 
     inference_processor = InferenceProcessor(
-        args.model_path, args.vocab_path, device=args.device
+        args.model_path,
+        args.vocab_path,
+        device=args.device,
+        compile=args.compile,
+        buckets=args.buckets,
+        compile_cache_dir=args.compile_cache_dir,
+        dtype=args.dtype,
+        num_layers=args.num_layers,
+        exit_layers=args.exit_layers,
+        exit_threshold=args.exit_threshold,
     )
-    asr_result = inference_processor.infer(args.audio_path, device=args.device)
-    logging.info(asr_result)
+    if args.report_speedup:
+        inference_processor.report_speedup(args.batch_size, device=args.device)
+    if args.layers:
+        assert args.embedding_dir is not None, "--layers needs --embedding_dir"
+        os.makedirs(args.embedding_dir, exist_ok=True)
+        audio_paths = sorted(args.audio_path, key=lambda path: sf.info(path).frames)
+        for i in range(0, len(audio_paths), args.batch_size):
+            batch = audio_paths[i : i + args.batch_size]
+            results = inference_processor.infer_with_layers(
+                batch, args.layers, not args.frame_level, device=args.device
+            )
+            for audio_path, result in zip(batch, results):
+                logging.info(f"{audio_path}: {result['text']}")
+                name = os.path.splitext(os.path.basename(audio_path))[0]
+                np.savez(
+                    os.path.join(args.embedding_dir, f"{name}.npz"),
+                    **{f"layer_{k}": v for k, v in result["layers"].items()},
+                )
+    elif args.batch_size == 1:
+        for audio_path in args.audio_path:
+            asr_result = inference_processor.infer(audio_path, device=args.device)
+            logging.info(asr_result)
+    else:
+        audio_paths = sorted(args.audio_path, key=lambda path: sf.info(path).frames)
+        start_time = time.time()
+        for i in range(0, len(audio_paths), args.batch_size):
+            batch = audio_paths[i : i + args.batch_size]
+            results = inference_processor.infer_batch(batch, device=args.device)
+            for audio_path, asr_result in zip(batch, results):
+                logging.info(f"{audio_path}: {asr_result}")
+        logging.info(f"Inference time: {time.time() - start_time}s")
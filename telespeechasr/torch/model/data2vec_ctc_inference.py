@@ -0,0 +1,478 @@
+# -*- coding:utf-8 -*-
+# @FileName  :data2vec_ctc_inference.py
+# @Time      :2024/7/19 10:20
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import re
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from telespeechasr.torch.modules.attention import Mlp
+from telespeechasr.torch.modules.encoder import ConvFeatureExtractionModel
+from telespeechasr.torch.modules.modality_specific_encoder import get_alibi
+from telespeechasr.torch.modules.transpose_last import TransposeLast
+from telespeechasr.torch.utils.utils import assign_state_dict
+
+# Data2VecMultiModel key prefix -> Data2VecCtcInference key prefix
+MAPPING = {
+    "modality_encoders.alibi_scale": "alibi_scale",
+    "modality_encoders.local_encoder": "local_encoder",
+    "modality_encoders.project_features": "project_features",
+    "modality_encoders.context_encoder.norm": "prenet_norm",
+}
+# weights only used in pre-training
+UNUSED_WEIGHTS = ["_ema", "modality_encoders.decoder", "modality_encoders.extra_tokens"]
+
+
+def convert_state_dict(
+    state_dict: Dict[str, torch.Tensor], prenet_depth: int = 8
+) -> Dict[str, torch.Tensor]:
+    """Rename the keys of a ``Data2VecMultiModel`` state dict for ``Data2VecCtcInference``.
+
+    The prenet blocks and the blocks of the model are merged into one list, and
+    the positional conv layers drop the modules without weights.  A state dict
+    that is already converted is returned unchanged.
+    """
+    if not any(k.startswith("modality_encoders.") for k in state_dict):
+        return state_dict
+
+    new_state_dict = {}
+    for name, value in state_dict.items():
+        if any(name.startswith(w) for w in UNUSED_WEIGHTS):
+            continue
+
+        for key, mapped_key in MAPPING.items():
+            if name.startswith(key):
+                name = mapped_key + name[len(key) :]
+                break
+        else:
+            name = re.sub(
+                r"^modality_encoders\.relative_positional_encoder\.(\d+)\.0\.",
+                lambda m: f"pos_conv.{int(m.group(1)) - 1}.conv.",
+                name,
+            )
+            # blocks of the model go after the prenet blocks
+            name = re.sub(
+                r"^blocks\.(\d+)\.",
+                lambda m: f"blocks.{int(m.group(1)) + prenet_depth}.",
+                name,
+            )
+            name = re.sub(
+                r"^modality_encoders\.context_encoder\.blocks\.", "blocks.", name
+            )
+        new_state_dict[name] = value
+    return new_state_dict
+
+
+def alibi_bias_from_slopes(
+    slopes: torch.Tensor, key_bias: torch.Tensor
+) -> torch.Tensor:
+    """ALiBi bias of the H ``slopes`` plus the B x 1 x 1 x T key padding bias."""
+    T = key_bias.size(-1)
+    positions = torch.arange(T, device=slopes.device)
+    distance = -(positions[None, :] - positions[:, None]).abs().float()
+    return slopes.view(1, -1, 1, 1) * distance[None, None] + key_bias
+
+
+@torch.jit.script_if_tracing
+def alibi_bias(
+    slopes: torch.Tensor, table: torch.Tensor, key_bias: torch.Tensor
+) -> torch.Tensor:
+    """ALiBi bias of one layer plus the B x 1 x 1 x T key padding bias.
+
+    The 1 x H x T x T ALiBi bias is sliced from ``table``, a H x M x M bias
+    baked by ``Data2VecCtcInference.bake_alibi_table``, when M >= T and
+    computed from the H ``slopes`` otherwise.  Scripted when traced, so that
+    an exported graph keeps both paths and a dynamic T.
+    """
+    T = key_bias.size(-1)
+    if table.size(-1) >= T:
+        return table[:, :T, :T].unsqueeze(0) + key_bias
+    return alibi_bias_from_slopes(slopes, key_bias)
+
+
+class PositionalConvLayer(nn.Module):
+    """One layer of the convolutional relative positional encoder, B x C x T in and out."""
+
+    def __init__(self, embed_dim: int, kernel_size: int, groups: int):
+        super().__init__()
+        self.conv = nn.Conv1d(
+            embed_dim,
+            embed_dim,
+            kernel_size=kernel_size,
+            padding=kernel_size // 2,
+            groups=groups,
+        )
+        # same as SamePad
+        self.remove = 1 if kernel_size % 2 == 0 else 0
+        self.norm = nn.LayerNorm(embed_dim, elementwise_affine=False)
+
+    def forward(self, x):
+        x = self.conv(x)
+        if self.remove > 0:
+            x = x[:, :, : -self.remove]
+        x = self.norm(x.transpose(1, 2)).transpose(1, 2)
+        return F.gelu(x)
+
+
+class InferenceAttention(nn.Module):
+    """``AltAttention`` taking one additive bias that already holds ALiBi and padding."""
+
+    def __init__(self, dim: int, num_heads: int):
+        super().__init__()
+        self.num_heads = num_heads
+        self.scale = (dim // num_heads) ** -0.5
+        self.qkv = nn.Linear(dim, dim * 3, bias=True)
+        self.proj = nn.Linear(dim, dim)
+
+    def forward(self, x, attn_bias):
+        B, N, C = x.shape
+        qkv = (
+            self.qkv(x)
+            .reshape(B, N, 3, self.num_heads, C // self.num_heads)
+            .permute(2, 0, 3, 1, 4)  # qkv x B x H x L x D
+        )
+        q, k, v = qkv[0], qkv[1], qkv[2]
+
+        attn = (q * self.scale) @ k.transpose(-2, -1)
+        # the bias is added and normalised in fp32 as in AltAttention
+        attn = (attn.float() + attn_bias).softmax(dim=-1).to(v.dtype)
+        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        return self.proj(x)
+
+
+class InferenceBlock(nn.Module):
+    """Post-LN ``AltBlock`` without dropout and drop path."""
+
+    def __init__(self, dim: int, num_heads: int, mlp_ratio: float, norm_eps: float):
+        super().__init__()
+        self.norm1 = nn.LayerNorm(dim, eps=norm_eps)
+        self.attn = InferenceAttention(dim, num_heads)
+        self.norm2 = nn.LayerNorm(dim, eps=norm_eps)
+        self.mlp = Mlp(in_features=dim, hidden_features=int(dim * mlp_ratio))
+
+    def forward(self, x, attn_bias):
+        x = self.norm1(x + self.attn(x, attn_bias))
+        return self.norm2(x + self.mlp(x))
+
+
+class Data2VecCtcInference(nn.Module):
+    """Inference-only ``Data2VecMultiModel`` with the CTC projection.
+
+    It holds the same weights (see ``convert_state_dict``, applied by
+    ``load_state_dict``) and nothing of the pre-training: no masking, no
+    batch cloning and no decoder.  The prenet blocks and the blocks of the
+    model run as one list and the ALiBi slopes, already multiplied by the
+    learnt per-head scales, are computed once when the weights are loaded.
+    ``forward`` is scriptable, traceable and exportable.
+
+    ``num_layers`` runs only the first blocks (prenet blocks included) before
+    ``proj``, see ``truncate``, and ``forward_early_exit`` stops as soon as the
+    CTC posteriors of a checkpoint layer are confident enough.
+    """
+
+    def __init__(
+        self,
+        norm_eps: float = 1e-5,
+        embed_dim: int = 1024,
+        num_heads: int = 16,
+        mlp_ratio: float = 4.0,
+        depth: int = 16,
+        prenet_depth: int = 8,
+        feature_encoder_spec: str = "[(512, 3, 2), (512, 3, 2)]",
+        input_feature_ndim: int = 40,
+        conv_pos_depth: int = 5,
+        conv_pos_width: int = 95,
+        conv_pos_groups: int = 16,
+        vocab_size: int = 7535,
+    ):
+        super().__init__()
+        self.feature_enc_layers: List[Tuple[int, int, int]] = eval(feature_encoder_spec)
+        self.prenet_depth = prenet_depth
+        self.num_heads = num_heads
+        feature_embed_dim = self.feature_enc_layers[-1][0]
+
+        self.local_encoder = ConvFeatureExtractionModel(
+            input_feature_ndim=input_feature_ndim,
+            conv_layers=self.feature_enc_layers,
+            dropout=0.0,
+            mode="layer_norm",
+            conv_bias=False,
+        )
+        self.project_features = nn.Sequential(
+            TransposeLast(),
+            nn.LayerNorm(feature_embed_dim),
+            nn.Linear(feature_embed_dim, embed_dim),
+        )
+
+        k = max(3, conv_pos_width // conv_pos_depth)
+        self.pos_conv = nn.ModuleList(
+            PositionalConvLayer(embed_dim, k, conv_pos_groups)
+            for _ in range(conv_pos_depth)
+        )
+
+        self.prenet_norm = nn.LayerNorm(embed_dim, eps=norm_eps)
+        self.blocks = nn.ModuleList(
+            InferenceBlock(embed_dim, num_heads, mlp_ratio, norm_eps)
+            for _ in range(prenet_depth + depth)
+        )
+        self.proj = nn.Linear(embed_dim, vocab_size)
+        # number of blocks run by extract_features
+        self.num_layers = prenet_depth + depth
+
+        self.alibi_scale = nn.Parameter(
+            torch.ones(1, 1, num_heads, 1, 1), requires_grad=False
+        )
+        # num_layers x num_heads slopes of the ALiBi bias
+        self.register_buffer(
+            "alibi_slopes",
+            torch.zeros(prenet_depth + depth, num_heads),
+            persistent=False,
+        )
+        # num_tables x num_heads x M x M baked ALiBi bias, num_tables is 1 when
+        # the slopes are shared, empty (M = 0) unless bake_alibi_table is called
+        self.register_buffer(
+            "alibi_table", torch.zeros(1, num_heads, 0, 0), persistent=False
+        )
+        self.shared_alibi = True
+        # compute the bias from the slopes, without the table: the If node of
+        # the scripted alibi_bias breaks the shape inference of onnxruntime's
+        # transformer optimizer (see onnx_optimize.export_fused)
+        self.alibi_from_slopes = False
+        self.update_alibi_slopes()
+
+    @torch.no_grad()
+    def update_alibi_slopes(self):
+        """Fold the learnt ALiBi scales into the slopes used by ``forward``."""
+        # slopes of get_alibi: the bias of head h at distance 1, on cpu even
+        # when the model is built on the meta device (see load_model)
+        with torch.device("cpu"):
+            slopes = -get_alibi(2, self.num_heads)[:, 0, 1]
+        # alibi_scale is 1 x 1 x H x 1 x 1 (shared by all layers) or
+        # L x 1 x H x 1 x 1 with a scale for every layer
+        scale = self.alibi_scale.detach().float().clamp_min(0).view(-1, self.num_heads)
+        slopes = slopes.to(scale.device) * scale
+        self.shared_alibi = slopes.size(0) == 1
+        self.alibi_slopes = slopes.expand(len(self.blocks), -1).contiguous()
+        # one (possibly empty) table per distinct slopes
+        self.bake_alibi_table(self.alibi_table.size(-1))
+
+    @torch.no_grad()
+    def bake_alibi_table(self, max_len: int):
+        """Precompute the ALiBi bias of up to ``max_len`` encoder frames.
+
+        ``forward`` then slices the bias of inputs of at most ``max_len``
+        frames after the conv extractor instead of computing it, longer inputs
+        still compute it.  The table takes H x max_len^2 floats, times the
+        number of layers when the slopes are not shared.  0 removes it.
+        """
+        slopes = self.alibi_slopes[:1] if self.shared_alibi else self.alibi_slopes
+        positions = torch.arange(max_len, device=slopes.device)
+        distance = -(positions[None, :] - positions[:, None]).abs().float()
+        self.alibi_table = slopes[:, :, None, None] * distance
+
+    def truncate(self, num_layers: int):
+        """Run only the first ``num_layers`` blocks and drop the others.
+
+        Unlike setting ``num_layers``, the weights of the dropped blocks are
+        freed and every export (fused, buckets, streaming) sees the
+        truncated model.  Load the weights before truncating.
+        """
+        assert 0 < num_layers <= len(self.blocks), f"no layer {num_layers}"
+        self.blocks = self.blocks[:num_layers]
+        self.num_layers = num_layers
+        self.alibi_slopes = self.alibi_slopes[:num_layers]
+        if not self.shared_alibi:
+            self.alibi_table = self.alibi_table[:num_layers]
+
+    def layer_bias(self, i: int, key_bias: torch.Tensor) -> torch.Tensor:
+        """Attention bias of block ``i``, its ALiBi bias plus ``key_bias``."""
+        if self.alibi_from_slopes:
+            return alibi_bias_from_slopes(self.alibi_slopes[i], key_bias)
+        table = self.alibi_table[0] if self.shared_alibi else self.alibi_table[i]
+        return alibi_bias(self.alibi_slopes[i], table, key_bias)
+
+    def load_state_dict(self, state_dict, strict: bool = True, assign: bool = False):
+        state_dict = convert_state_dict(state_dict, self.prenet_depth)
+        if assign:
+            result = assign_state_dict(self, state_dict, strict=strict)
+        else:
+            result = super().load_state_dict(state_dict, strict=strict)
+        self.update_alibi_slopes()
+        return result
+
+    def get_output_lengths(self, lengths: torch.Tensor) -> torch.Tensor:
+        """Number of output frames of the conv feature extractor."""
+        for _, kernel_size, stride in self.feature_enc_layers:
+            lengths = (
+                torch.div(lengths - kernel_size, stride, rounding_mode="floor") + 1
+            )
+        return lengths
+
+    def embed(
+        self, feats: torch.Tensor, lengths: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Input of the first block.
+
+        Returns:
+            B x T' x D frames, the number of valid output frames and the
+            B x 1 x 1 x T' key padding bias of the attention.
+        """
+        x = self.local_encoder(feats)
+        x = self.project_features(x)
+        B, T, _ = x.shape
+
+        padding_mask: Optional[torch.Tensor] = None
+        if lengths is None:
+            out_lengths = torch.full((B,), T, dtype=torch.long, device=x.device)
+        else:
+            out_lengths = self.get_output_lengths(lengths.to(x.device))
+            padding_mask = (
+                torch.arange(T, device=x.device)[None, :] >= out_lengths[:, None]
+            )
+
+        # convolutional positional encoding, padded frames are zeroed before
+        # every layer so that they do not leak into the valid ones
+        x_pos = x.transpose(1, 2)
+        if padding_mask is not None:
+            keep = (~padding_mask).unsqueeze(1).type_as(x)
+            for layer in self.pos_conv:
+                x_pos = layer(x_pos * keep)
+        else:
+            for layer in self.pos_conv:
+                x_pos = layer(x_pos)
+        x = self.prenet_norm(x + x_pos.transpose(1, 2))
+
+        key_bias = torch.zeros(1, 1, 1, T, device=x.device)
+        if padding_mask is not None:
+            key_bias = torch.zeros(B, 1, 1, T, device=x.device).masked_fill(
+                padding_mask[:, None, None, :], float("-inf")
+            )
+        return x, out_lengths, key_bias
+
+    def extract_features(
+        self,
+        feats: torch.Tensor,
+        lengths: Optional[torch.Tensor] = None,
+        layers: Optional[List[int]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, List[torch.Tensor]]:
+        """Run the encoder, keeping only the requested intermediate layers.
+
+        Args:
+            feats: B x T x C normalised mfcc features.
+            lengths: number of valid frames of every utterance, None if no
+                utterance is padded.
+            layers: indices of the layers to return. 0 is the input of the
+                first block and i the output of block i, the prenet blocks
+                being 1 to ``prenet_depth``. Negative indices count from the
+                last block run, the ``num_layers``-th.
+
+        Returns:
+            B x T' x D output of the last block run, the number of valid output
+            frames and the B x T' x D outputs of ``layers`` in the same order.
+        """
+        num_layers = self.num_layers + 1
+        wanted: List[int] = []
+        if layers is not None:
+            for layer in layers:
+                assert -num_layers <= layer < num_layers, f"no layer {layer}"
+                wanted.append(layer % num_layers)
+        layer_results: List[torch.Tensor] = [feats for _ in wanted]
+
+        x, out_lengths, key_bias = self.embed(feats, lengths)
+
+        for j, layer in enumerate(wanted):
+            if layer == 0:
+                layer_results[j] = x
+
+        attn_bias = self.layer_bias(0, key_bias)
+        for i, blk in enumerate(self.blocks):
+            # no break, TorchScript does not support it over a ModuleList
+            if i < self.num_layers:
+                if i > 0 and not self.shared_alibi:
+                    attn_bias = self.layer_bias(i, key_bias)
+                x = blk(x, attn_bias)
+                for j, layer in enumerate(wanted):
+                    if layer == i + 1:
+                        layer_results[j] = x
+
+        return x, out_lengths, layer_results
+
+    def forward(
+        self, feats: torch.Tensor, lengths: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            feats: B x T x C normalised mfcc features.
+            lengths: number of valid frames of every utterance, None if no
+                utterance is padded.
+
+        Returns:
+            B x T' x V logits and the number of valid output frames.
+        """
+        x, out_lengths, _ = self.extract_features(feats, lengths)
+        return self.proj(x), out_lengths
+
+    @torch.jit.unused
+    def iter_layers(
+        self, feats: torch.Tensor, lengths: Optional[torch.Tensor] = None
+    ) -> Iterator[Tuple[int, torch.Tensor, torch.Tensor]]:
+        """Run the blocks one at a time, up to ``num_layers``.
+
+        Yields:
+            The layer (numbered as in ``extract_features``, from 1), its
+            B x T' x D output and the number of valid output frames.  The
+            following blocks only run when the next item is requested.
+        """
+        x, out_lengths, key_bias = self.embed(feats, lengths)
+        attn_bias = self.layer_bias(0, key_bias)
+        for i in range(self.num_layers):
+            if i > 0 and not self.shared_alibi:
+                attn_bias = self.layer_bias(i, key_bias)
+            x = self.blocks[i](x, attn_bias)
+            yield i + 1, x, out_lengths
+
+    @torch.jit.unused
+    def forward_early_exit(
+        self,
+        feats: torch.Tensor,
+        lengths: Optional[torch.Tensor] = None,
+        exit_layers: Sequence[int] = (12, 16, 20),
+        threshold: float = 0.9,
+    ) -> Tuple[torch.Tensor, torch.Tensor, int]:
+        """``forward`` stopping at the first confident checkpoint layer.
+
+        ``proj`` is applied after every layer of ``exit_layers`` (numbered as
+        in ``extract_features``), the model stops there when the mean over
+        the valid frames of the max CTC posterior reaches ``threshold`` for
+        every utterance of the batch.  The ``num_layers``-th layer is the last
+        exit.
+
+        Returns:
+            B x T' x V logits, the number of valid output frames and the layer
+            that produced them.
+        """
+        for layer, x, out_lengths in self.iter_layers(feats, lengths):
+            if layer in exit_layers or layer == self.num_layers:
+                logits = self.proj(x)
+                if layer == self.num_layers:
+                    break
+                if bool((ctc_confidence(logits, out_lengths) >= threshold).all()):
+                    break
+        return logits, out_lengths, layer
+
+
+def ctc_confidence(logits: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+    """Mean over the valid frames of the max CTC posterior, B x T' x V -> B."""
+    probs = logits.float().softmax(dim=-1).amax(dim=-1, keepdim=True)
+    return masked_mean(probs, lengths).squeeze(-1)
+
+
+def masked_mean(x: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+    """Average B x T x D frames over the valid frames of every utterance."""
+    mask = torch.arange(x.size(1), device=x.device)[None, :] < lengths[:, None]
+    mask = mask.unsqueeze(-1).type_as(x)
+    return (x * mask).sum(dim=1) / mask.sum(dim=1).clamp_min(1)
@@ -232,6 +232,7 @@ class AudioEncoder(ModalitySpecificEncoder):
         prenet_depth: int = 8,
     ):
         self.feature_enc_layers = eval(feature_encoder_spec)
+        self.conv_pos_pre_ln = conv_pos_pre_ln
         feature_embed_dim = self.feature_enc_layers[-1][0]
 
         local_encoder = ConvFeatureExtractionModel(
@@ -344,6 +345,25 @@ class AudioEncoder(ModalitySpecificEncoder):
 
         return padding_mask
 
+    def relative_positional_features(self, x, padding_mask):
+        if padding_mask is None or not padding_mask.any():
+            return self.relative_positional_encoder(x)
+
+        # The convolutions would otherwise mix the frames after the end of a
+        # short utterance into its last frames. Zero them before every layer,
+        # so that each utterance sees the same zero padding as when it is
+        # decoded alone.
+        positional_encoder = self.relative_positional_encoder
+        if self.conv_pos_pre_ln:
+            x = positional_encoder[0](x)
+            positional_encoder = positional_encoder[1]
+
+        keep = (~padding_mask).unsqueeze(1).type_as(x)  # B x 1 x T
+        x = x.transpose(1, 2)
+        for layer in positional_encoder[1:-1]:
+            x = layer(x * keep)
+        return x.transpose(1, 2)
+
     def reset_parameters(self):
         super().reset_parameters()
         for mod in self.project_features.children():
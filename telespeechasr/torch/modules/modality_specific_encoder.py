@@ -469,6 +469,9 @@ class ModalitySpecificEncoder(nn.Module):
     def convert_padding_mask(self, x, padding_mask):
         return padding_mask
 
+    def relative_positional_features(self, x, padding_mask):
+        return self.relative_positional_encoder(x)
+
     def decoder_input(self, x, mask_info: MaskInfo, inp_drop=0.1):
         if inp_drop > 0:
             x = F.dropout(x, inp_drop, training=self.training, inplace=True)
@@ -561,7 +564,7 @@ class ModalitySpecificEncoder(nn.Module):
             )
 
         if self.relative_positional_encoder is not None:
-            x_pos = self.relative_positional_encoder(x)
+            x_pos = self.relative_positional_features(x, padding_mask)
 
         masked_padding_mask = padding_mask
         if mask and remove_masked:
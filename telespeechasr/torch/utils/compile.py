@@ -0,0 +1,122 @@
+# -*- coding:utf-8 -*-
+# @FileName  :compile.py
+# @Time      :2024/7/22 10:05
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import logging
+import os
+import time
+from typing import Dict, List, Sequence
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+# bucket sizes in mfcc frames (10ms), 5s to 30s
+DEFAULT_BUCKETS = (500, 1000, 1500, 2000, 3000)
+
+
+def get_bucket(length: int, buckets: Sequence[int] = DEFAULT_BUCKETS) -> int:
+    """Smallest bucket holding ``length`` frames.
+
+    Inputs longer than the largest bucket are rounded up to a multiple of it,
+    so that the number of distinct shapes stays bounded.
+    """
+    for bucket in sorted(buckets):
+        if length <= bucket:
+            return bucket
+    largest = max(buckets)
+    return -(-length // largest) * largest
+
+
+def pad_to_bucket(
+    feats: torch.Tensor, buckets: Sequence[int] = DEFAULT_BUCKETS
+) -> torch.Tensor:
+    """Zero pad B x T x C features along T to the size of their bucket."""
+    bucket = get_bucket(feats.size(1), buckets)
+    return F.pad(feats, (0, 0, 0, bucket - feats.size(1)))
+
+
+def compile_model(model: nn.Module, cache_dir: str = None, **kwargs) -> nn.Module:
+    """``torch.compile`` a model with inductor, caching the compiled kernels on disk.
+
+    Args:
+        model: the model to compile, it is not modified.
+        cache_dir: directory of the inductor cache, reused by later processes.
+            Defaults to the inductor default (a directory under /tmp).
+        kwargs: extra arguments of ``torch.compile``.
+    """
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # read by inductor when it first needs the cache directory
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(cache_dir)
+
+    import torch._inductor.config as inductor_config
+
+    # keep whole compiled graphs across restarts, not only the kernels
+    if hasattr(inductor_config, "fx_graph_cache"):
+        inductor_config.fx_graph_cache = True
+
+    # one graph per (batch size, bucket) is expected, do not fall back to
+    # eager after the default limit of 8 recompilations
+    import torch._dynamo.config as dynamo_config
+
+    dynamo_config.cache_size_limit = max(dynamo_config.cache_size_limit, 64)
+
+    kwargs.setdefault("backend", "inductor")
+    kwargs.setdefault("dynamic", False)
+    return torch.compile(model, **kwargs)
+
+
+@torch.no_grad()
+def report_speedup(
+    eager_model: nn.Module,
+    compiled_model: nn.Module,
+    buckets: Sequence[int] = DEFAULT_BUCKETS,
+    batch_size: int = 1,
+    feature_dim: int = 40,
+    repeat: int = 3,
+    device="cpu",
+) -> List[Dict]:
+    """Time a ``(feats, lengths)`` model eager and compiled at every bucket size.
+
+    The first compiled call of every bucket compiles (or loads from the cache)
+    and is timed separately as ``compile_s``.
+    """
+
+    def timeit(model, feats, lengths):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            model(feats, lengths)
+            if feats.is_cuda:
+                torch.cuda.synchronize()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    report = []
+    for bucket in sorted(buckets):
+        feats = torch.randn(batch_size, bucket, feature_dim, device=device)
+        lengths = torch.full((batch_size,), bucket, dtype=torch.long, device=device)
+
+        start = time.perf_counter()
+        compiled_model(feats, lengths)
+        compile_s = time.perf_counter() - start
+
+        eager_s = timeit(eager_model, feats, lengths)
+        compiled_s = timeit(compiled_model, feats, lengths)
+        report.append(
+            {
+                "bucket": bucket,
+                "compile_s": round(compile_s, 3),
+                "eager_ms": round(eager_s * 1000, 2),
+                "compiled_ms": round(compiled_s * 1000, 2),
+                "speedup": round(eager_s / compiled_s, 3),
+            }
+        )
+        logging.info(
+            f"bucket {bucket}: eager {eager_s * 1000:.1f}ms, compiled "
+            f"{compiled_s * 1000:.1f}ms, speedup {eager_s / compiled_s:.2f}x "
+            f"(first call {compile_s:.1f}s)"
+        )
+    return report
@@ -4,10 +4,18 @@
 # @Author    :lovemefan
 # @Email     :lovemefan@outlook.com
 import argparse
+import json
 import logging
+import os
+import pickle
+import re
+import zipfile
+from typing import Dict, List
 
 import torch
 
+from telespeechasr.torch.utils.utils import SAFETENSORS_INDEX
+
 formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
 logging.basicConfig(format=formatter, level=logging.INFO)
 
@@ -20,42 +28,286 @@ MAPPING = {
     "w2v_encoder.w2v_model.modality_encoders.AUDIO.context_encoder": "modality_encoders.context_encoder",
     "w2v_encoder.w2v_model.blocks": "blocks",
 }
+# weights only used in pre-training
+UNUSED_WEIGHTS = re.compile(r"(^|\.)_ema(\.|$)|\.modality_encoders\.AUDIO\.decoder\.")
+# one match finds the MAPPING prefix of a key, the longest when several match
+PREFIX_PATTERN = re.compile(
+    r"^(%s)(?=\.|$)"
+    % "|".join(re.escape(k) for k in sorted(MAPPING, key=len, reverse=True))
+)
+DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+}
+
+
+def map_key(name: str) -> str:
+    """Data2VecMultiModel key of a fairseq key, None for unused weights."""
+    if UNUSED_WEIGHTS.search(name):
+        return None
+    match = PREFIX_PATTERN.match(name)
+    if match is None:
+        return name
+    return MAPPING[match.group(1)] + name[match.end() :]
+
+
+def element_size(dtype: torch.dtype) -> int:
+    return torch.empty((), dtype=dtype).element_size()
+
+
+class LazyTensor:
+    """A tensor of a torch zip checkpoint, read from the archive by ``load``."""
+
+    def __init__(self, key, dtype, storage_offset, size, stride):
+        self.key = key
+        self.dtype = dtype
+        self.storage_offset = storage_offset
+        self.shape = torch.Size(size)
+        self.stride = stride
+
+    def load(self, archive: zipfile.ZipFile, prefix: str) -> torch.Tensor:
+        storage = bytearray(archive.read(f"{prefix}/data/{self.key}"))
+        data = torch.frombuffer(storage, dtype=self.dtype)
+        tensor = data.as_strided(self.shape, self.stride, self.storage_offset)
+        # a view of a larger storage keeps only its own elements
+        return tensor.clone() if tensor.numel() != data.numel() else tensor
+
+
+class _Stub:
+    """Placeholder of the pickled objects whose class is not importable here."""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __setstate__(self, state):
+        pass
+
+
+class LazyUnpickler(pickle.Unpickler):
+    """Unpickle the ``data.pkl`` of a torch zip checkpoint without reading any tensor.
+
+    Tensors become ``LazyTensor``, so the optimizer state and the EMA
+    weights cost nothing, and objects of classes that are not installed
+    (fairseq, omegaconf) become ``_Stub``.
+    """
+
+    def find_class(self, module, name):
+        if module == "torch._utils" and name in (
+            "_rebuild_tensor",
+            "_rebuild_tensor_v2",
+            "_rebuild_tensor_v3",
+        ):
+            return self.rebuild_tensor
+        if module == "torch._utils" and name == "_rebuild_parameter":
+            return lambda data, *args: data
+        try:
+            return super().find_class(module, name)
+        except (ImportError, AttributeError):
+            return _Stub
+
+    @staticmethod
+    def rebuild_tensor(storage, storage_offset, size, stride, *args):
+        key, dtype = storage
+        if args and isinstance(args[-1], torch.dtype):
+            # _rebuild_tensor_v3 passes the dtype of untyped storages
+            dtype = args[-1]
+        return LazyTensor(key, dtype, storage_offset, size, stride)
 
+    def persistent_load(self, saved_id):
+        _, storage_type, key, _, _ = saved_id
+        dtype = (
+            torch.uint8
+            if storage_type is torch.UntypedStorage
+            else getattr(storage_type, "dtype", torch.uint8)
+        )
+        return key, dtype
 
-def recursively_load_weights(fairseq_model):
-    unused_weights = ["_ema", "modality_encoders.AUDIO.decoder.blocks"]
-    new_weights = {}
 
-    items = list(fairseq_model.items())
-    for name, value in items:
-        for w in unused_weights:
-            if w in name:
+class FairseqCheckpointReader:
+    """The ``model`` tensors of a fairseq checkpoint, read one at a time.
+
+    Only the pickle of the zip archive is read when opening, ``tensors``
+    then holds the ``LazyTensor`` of every used weight under its
+    ``Data2VecMultiModel`` key and ``read`` loads one of them, so the peak
+    memory is about the largest tensor.  Legacy (non zip) checkpoints are
+    loaded whole.
+    """
+
+    def __init__(self, checkpoint_path: str):
+        self.archive = None
+        if zipfile.is_zipfile(checkpoint_path):
+            self.archive = zipfile.ZipFile(checkpoint_path)
+            pkl_name = next(
+                n for n in self.archive.namelist() if n.endswith("/data.pkl")
+            )
+            self.prefix = pkl_name[: -len("/data.pkl")]
+            with self.archive.open(pkl_name) as f:
+                model_state = LazyUnpickler(f).load()["model"]
+        else:
+            logging.warning(
+                f"{checkpoint_path} is not a zip checkpoint, loading it into memory"
+            )
+            # fairseq checkpoints pickle their config, weights_only rejects it
+            model_state = torch.load(
+                checkpoint_path, map_location="cpu", weights_only=False
+            )["model"]
+
+        self.tensors = {}
+        for name, value in model_state.items():
+            new_name = map_key(name)
+            if new_name is None:
                 logging.warning(f"Unused weights: {name}")
-                del fairseq_model[name]
+                continue
+            self.tensors[new_name] = value
+
+    def read(self, name: str) -> torch.Tensor:
+        value = self.tensors[name]
+        if isinstance(value, LazyTensor):
+            value = value.load(self.archive, self.prefix)
+        return value
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_model_shapes() -> Dict[str, torch.Size]:
+    """Keys and shapes of the ``Data2VecMultiModel`` state dict, built on the meta device."""
+    from telespeechasr.torch.model.data2vec_multi_model import Data2VecMultiModel
+
+    with torch.device("meta"):
+        model = Data2VecMultiModel()
+    return {k: v.shape for k, v in model.state_dict().items()}
+
+
+def plan_shards(sizes: Dict[str, int], max_shard_size: int) -> List[List[str]]:
+    """Split the keys, in order, into shards of at most ``max_shard_size`` bytes."""
+    shards, shard_size = [[]], 0
+    for name, size in sizes.items():
+        if shards[-1] and shard_size + size > max_shard_size:
+            shards.append([])
+            shard_size = 0
+        shards[-1].append(name)
+        shard_size += size
+    return shards
+
+
+def convert_telespeech_checkpoint(
+    input,
+    output,
+    dtype: str = None,
+    max_shard_size: int = 2 << 30,
+    verify: bool = True,
+):
+    """Convert a fairseq checkpoint into a ``Data2VecMultiModel`` checkpoint.
+
+    The optimizer state and the EMA weights are never read, see
+    ``FairseqCheckpointReader``.
+
+    Args:
+        output: a ``.pt`` file, or a directory of safetensors shards and
+            their ``model.safetensors.index.json``, which
+            ``telespeechasr.torch.utils.utils.load_model`` loads memory mapped.
+        dtype: float32, float16 or bfloat16 to cast the floating tensors to.
+        max_shard_size: maximum bytes of a safetensors shard.
+        verify: check the keys and shapes against ``Data2VecMultiModel``.
+            Missing keys and wrong shapes are errors, unexpected keys are
+            dropped with a warning.
+    """
+    cast = DTYPES[dtype] if dtype is not None else None
+    with FairseqCheckpointReader(input) as reader:
+        names = list(reader.tensors)
+        if verify:
+            expected = get_model_shapes()
+            for name in names:
+                if name not in expected:
+                    logging.warning(f"Unexpected weights: {name}")
+                    continue
+                shape = tuple(reader.tensors[name].shape)
+                assert shape == expected[name], f"{name}: {shape} != {expected[name]}"
+            missing = set(expected) - set(names)
+            assert not missing, f"missing weights: {sorted(missing)}"
+            names = [name for name in names if name in expected]
+
+        def read(name):
+            value = reader.read(name)
+            if cast is not None and value.is_floating_point():
+                value = value.to(cast)
+            return value.contiguous()
+
+        if output.endswith(".pt"):
+            torch.save({name: read(name) for name in names}, output)
+            return
 
-    for name, value in fairseq_model.items():
-        is_needed = True
-        for key, mapped_key in MAPPING.items():
-            if key in name:
-                logging.info(f"Replace {name} with {name.replace(key, mapped_key)}")
-                new_weights[name.replace(key, mapped_key)] = value
-                is_needed = False
-        if is_needed:
-            new_weights[name] = value
+        from safetensors.torch import save_file
 
-    return new_weights
+        # the shards are planned from the shapes, then every tensor is read
+        # once and every shard written as soon as it is complete
+        sizes = {}
+        for name in names:
+            value = reader.tensors[name]
+            value_dtype = value.dtype
+            if cast is not None and value_dtype.is_floating_point:
+                value_dtype = cast
+            sizes[name] = value.shape.numel() * element_size(value_dtype)
+        shards = plan_shards(sizes, max_shard_size)
 
+        os.makedirs(output, exist_ok=True)
+        weight_map = {}
+        for i, shard in enumerate(shards):
+            shard_name = f"model-{i + 1:05d}-of-{len(shards):05d}.safetensors"
+            save_file(
+                {name: read(name) for name in shard},
+                os.path.join(output, shard_name),
+                metadata={"format": "pt"},
+            )
+            weight_map.update((name, shard_name) for name in shard)
+            logging.info(f"Saved {shard_name}")
 
-def convert_telespeech_checkpoint(input, output):
-    fairseq_model = torch.load(input, map_location="cpu")
-    new_weights = recursively_load_weights(fairseq_model["model"])
-    torch.save(new_weights, output)
+    with open(os.path.join(output, SAFETENSORS_INDEX), "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "metadata": {"total_size": sum(sizes.values())},
+                "weight_map": weight_map,
+            },
+            f,
+            indent=2,
+        )
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--input", type=str, required=True)
-    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=True,
+        help="a .pt file, or a directory of sharded safetensors",
+    )
+    parser.add_argument(
+        "--dtype", type=str, default=None, choices=list(DTYPES), help="cast the weights"
+    )
+    parser.add_argument(
+        "--max_shard_size", type=int, default=2048, help="MB of a safetensors shard"
+    )
+    parser.add_argument(
+        "--no_verify",
+        action="store_true",
+        help="do not check the keys and shapes against Data2VecMultiModel",
+    )
 
     args = parser.parse_args()
-    convert_telespeech_checkpoint(args.input, args.output)
+    convert_telespeech_checkpoint(
+        args.input,
+        args.output,
+        dtype=args.dtype,
+        max_shard_size=args.max_shard_size << 20,
+        verify=not args.no_verify,
+    )
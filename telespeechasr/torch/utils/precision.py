@@ -0,0 +1,37 @@
+# -*- coding:utf-8 -*-
+# @FileName  :precision.py
+# @Time      :2024/7/23 10:40
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import torch
+from torch import nn
+
+from telespeechasr.torch.modules.layernorm import Fp32LayerNorm
+
+
+def convert_to_bf16(model: nn.Module) -> nn.Module:
+    """Prepare a model for bf16 autocast inference, in place.
+
+    The weights of the ``nn.Linear`` and ``nn.Conv1d`` layers, nearly all of
+    the model, are stored in bf16 so that autocast does not keep a converted
+    copy next to the fp32 one.  Every ``nn.LayerNorm`` becomes an
+    ``Fp32LayerNorm`` with fp32 parameters, so normalisation runs in fp32 on
+    bf16 activations.  The attention of ``Data2VecCtcInference`` already adds
+    the ALiBi bias and normalises in fp32.
+
+    Convert the model before moving it to its device, it must then be run
+    under ``torch.autocast(device_type, dtype=torch.bfloat16)``.
+    """
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, nn.LayerNorm) and not isinstance(child, Fp32LayerNorm):
+                norm = Fp32LayerNorm(
+                    child.normalized_shape,
+                    eps=child.eps,
+                    elementwise_affine=child.elementwise_affine,
+                )
+                norm.load_state_dict(child.state_dict())
+                setattr(module, name, norm)
+            elif isinstance(child, (nn.Linear, nn.Conv1d)):
+                child.to(torch.bfloat16)
+    return model
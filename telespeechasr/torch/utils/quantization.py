@@ -0,0 +1,97 @@
+# -*- coding:utf-8 -*-
+# @FileName  :quantization.py
+# @Time      :2024/7/24 09:50
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import argparse
+import logging
+import os
+import re
+from typing import Dict, List
+
+import torch
+from torch import nn
+
+from telespeechasr.torch.model.data2vec_ctc_inference import Data2VecCtcInference
+from telespeechasr.torch.utils.utils import (
+    is_safetensors,
+    load_checkpoint,
+    load_state_dict,
+)
+
+# the Linear layers of the attention, the mlp and the CTC projection, the
+# feature projection of the conv extractor stays in float
+QUANTIZED_LAYERS = r"^(blocks\.\d+\.(attn\.(qkv|proj)|mlp\.(fc1|fc2))|proj)$"
+
+
+def get_quantized_layers(model: nn.Module) -> List[str]:
+    return [
+        name
+        for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and re.match(QUANTIZED_LAYERS, name)
+    ]
+
+
+def quantize_int8(model: nn.Module) -> nn.Module:
+    """Dynamic int8 quantisation of the attention, mlp and output Linear layers.
+
+    The weights are quantised once, the activations dynamically at
+    every call.  Runs on CPU only.
+    """
+    return torch.ao.quantization.quantize_dynamic(
+        model.cpu().eval(),
+        set(get_quantized_layers(model)),
+        dtype=torch.qint8,
+    )
+
+
+def is_quantized_state_dict(state_dict: Dict) -> bool:
+    return any("_packed_params" in k for k in state_dict)
+
+
+def load_int8_checkpoint(checkpoint_path: str, model: nn.Module) -> nn.Module:
+    """Load a float or an int8 checkpoint into an int8 model.
+
+    A float checkpoint is quantised after loading, an int8 one (written by
+    ``quantize_checkpoint``) is loaded into the quantised layout as is.
+    """
+    if is_safetensors(checkpoint_path):
+        state = load_state_dict(checkpoint_path)
+    else:
+        # packed int8 params are not plain tensors, weights_only would reject them
+        with open(checkpoint_path, "rb") as f:
+            state = torch.load(f, map_location="cpu")
+
+    if not is_quantized_state_dict(state):
+        model.load_state_dict(state)
+        return quantize_int8(model)
+
+    model = quantize_int8(model)
+    model.load_state_dict(state)
+    return model
+
+
+def quantize_checkpoint(checkpoint_path: str, output_path: str):
+    """Write the int8 state dict of a float checkpoint, loaded by ``load_int8_checkpoint``."""
+    model = Data2VecCtcInference()
+    model = load_checkpoint(checkpoint_path, model)
+    model = quantize_int8(model)
+    torch.save(model.state_dict(), output_path)
+    logging.info(
+        f"Saved int8 model to {output_path} "
+        f"({os.path.getsize(output_path) / 2 ** 20:.0f}MB)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="quantise a torch checkpoint to int8 for InferenceProcessor "
+        "--dtype int8"
+    )
+    parser.add_argument("--model_path", type=str, required=True)
+    parser.add_argument("--output_path", type=str, required=True)
+    args = parser.parse_args()
+
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    quantize_checkpoint(args.model_path, args.output_path)
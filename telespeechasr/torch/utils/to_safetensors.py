@@ -0,0 +1,60 @@
+# -*- coding:utf-8 -*-
+# @FileName  :to_safetensors.py
+# @Time      :2024/8/2 11:05
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import argparse
+import logging
+import os
+from typing import Callable
+
+import torch
+from torch import nn
+
+from telespeechasr.torch.model.data2vec_ctc_inference import (
+    Data2VecCtcInference,
+    convert_state_dict,
+)
+from telespeechasr.torch.utils.utils import (
+    load_model,
+    load_state_dict,
+    save_safetensors,
+)
+
+
+def convert_to_safetensors(
+    checkpoint_path: str,
+    output_path: str,
+    model_fn: Callable[[], nn.Module] = Data2VecCtcInference,
+):
+    """Save a torch checkpoint as safetensors in the ``Data2VecCtcInference`` layout.
+
+    The checkpoint may be a ``Data2VecMultiModel`` one (from
+    convert_fairseq_checkpoint.py) or a ``Data2VecCtcInference`` one.  The
+    result is loaded back with ``load_model`` and compared with the input.
+    """
+    state_dict = convert_state_dict(load_state_dict(checkpoint_path))
+    save_safetensors(state_dict, output_path)
+
+    model = load_model(output_path, model_fn)
+    loaded = model.state_dict()
+    for name, value in state_dict.items():
+        assert torch.equal(loaded[name], value.float()), f"{name} differs"
+    logging.info(
+        f"Saved {output_path} ({os.path.getsize(output_path) / 2 ** 20:.0f}MB)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="convert a torch checkpoint to safetensors, which the torch "
+        "runtime memory maps instead of unpickling"
+    )
+    parser.add_argument("--model_path", type=str, required=True)
+    parser.add_argument("--output_path", type=str, required=True)
+    args = parser.parse_args()
+
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    convert_to_safetensors(args.model_path, args.output_path)
@@ -3,29 +3,182 @@
 # @Time      :2024/5/31 14:06
 # @Author    :lovemefan
 # @Email     :lovemefan@outlook.com
+import inspect
+import json
+import os
+import warnings
 from collections import OrderedDict
+from typing import Callable, Dict, List
 
 import numpy as np
 import soundfile as sf
 import torch
+from torch import nn
+from torch.nn.modules.module import _IncompatibleKeys
+
+# index of sharded safetensors, written by convert_fairseq_checkpoint.py
+SAFETENSORS_INDEX = "model.safetensors.index.json"
+# load_state_dict(assign=True) needs torch>=2.1
+_SUPPORTS_ASSIGN = "assign" in inspect.signature(nn.Module.load_state_dict).parameters
+
+
+def is_safetensors(checkpoint_path) -> bool:
+    """A safetensors file, or the index or directory of sharded safetensors."""
+    checkpoint_path = str(checkpoint_path)
+    return (
+        checkpoint_path.endswith(".safetensors")
+        or checkpoint_path.endswith(SAFETENSORS_INDEX)
+        or os.path.isfile(os.path.join(checkpoint_path, SAFETENSORS_INDEX))
+    )
+
+
+def safetensors_files(checkpoint_path) -> List[str]:
+    """The safetensors files of a checkpoint, the shards of an index or directory."""
+    checkpoint_path = str(checkpoint_path)
+    if checkpoint_path.endswith(".safetensors"):
+        return [checkpoint_path]
+    if os.path.isdir(checkpoint_path):
+        checkpoint_path = os.path.join(checkpoint_path, SAFETENSORS_INDEX)
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        weight_map = json.load(f)["weight_map"]
+    root = os.path.dirname(checkpoint_path)
+    return [os.path.join(root, name) for name in dict.fromkeys(weight_map.values())]
+
+
+def load_state_dict(
+    checkpoint_path, device=torch.device("cpu")
+) -> Dict[str, torch.Tensor]:
+    """Read the tensors of a checkpoint without building a model.
+
+    Safetensors (one file, or the index or directory of sharded ones) are
+    memory mapped: on cpu the tensors point into the mapping without any
+    copy, pages are read from disk when first touched and processes loading
+    the same file share them through the page cache.  A pickle is read with
+    ``weights_only``.
+    """
+    if is_safetensors(checkpoint_path):
+        from safetensors import safe_open
+
+        state = {}
+        for file in safetensors_files(checkpoint_path):
+            with safe_open(file, framework="pt", device=str(device)) as f:
+                state.update((key, f.get_tensor(key)) for key in f.keys())
+        return state
+
+    with open(checkpoint_path, "rb") as f:
+        return torch.load(f, map_location=device, weights_only=True)
+
+
+def save_safetensors(state_dict: Dict[str, torch.Tensor], checkpoint_path: str):
+    """Save a state dict as safetensors, for ``load_state_dict`` and ``load_model``."""
+    from safetensors.torch import save_file
+
+    state_dict = {k: v.detach().contiguous() for k, v in state_dict.items()}
+    save_file(state_dict, checkpoint_path, metadata={"format": "pt"})
 
 
 def load_checkpoint(checkpoint_path, model, device=torch.device("cpu")):
     """Load checkpoint from disk.
     Args:
-        checkpoint_path (str): Path to checkpoint.
+        checkpoint_path (str): Path to checkpoint, a pickle or safetensors.
         model (nn.Module): Model to load.
-        device (torch.device): Device to load.
+        device (torch.device): Device the tensors are loaded to.
     Returns:
-        dict: Checkpoint loaded.
+        nn.Module: The model, with the weights copied in.
     """
-    with open(checkpoint_path, "rb") as f:
-        state = torch.load(f)
-
+    state = load_state_dict(checkpoint_path, device)
     model.load_state_dict(state)
     return model
 
 
+def assign_state_dict(
+    model: nn.Module, state_dict: Dict[str, torch.Tensor], strict: bool = True
+) -> _IncompatibleKeys:
+    """``load_state_dict(assign=True)``, also on torch<2.1.
+
+    The tensors of the state dict replace the parameters (as parameters
+    without grad) and the buffers of the model instead of being copied into
+    them, so a model built on the meta device gets the memory mapped tensors
+    of ``load_state_dict`` as they are.
+    """
+    if _SUPPORTS_ASSIGN:
+        return nn.Module.load_state_dict(model, state_dict, strict=strict, assign=True)
+
+    expected = model.state_dict(keep_vars=True)
+    missing = [k for k in expected if k not in state_dict]
+    unexpected = [k for k in state_dict if k not in expected]
+    if strict and (missing or unexpected):
+        raise RuntimeError(
+            f"Error(s) in loading state_dict for {type(model).__name__}: "
+            f"missing keys {missing}, unexpected keys {unexpected}"
+        )
+    for name, tensor in state_dict.items():
+        if name not in expected:
+            continue
+        if tensor.shape != expected[name].shape:
+            raise RuntimeError(
+                f"size mismatch for {name}: {tuple(tensor.shape)} in the "
+                f"checkpoint, {tuple(expected[name].shape)} in the model"
+            )
+        module_name, _, attr = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        if attr in module._parameters:
+            module._parameters[attr] = nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[attr] = tensor
+    return _IncompatibleKeys(missing, unexpected)
+
+
+def load_model(
+    checkpoint_path,
+    model_fn: Callable[[], nn.Module],
+    device=torch.device("cpu"),
+    dtype: torch.dtype = torch.float32,
+) -> nn.Module:
+    """Build a model straight from a checkpoint, without initialising it first.
+
+    ``model_fn`` runs on the meta device, so no memory is allocated and no
+    random init is computed, then the checkpoint tensors become the
+    parameters as they are.  With a safetensors checkpoint on cpu the
+    parameters are the memory mapped tensors of ``load_state_dict``: loading
+    is nearly instant and the weight pages are shared by every process
+    serving the same file.  Tensors stored in another floating ``dtype`` are
+    converted, which copies them.
+
+    The ``load_state_dict`` of the model must take ``assign`` (any model on
+    torch>=2.1, ``Data2VecCtcInference`` on every version, through
+    ``assign_state_dict``), otherwise the model is built and the weights
+    copied in as usual.  Buffers missing from the checkpoint must be
+    computed by the ``load_state_dict`` of the model, as
+    ``Data2VecCtcInference`` does.
+    """
+    with torch.device("meta"):
+        model = model_fn()
+    if "assign" not in inspect.signature(model.load_state_dict).parameters:
+        warnings.warn(
+            f"{type(model).__name__}.load_state_dict does not take assign on "
+            f"torch {torch.__version__}: the model is initialised and the "
+            f"weights of {checkpoint_path} copied in, without memory mapping",
+            RuntimeWarning,
+        )
+        return load_checkpoint(checkpoint_path, model_fn(), device).to(device)
+
+    state = load_state_dict(checkpoint_path, device)
+    state = {
+        k: v.to(dtype) if v.is_floating_point() and v.dtype != dtype else v
+        for k, v in state.items()
+    }
+    model.load_state_dict(state, assign=True)
+
+    on_meta = [
+        name
+        for name, tensor in [*model.named_parameters(), *model.named_buffers()]
+        if tensor.is_meta
+    ]
+    assert not on_meta, f"not initialised by {checkpoint_path}: {on_meta}"
+    return model
+
+
 def read_wave(filename) -> torch.Tensor:
     """Read a wave file and return it as a 1-D tensor.
 
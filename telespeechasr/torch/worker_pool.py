@@ -0,0 +1,288 @@
+# -*- coding:utf-8 -*-
+# @FileName  :worker_pool.py
+# @Time      :2024/8/5 10:20
+# @Author    :lovemefan
+# @Email     :lovemefan@outlook.com
+import argparse
+import ctypes
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import time
+from typing import Dict, List, Sequence
+
+import torch
+
+from telespeechasr.torch.utils.utils import is_safetensors, safetensors_files
+
+# InferenceProcessor of the parent, inherited by the forked workers
+_processor = None
+
+
+def _init_worker(num_threads: int, processor_kwargs: Dict = None):
+    """Set the threads of a worker, and load its own model when not shared."""
+    global _processor
+    torch.set_num_threads(num_threads)
+    if processor_kwargs is not None:
+        from telespeechasr.torch.infer import InferenceProcessor
+
+        _processor = InferenceProcessor(device="cpu", **processor_kwargs)
+
+
+def _infer_batch(audio_paths: List[str]) -> List[str]:
+    return _processor.infer_batch(audio_paths, device="cpu")
+
+
+def share_weights(model: torch.nn.Module, checkpoint_path: str) -> int:
+    """Move to shared memory the tensors that are not mapped from the checkpoint.
+
+    Tensors of a memory mapped safetensors checkpoint are already shared
+    through the page cache, the others (a pickle, or weights converted to
+    another dtype after loading) are copied to shared memory once and the
+    heap they leave is given back to the system.
+
+    Returns:
+        The number of bytes moved to shared memory.
+    """
+    files = set()
+    if is_safetensors(checkpoint_path):
+        files = {os.path.realpath(file) for file in safetensors_files(checkpoint_path)}
+    mapped = []
+    with open("/proc/self/maps", "r") as f:
+        for line in f:
+            fields = line.rstrip("\n").split(maxsplit=5)
+            if len(fields) == 6 and fields[5] in files:
+                start, end = (int(x, 16) for x in fields[0].split("-"))
+                mapped.append((start, end))
+
+    moved = 0
+    for tensor in [*model.parameters(), *model.buffers()]:
+        ptr = tensor.data_ptr()
+        if not any(start <= ptr < end for start, end in mapped):
+            tensor.share_memory_()
+            moved += tensor.untyped_storage().nbytes()
+
+    if moved:
+        # the heap keeps the freed copies resident, the workers would
+        # inherit them and the next pool would load on top of them
+        try:
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+    return moved
+
+
+def read_memory(pid: int) -> Dict[str, float]:
+    """RSS, PSS and USS of a process in MB.
+
+    The PSS divides every shared page by the number of processes mapping
+    it, so the PSS of a pool adds up to its real footprint while its RSS
+    counts the shared weights once per process.
+    """
+    memory = {}
+    with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            if key in ("Rss", "Pss", "Private_Clean", "Private_Dirty"):
+                memory[key] = int(value.split()[0]) / 1024
+    return {
+        "rss_mb": memory["Rss"],
+        "pss_mb": memory["Pss"],
+        "uss_mb": memory["Private_Clean"] + memory["Private_Dirty"],
+    }
+
+
+class SharedWeightPool:
+    """Torch inference workers sharing the weights of one model in memory.
+
+    The model is loaded once in the parent, then the workers are forked and
+    use its weights without any copy:
+
+    - a safetensors checkpoint is memory mapped (see ``load_model``), every
+      worker maps the same pages of the page cache;
+    - other weights are moved to shared memory first (see ``share_weights``),
+      so that no page is duplicated by copy on write.
+
+    The parent must not run the model before the workers are forked, the
+    thread pools of torch do not survive a fork.  With ``shared=False``
+    every worker loads its own model instead, the layout this pool replaces.
+
+    Args:
+        num_workers: number of worker processes.
+        num_threads: intra-op threads of every worker.
+        dtype: dtype of ``InferenceProcessor``, float32, bfloat16 or int8.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        num_workers: int = 2,
+        num_threads: int = 1,
+        dtype: str = "float32",
+        vocab_path: str = None,
+        shared: bool = True,
+    ):
+        global _processor
+        from telespeechasr.torch.infer import InferenceProcessor
+
+        self.num_workers = num_workers
+        processor_kwargs = dict(
+            model_path=model_path, vocab_path=vocab_path, dtype=dtype
+        )
+        if shared:
+            _processor = InferenceProcessor(device="cpu", **processor_kwargs)
+            moved = share_weights(_processor.model, model_path)
+            logging.info(f"Moved {moved / 2 ** 20:.0f}MB of weights to shared memory")
+            context = multiprocessing.get_context("fork")
+            initargs = (num_threads, None)
+        else:
+            context = multiprocessing.get_context("spawn")
+            initargs = (num_threads, processor_kwargs)
+        self.pool = context.Pool(num_workers, _init_worker, initargs)
+
+    def infer_batches(
+        self, audio_paths: Sequence[str], batch_size: int = 1
+    ) -> List[str]:
+        """Recognise the audio files, ``batch_size`` at a time per worker, in order."""
+        batches = [
+            list(audio_paths[i : i + batch_size])
+            for i in range(0, len(audio_paths), batch_size)
+        ]
+        return [
+            text for texts in self.pool.map(_infer_batch, batches) for text in texts
+        ]
+
+    def memory_report(self) -> Dict:
+        """Memory of the parent and of every worker, and their totals."""
+        processes = [read_memory(os.getpid())] + [
+            read_memory(p.pid) for p in multiprocessing.active_children()
+        ]
+        report = {
+            key: round(sum(p[key] for p in processes), 1)
+            for key in ("rss_mb", "pss_mb", "uss_mb")
+        }
+        report["processes"] = processes
+        return report
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self._release()
+
+    def _release(self):
+        # the weights of the parent would otherwise stay in memory until the
+        # next pool replaces them
+        global _processor
+        _processor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.pool.terminate()
+        self.pool.join()
+        self._release()
+
+
+def measure_workers(
+    model_path: str,
+    audio_paths: List[str],
+    worker_counts: Sequence[int] = (1, 2, 4),
+    num_threads: int = 1,
+    batch_size: int = 1,
+    dtype: str = "float32",
+    compare_unshared: bool = False,
+) -> List[Dict]:
+    """Total memory and throughput of the pool for every number of workers.
+
+    Every pool decodes all the audio files once to warm up and then once
+    more timed, the memory is read after that, so the activations and the
+    pages touched by inference are counted.  With ``compare_unshared`` every
+    worker count also runs with one model per worker.
+    """
+    import soundfile as sf
+
+    audio_s = sum(sf.info(path).duration for path in audio_paths)
+    report = []
+    for num_workers in worker_counts:
+        for shared in (True, False) if compare_unshared else (True,):
+            with SharedWeightPool(
+                model_path,
+                num_workers=num_workers,
+                num_threads=num_threads,
+                dtype=dtype,
+                shared=shared,
+            ) as pool:
+                pool.infer_batches(audio_paths, batch_size)
+                start_time = time.time()
+                pool.infer_batches(audio_paths, batch_size)
+                decode_s = time.time() - start_time
+                memory = pool.memory_report()
+            result = {
+                "workers": num_workers,
+                "shared": shared,
+                "rss_mb": memory["rss_mb"],
+                "pss_mb": memory["pss_mb"],
+                "uss_mb": memory["uss_mb"],
+                "throughput": round(audio_s / decode_s, 2),
+            }
+            logging.info(
+                f"{num_workers} workers ({'shared' if shared else 'own'} weights): "
+                f"total RSS {result['rss_mb']:.0f}MB, PSS {result['pss_mb']:.0f}MB, "
+                f"USS {result['uss_mb']:.0f}MB, {result['throughput']:.1f}x realtime"
+            )
+            report.append(result)
+    return report
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(
+        description="measure the memory of torch inference workers sharing the "
+        "weights of one model against the number of workers"
+    )
+    args.add_argument("--model_path", type=str, required=True)
+    args.add_argument(
+        "--audio_path", type=str, required=True, help="directory of wav files"
+    )
+    args.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args.add_argument(
+        "--num_threads", type=int, default=1, help="intra-op threads per worker"
+    )
+    args.add_argument("--batch_size", type=int, default=1)
+    args.add_argument(
+        "--dtype",
+        type=str,
+        default="float32",
+        choices=["float32", "bfloat16", "int8"],
+    )
+    args.add_argument("--max_utts", type=int, default=0)
+    args.add_argument(
+        "--compare_unshared",
+        action="store_true",
+        help="also run every worker count with one model per worker",
+    )
+    args.add_argument(
+        "--output", type=str, default=None, help="json file of the results"
+    )
+    args = args.parse_args()
+
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    audio_paths = sorted(glob.glob(os.path.join(args.audio_path, "*.wav")))
+    if args.max_utts > 0:
+        audio_paths = audio_paths[: args.max_utts]
+    report = measure_workers(
+        args.model_path,
+        audio_paths,
+        worker_counts=args.workers,
+        num_threads=args.num_threads,
+        batch_size=args.batch_size,
+        dtype=args.dtype,
+        compare_unshared=args.compare_unshared,
+    )
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
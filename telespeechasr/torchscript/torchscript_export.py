@@ -4,51 +4,64 @@
 # @Author    :lovemefan
 # @Email     :lovemefan@outlook.com
 import argparse
+import logging
 import os
 
 import torch
 from torch import nn
 
-from telespeechasr.torch.model.data2vec_multi_model import Data2VecMultiModel
+from telespeechasr.torch.model.data2vec_ctc_inference import Data2VecCtcInference
 from telespeechasr.torch.utils.utils import load_checkpoint
 
 
 class data2vec_multo_model_export(nn.Module):
-    def __init__(self, model: Data2VecMultiModel):
+    """Export wrapper of ``Data2VecCtcInference`` for unpadded inputs.
+
+    It returns T x B x V logits, the layout the onnx and torchscript runtimes
+    expect.
+    """
+
+    def __init__(self, model: Data2VecCtcInference):
         super().__init__()
         self.model = model
 
     def forward(self, feats):
-        x = self.model.modality_encoders.local_features(feats)
-        orig_B, orig_T, _ = x.shape
-        x_pos = self.model.modality_encoders.relative_positional_encoder(x)
-        x = x + x_pos
-        alibi_bias = self.model.modality_encoders.get_alibi_bias(
-            batch_size=1,
-            time_steps=orig_T,
-            heads=self.model.modality_encoders.num_alibi_heads,
-            dtype=torch.float32,
-            device=x.device,
-        )
-        alibi_scale = self.model.modality_encoders.alibi_scale.clamp_min(0)
-        alibi_bias = alibi_bias * alibi_scale.squeeze(0).type_as(alibi_bias)
-        x = self.model.modality_encoders.context_encoder(
-            x,
-            None,
-            alibi_bias,
-            None,
-        )
-
-        for i, blk in enumerate(self.model.blocks):
-            x, lr = blk(
-                x,
-                padding_mask=None,
-                alibi_bias=alibi_bias,
-            )
+        logits, _ = self.model(feats)
+        return logits.transpose(0, 1)
+
+
+def export_torchscript(model: Data2VecCtcInference) -> torch.jit.ScriptModule:
+    """Script, freeze and optimise the model for inference.
 
-        x.transpose_(0, 1)
-        model_output = self.model.proj(x)
-        return model_output
+    Scripting keeps the shape dependent code (lengths, ALiBi distances) as
+    code instead of constants of one traced length, so any batch size and
+    number of frames work.  The exported module takes ``(feats, lengths=None)``
+    and returns B x T' x V logits and the output lengths.
+    """
+    scripted = torch.jit.script(model.eval())
+    frozen = torch.jit.freeze(scripted)
+    return torch.jit.optimize_for_inference(frozen)
+
+
+@torch.no_grad()
+def verify(
+    model: Data2VecCtcInference,
+    exported: torch.jit.ScriptModule,
+    lengths=(16, 155, 401, 1000),
+):
+    """Compare the export with the eager model, unpadded and as a padded batch."""
+    for max_length in lengths:
+        feats = torch.randn(2, max_length, 40)
+        feat_lengths = torch.tensor([max_length, max(16, max_length // 2)])
+        for inputs in ((feats[:1],), (feats, feat_lengths)):
+            logits, out_lengths = model(*inputs)
+            exported_logits, exported_lengths = exported(*inputs)
+            assert torch.equal(out_lengths, exported_lengths)
+            diff = (logits - exported_logits).abs().max().item()
+            logging.info(
+                f"T={max_length}, batch={inputs[0].size(0)}: max abs diff {diff:.3g}"
+            )
+            assert diff < 1e-3, f"export differs from eager at T={max_length}"
 
 
 def get_parser():
@@ -74,11 +87,14 @@ def get_parser():
 
 
 if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
     args = get_parser()
-    model = Data2VecMultiModel(vocab_size=7535)
+    model = Data2VecCtcInference(vocab_size=7535)
     model = load_checkpoint(args.model_path, model)
-    model_export = data2vec_multo_model_export(model)
-    model_export = torch.jit.trace(model_export, (torch.randn(1, 155, 40)))
+    model_export = export_torchscript(model)
+    verify(model, model_export)
     torch.jit.save(
         model_export, os.path.join(args.output_dir, f"model_export_torchscript.pt")
     )
@@ -8,11 +8,14 @@ import json
 import logging
 import os
 import time
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 import kaldifeat
+import soundfile as sf
 import torch
+from torch.nn.utils.rnn import pad_sequence
 
+from telespeechasr.decoding.timestamps import ctc_greedy_search, get_frame_shift
 from telespeechasr.torch.utils.utils import load_checkpoint, read_wave
 
 
@@ -47,6 +50,7 @@ class InferenceProcessor:
 
         self.blank_weight = 0.0
         self.blank_mode = "add"
+        self.frame_shift = get_frame_shift()
 
     def postprocess(self, feats):
         assert feats.dim() == 2, feats.dim()
@@ -55,6 +59,47 @@ class InferenceProcessor:
         feats = (feats - m) / (std + self.eps)
         return feats
 
+    def postprocess_batch(self, feats, lengths):
+        """Per-utterance CMVN of B x T x C padded features, same as ``postprocess``."""
+        mask = (
+            torch.arange(feats.size(1), device=feats.device)[None, :] < lengths[:, None]
+        ).unsqueeze(-1)
+        n = lengths.to(feats.dtype)[:, None, None]
+        feats = feats * mask
+        m = feats.sum(dim=1, keepdim=True) / n
+        # unbiased, as torch.std
+        var = ((feats - m) * mask).pow(2).sum(dim=1, keepdim=True) / (n - 1)
+        feats = (feats - m) / (var.sqrt() + self.eps)
+        return feats * mask
+
+    def get_features(
+        self, waves: List[torch.Tensor]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Compute the normalised, zero padded mfcc of a list of waves and their lengths."""
+        feats = self.mfcc([wave.cpu() for wave in waves])
+        lengths = torch.tensor([f.size(0) for f in feats], dtype=torch.long)
+        feats = pad_sequence(feats, batch_first=True)
+        feats = self.postprocess_batch(feats, lengths)
+        return feats, lengths
+
+    def forward(
+        self, feats: torch.Tensor, lengths: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return B x T' x V emissions and the number of valid output frames."""
+        if lengths is None:
+            model_output = self.model(feats)
+        else:
+            model_output = self.model(feats, lengths)
+
+        if isinstance(model_output, tuple):
+            emissions, lengths = model_output
+        else:
+            # traced exports of older versions: T x B x V logits, no padding
+            assert lengths is None, "this export does not support padded batches"
+            emissions = model_output.transpose(0, 1)
+            lengths = torch.full((emissions.size(0),), emissions.size(1))
+        return self.get_logits(emissions), lengths
+
     def get_logits(self, logits):
         if self.blank_weight != 0:
             if self.blank_mode == "add":
@@ -69,12 +114,10 @@ class InferenceProcessor:
     def viterbi_decode(
         self,
         emissions: torch.FloatTensor,
-    ) -> List[List[Dict[str, torch.LongTensor]]]:
-        def get_pred(e):
-            toks = e.argmax(dim=-1).unique_consecutive()
-            return toks[toks != 0].cpu().numpy()
-
-        return [[{"tokens": get_pred(x), "score": 0}] for x in emissions]
+    ) -> List[List[Dict]]:
+        return [
+            [ctc_greedy_search(x.cpu().numpy(), self.frame_shift)] for x in emissions
+        ]
 
     def postprocess_sentence(self, tokens):
         text = ""
@@ -93,22 +136,43 @@ class InferenceProcessor:
         feats = self.mfcc(wave.cpu())
         feats = self.postprocess(feats).unsqueeze(0).to(device)
 
-        model_output = self.model(feats)
-
-        emissions = self.get_logits(model_output)
-        emissions = emissions.transpose(0, 1).float().cpu().contiguous()
+        emissions, _ = self.forward(feats)
+        emissions = emissions.float().cpu().contiguous()
         hypos = self.viterbi_decode(emissions)
 
         result = self.postprocess_sentence(hypos[0][0]["tokens"])
         logging.info(f"Inference time: {time.time() - start_time}s")
         return result
 
+    @torch.no_grad()
+    def infer_batch(self, audio_paths: List[str], device="cuda") -> List[str]:
+        """Recognise several audio files as one padded batch."""
+        device = torch.device(device)
+        waves = [read_wave(audio_path) for audio_path in audio_paths]
+        feats, lengths = self.get_features(waves)
+
+        emissions, lengths = self.forward(feats.to(device), lengths.to(device))
+        emissions = emissions.float().cpu()
+        return [
+            self.postprocess_sentence(hypos[0]["tokens"])
+            for hypos in self.viterbi_decode(
+                [e[:n] for e, n in zip(emissions, lengths.tolist())]
+            )
+        ]
+
 
 if __name__ == "__main__":
     args = argparse.ArgumentParser()
     args.add_argument("--model_path", type=str, required=True)
-    args.add_argument("--audio_path", type=str, required=True)
+    args.add_argument("--audio_path", type=str, nargs="+", required=True)
     args.add_argument("--vocab_path", type=str, default=None)
+    args.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="number of audio files decoded together, files are sorted by "
+        "duration so that each batch has little padding",
+    )
     args.add_argument(
         "--device", type=str, default="cuda", choices=["cpu", "cuda", "mps"]
     )
@@ -121,5 +185,14 @@ if __name__ == "__main__":
     inference_processor = InferenceProcessor(
         args.model_path, args.vocab_path, device=args.device
     )
-    asr_result = inference_processor.infer(args.audio_path, device=args.device)
-    print(asr_result)
+    if args.batch_size == 1:
+        for audio_path in args.audio_path:
+            asr_result = inference_processor.infer(audio_path, device=args.device)
+            print(asr_result)
+    else:
+        audio_paths = sorted(args.audio_path, key=lambda path: sf.info(path).frames)
+        for i in range(0, len(audio_paths), args.batch_size):
+            batch = audio_paths[i : i + args.batch_size]
+            results = inference_processor.infer_batch(batch, device=args.device)
+            for audio_path, asr_result in zip(batch, results):
+                print(f"{audio_path}: {asr_result}")